@@ -1,30 +1,31 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.models.user import User
 from app.schemas.user import UserCreate
-from app.utils.auth import get_password_hash
+from app.utils.auth import hash_password
 
 
-def get_user(db: Session, user_id: int):
-    return db.query(User).filter(User.id == user_id).first()
+async def get_user(db: AsyncSession, user_id: int):
+    return await db.scalar(select(User).where(User.id == user_id))
 
 
-def get_user_by_email(db: Session, email: str):
-    return db.query(User).filter(User.email == email).first()
+async def get_user_by_email(db: AsyncSession, email: str):
+    return await db.scalar(select(User).where(User.email == email))
 
 
-def get_user_by_name(db: Session, username: str | None):
-    return db.query(User).filter(User.username == username).first()
+async def get_user_by_name(db: AsyncSession, username: str | None):
+    return await db.scalar(select(User).where(User.username == username))
 
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(User).offset(skip).limit(limit).all()
+async def get_users(db: AsyncSession, skip: int = 0, limit: int = 100):
+    return list(await db.scalars(select(User).offset(skip).limit(limit)))
 
 
-def create_user(db: Session, user: UserCreate):
-    hashed_password = get_password_hash(user.password)
+async def create_user(db: AsyncSession, user: UserCreate):
+    hashed_password = await hash_password(user.password)
     db_user = User(email=user.email, password=hashed_password, username=user.username)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
@@ -1,12 +1,54 @@
-from fastapi import FastAPI
+from typing import Any
+
+from fastapi import Depends, FastAPI, Request, status
+from fastapi.responses import JSONResponse
 
 from app.routers import auth, user
+from app.utils.auth import (
+    PASSWORD_HASH_RETRY_AFTER,
+    PasswordHasherBusy,
+    password_hasher,
+    require_metrics_token,
+)
+from app.utils.database import close_db, pool_wait_stats
+from app.utils.logger import logger
 
 app = FastAPI()
 
 app.include_router(auth.router, prefix="/auth", tags=["auth"])
 app.include_router(user.router, prefix="/users", tags=["users"])
 
+
+@app.on_event("shutdown")
+async def shutdown_event() -> None:
+    try:
+        await close_db()
+    except Exception as e:
+        logger.error(f"Failed to close the database engine: {e}")
+    password_hasher.shutdown()
+
+
+@app.exception_handler(PasswordHasherBusy)
+async def password_hasher_busy_handler(
+    request: Request, exc: PasswordHasherBusy
+) -> JSONResponse:
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Too many login attempts in progress, try again later"},
+        headers={"Retry-After": str(PASSWORD_HASH_RETRY_AFTER)},
+    )
+
+
+@app.get("/metrics/db-pool", dependencies=[Depends(require_metrics_token)])
+async def fetch_db_pool_metrics() -> Any:
+    return pool_wait_stats.stats()
+
+
+@app.get("/metrics/password-hasher", dependencies=[Depends(require_metrics_token)])
+async def fetch_password_hasher_metrics() -> Any:
+    return password_hasher.stats()
+
+
 # if __name__ == "__main__":
 #     uvicorn.run(
 #         "app.main:app",
@@ -3,7 +3,7 @@ from typing import Annotated
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.crud.user import create_user, get_user_by_email, get_user_by_name
 from app.schemas.token import Token
@@ -19,12 +19,12 @@ router = APIRouter()
 @router.post("/login")
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    db: Annotated[Session, Depends(get_db)],
+    db: Annotated[AsyncSession, Depends(get_db)],
 ) -> Token:
-    user = get_user_by_name(db, username=form_data.username)
+    user = await get_user_by_name(db, username=form_data.username)
     if not user:
         raise HTTPException(status_code=400, detail="User not found")
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, user, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -39,12 +39,12 @@ async def login_for_access_token(
 
 
 @router.post("/signup", response_model=UserBase)
-async def sign_up(payload: UserCreate, db: Session = Depends(get_db)):
-    db_user = get_user_by_email(db, email=payload.email)
+async def sign_up(payload: UserCreate, db: AsyncSession = Depends(get_db)):
+    db_user = await get_user_by_email(db, email=payload.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
 
-    db_user = get_user_by_name(db, username=payload.username)
+    db_user = await get_user_by_name(db, username=payload.username)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    return create_user(db, payload)
+    return await create_user(db, payload)
@@ -0,0 +1,110 @@
+import asyncio
+
+import bcrypt
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+
+from app.main import app
+from app.models.user import User
+from app.utils import auth
+from app.utils.database import Base, get_db
+
+PASSWORD = "correct horse"
+
+
+@pytest.fixture(scope="module")
+def session_factory(tmp_path_factory):
+    path = tmp_path_factory.mktemp("auth") / "auth.db"
+    # every TestClient request runs on a new event loop, so connections are
+    # not pooled between requests
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}", poolclass=NullPool)
+    factory = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+    async def setup():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with factory() as db:
+            # hashed with fewer rounds than BCRYPT_ROUNDS
+            old_hash = bcrypt.hashpw(
+                PASSWORD.encode(), bcrypt.gensalt(rounds=4)
+            ).decode()
+            db.add(User(username="old", email="old@gmail.com", password=old_hash))
+            await db.commit()
+
+    asyncio.run(setup())
+    yield factory
+    asyncio.run(engine.dispose())
+
+
+@pytest.fixture
+def client(session_factory, monkeypatch):
+    async def override_get_db():
+        async with session_factory() as db:
+            yield db
+
+    monkeypatch.setitem(app.dependency_overrides, get_db, override_get_db)
+    monkeypatch.setattr(auth, "SECRET_KEY", "test-secret")
+    monkeypatch.setattr(auth, "ALGORITHM", "HS256")
+    return TestClient(app)
+
+
+def stored_hash(session_factory, username):
+    async def load():
+        async with session_factory() as db:
+            return await db.scalar(
+                select(User.password).where(User.username == username)
+            )
+
+    return asyncio.run(load())
+
+
+def test_login_rehashes_outdated_passwords(client, session_factory):
+    assert stored_hash(session_factory, "old").startswith("$2b$04$")
+
+    response = client.post(
+        "/auth/login", data={"username": "old", "password": PASSWORD}
+    )
+    assert response.status_code == 200, response.text
+    assert response.json()["token_type"] == "bearer"
+
+    new_hash = stored_hash(session_factory, "old")
+    assert new_hash.startswith(f"$2b${auth.BCRYPT_ROUNDS:02d}$")
+    assert bcrypt.checkpw(PASSWORD.encode(), new_hash.encode())
+
+    # a wrong password leaves the hash alone
+    response = client.post("/auth/login", data={"username": "old", "password": "x"})
+    assert response.status_code == 401, response.text
+    assert stored_hash(session_factory, "old") == new_hash
+
+
+def test_busy_password_hasher_returns_503(client, monkeypatch):
+    monkeypatch.setattr(auth.password_hasher, "max_pending", 0)
+    rejected = auth.password_hasher.rejected_total
+
+    response = client.post(
+        "/auth/login", data={"username": "old", "password": PASSWORD}
+    )
+    assert response.status_code == 503, response.text
+    assert response.headers["retry-after"] == str(auth.PASSWORD_HASH_RETRY_AFTER)
+
+    response = client.post(
+        "/auth/signup",
+        json={"username": "new", "email": "new@gmail.com", "password": PASSWORD},
+    )
+    assert response.status_code == 503, response.text
+    assert auth.password_hasher.rejected_total == rejected + 2
+
+
+@pytest.mark.parametrize("path", ["/metrics/db-pool", "/metrics/password-hasher"])
+def test_metrics_need_the_metrics_token(client, monkeypatch, path):
+    monkeypatch.setattr(auth, "METRICS_TOKEN", None)
+    assert client.get(path, headers={"X-Metrics-Token": ""}).status_code == 404
+
+    monkeypatch.setattr(auth, "METRICS_TOKEN", "secret")
+    assert client.get(path).status_code == 404
+    assert client.get(path, headers={"X-Metrics-Token": "wrong"}).status_code == 404
+    response = client.get(path, headers={"X-Metrics-Token": "secret"})
+    assert response.status_code == 200, response.text
@@ -1,24 +1,96 @@
+import asyncio
+import hmac
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from typing import Annotated, Any, Callable, TypeVar
 
 import jwt
+from fastapi import Header, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
 
 # openssl rand -hex 32
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM", "")
+# shared secret for the /metrics endpoints, which are not served without one
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# hashes with fewer rounds are rehashed on the next successful login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+# bcrypt releases the GIL, so a thread pool hashes in parallel
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count())))
+# hashing requests waiting or running before new ones are turned away
+PASSWORD_HASH_MAX_PENDING = int(
+    os.getenv("PASSWORD_HASH_MAX_PENDING", str(PASSWORD_HASH_WORKERS * 4))
+)
+PASSWORD_HASH_RETRY_AFTER = int(os.getenv("PASSWORD_HASH_RETRY_AFTER", "1"))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
+T = TypeVar("T")
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many password hashes are already queued."""
+
+
+class PasswordHasher:
+    """Runs bcrypt off the event loop in a bounded thread pool."""
+
+    def __init__(self, workers: int, max_pending: int) -> None:
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="password-hasher"
+        )
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected_total = 0
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        if self.pending >= self.max_pending:
+            self.rejected_total += 1
+            raise PasswordHasherBusy()
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, fn, *args)
+        finally:
+            self.pending -= 1
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
+    def stats(self) -> dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "rejected_total": self.rejected_total,
+        }
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
+
+
+async def hash_password(password: str) -> str:
+    return await password_hasher.run(pwd_context.hash, password)
+
+
+async def verify_and_update_password(
+    plain_password: str, hashed_password: str
+) -> tuple[bool, str | None]:
+    """Verify the password, returning a new hash if the stored one is outdated."""
+    return await password_hasher.run(
+        pwd_context.verify_and_update, plain_password, hashed_password
+    )
 
 
 def decode_access_token(token: str):
@@ -34,3 +106,15 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
+
+
+def require_metrics_token(
+    x_metrics_token: Annotated[str | None, Header()] = None
+) -> None:
+    """Hide the metrics endpoints from callers without the metrics token."""
+    if (
+        not METRICS_TOKEN
+        or x_metrics_token is None
+        or not hmac.compare_digest(x_metrics_token, METRICS_TOKEN)
+    ):
+        raise HTTPException(status_code=404, detail="Not Found")
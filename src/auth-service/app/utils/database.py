@@ -1,32 +1,113 @@
 import os
-from typing import Any, Generator
+import time
+from typing import Any, AsyncGenerator
 
-from sqlalchemy import create_engine
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import Session, sessionmaker
 
 from app.utils.logger import logger
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./test.db")
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
+# connection pool tuning, see the SQLAlchemy QueuePool docs
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# log a warning when a request waits longer than this for a connection
+DB_POOL_SLOW_WAIT_MS = float(os.getenv("DB_POOL_SLOW_WAIT_MS", "100"))
+
+# asyncio drivers used in place of the sync drivers of the DATABASE_URL
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def get_async_database_url(url: str) -> str:
+    scheme, _, rest = url.partition("://")
+    dialect = scheme.split("+")[0]
+    if dialect not in ASYNC_DRIVERS:
+        raise RuntimeError(f"no asyncio driver configured for '{dialect}'")
+    return f"{ASYNC_DRIVERS[dialect]}://{rest}"
+
+
+def get_pool_options(url: str) -> dict[str, Any]:
+    if url.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+
+
+class PoolWaitStats:
+    """Time spent by requests waiting to check a connection out of the pool."""
+
+    def __init__(self) -> None:
+        self.checkouts = 0
+        self.slow_checkouts = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    def record(self, wait_ms: float) -> None:
+        self.checkouts += 1
+        self.total_wait_ms += wait_ms
+        self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        if wait_ms >= DB_POOL_SLOW_WAIT_MS:
+            self.slow_checkouts += 1
+            logger.warning(f"Waited {wait_ms:.1f}ms for a database connection")
+
+    def stats(self) -> dict[str, Any]:
+        pool: Any = engine.pool
+        stats: dict[str, Any] = {
+            "checkouts": self.checkouts,
+            "slow_checkouts": self.slow_checkouts,
+            "avg_wait_ms": self.total_wait_ms / self.checkouts if self.checkouts else 0,
+            "max_wait_ms": self.max_wait_ms,
+        }
+        # only QueuePool has a size, SQLite uses a pool without limits
+        if hasattr(pool, "size"):
+            stats.update(
+                pool_size=pool.size(),
+                checked_out=pool.checkedout(),
+                overflow=pool.overflow(),
+                max_overflow=DB_MAX_OVERFLOW,
+            )
+        return stats
+
+
+ASYNC_DATABASE_URL = get_async_database_url(SQLALCHEMY_DATABASE_URL)
+engine = create_async_engine(
+    ASYNC_DATABASE_URL,
     pool_pre_ping=True,  # Ensure the connection is valid before each use
+    **get_pool_options(ASYNC_DATABASE_URL),
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+pool_wait_stats = PoolWaitStats()
 
 Base = declarative_base()
 
 
+async def close_db() -> None:
+    await engine.dispose()
+
+
 # Dependency
-def get_db() -> Generator[Session, Any, None]:
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
     db = SessionLocal()
     try:
+        # check the connection out up front so the pool wait can be measured
+        started = time.perf_counter()
+        await db.connection()
+        pool_wait_stats.record((time.perf_counter() - started) * 1000)
         yield db
     except OperationalError as e:
         # Handle reconnection logic
         logger.error(f"Operational Error encountered: {e}")
         raise e
     finally:
-        db.close()
+        await db.close()
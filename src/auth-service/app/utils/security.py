@@ -2,25 +2,36 @@ from typing import Annotated
 
 import jwt
 from fastapi import Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.crud.user import get_user_by_name
+from app.models.user import User as UserModel
 from app.schemas.token import TokenData
 from app.schemas.user import User
-from app.utils.auth import decode_access_token, oauth2_scheme, verify_password
+from app.utils.auth import (
+    decode_access_token,
+    oauth2_scheme,
+    verify_and_update_password,
+)
 from app.utils.database import get_db
 
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = get_user_by_name(db, username)
+# the user is looked up by the caller, so a login only queries the database once
+async def authenticate_user(db: AsyncSession, user: UserModel | None, password: str):
     if not user:
         return False
-    if not verify_password(password, user.password):
+    verified, new_hash = await verify_and_update_password(password, user.password)
+    if not verified:
         return False
+    if new_hash:
+        # the stored hash uses outdated settings, replace it while we have the password
+        user.password = new_hash
+        await db.commit()
     return user
 
+
 async def get_current_user(
-    db: Annotated[Session, Depends(get_db)],
+    db: Annotated[AsyncSession, Depends(get_db)],
     token: Annotated[str, Depends(oauth2_scheme)],
 ):
     credentials_exception = HTTPException(
@@ -36,7 +47,7 @@ async def get_current_user(
         token_data = TokenData(username=username)
     except jwt.InvalidTokenError:
         raise credentials_exception
-    user = get_user_by_name(db, token_data.username)
+    user = await get_user_by_name(db, token_data.username)
     if user is None:
         raise credentials_exception
     return user
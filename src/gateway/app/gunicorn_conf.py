@@ -0,0 +1,42 @@
+"""Gunicorn settings for running the gateway with several worker processes.
+
+    gunicorn -c python:app.gunicorn_conf app.main:app
+
+Every worker runs the app's startup and shutdown events, so each one opens
+its own upstream connection pools and user cache connection.
+"""
+
+import importlib.util
+import multiprocessing
+import os
+from typing import Any
+
+from app.utils.user_cache import USER_CACHE_BACKEND, remove_shared_cache
+
+bind = os.getenv("GATEWAY_BIND", "0.0.0.0:8000")
+# one worker per core by default, the gateway mostly waits on its upstreams
+workers = int(os.getenv("GATEWAY_WORKERS", str(multiprocessing.cpu_count())))
+# uvicorn picks uvloop and httptools when they are installed
+worker_class = "uvicorn.workers.UvicornWorker"
+# seconds a worker may be unresponsive before it is restarted ...
+timeout = int(os.getenv("GATEWAY_WORKER_TIMEOUT", "60"))
+# ... and may take to finish its requests on shutdown
+graceful_timeout = int(os.getenv("GATEWAY_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GATEWAY_KEEPALIVE", "5"))
+# the app is imported in each worker, nothing is shared through fork()
+preload_app = False
+
+
+def on_starting(server: Any) -> None:
+    if USER_CACHE_BACKEND == "sqlite":
+        remove_shared_cache()
+    server.log.info(
+        f"Starting {workers} gateway workers, "
+        f"uvloop: {importlib.util.find_spec('uvloop') is not None}, "
+        f"httptools: {importlib.util.find_spec('httptools') is not None}, "
+        f"user cache: {USER_CACHE_BACKEND}"
+    )
+
+
+def worker_exit(server: Any, worker: Any) -> None:
+    server.log.info(f"Gateway worker {worker.pid} exited")
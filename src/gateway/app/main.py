@@ -1,122 +1,291 @@
 import json
+import os
 from typing import Any
 
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse, Response
-from httpx import AsyncClient
-from starlette.middleware.base import BaseHTTPMiddleware
+import jwt
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 
+from app.utils.auth import decode_access_token, require_metrics_token
+from app.utils.compression import (
+    CompressionMiddleware,
+    compression_stats,
+    strip_etag_encodings,
+)
 from app.utils.logger import logger
-from app.utils.middleware import middleware_logger
+from app.utils.middleware import TimingMiddleware
+from app.utils.upstream import (
+    Upstream,
+    close_upstreams,
+    register_upstream,
+    start_upstreams,
+    upstream_stats,
+)
+from app.utils.user_cache import user_cache
 
 app = FastAPI()
-app.add_middleware(BaseHTTPMiddleware, dispatch=middleware_logger)
+# the last middleware added runs first, so the logged time includes compression
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(TimingMiddleware)
 
 # Define your service URLs
-AUTH_SERVICE_URL = "http://auth-service:8000/auth"
-USER_SERVICE_URL = "http://auth-service:8000/users"
-TASK_SERVICE_URL = "http://task-service:8000/tasks"
+AUTH_SERVICE_BASE_URL = os.getenv("AUTH_SERVICE_BASE_URL", "http://auth-service:8000")
+TASK_SERVICE_BASE_URL = os.getenv("TASK_SERVICE_BASE_URL", "http://task-service:8000")
+AUTH_SERVICE_URL = f"{AUTH_SERVICE_BASE_URL}/auth"
+USER_SERVICE_URL = f"{AUTH_SERVICE_BASE_URL}/users"
+TASK_SERVICE_URL = f"{TASK_SERVICE_BASE_URL}/tasks"
+
+# pipe task-service bodies through instead of decoding and re-encoding them
+STREAMING_PROXY_ENABLED = os.getenv("STREAMING_PROXY_ENABLED", "true").lower() == "true"
+# open change feeds per worker, each holds a task-service connection
+FEED_MAX_CONNECTIONS = int(os.getenv("FEED_MAX_CONNECTIONS", "1000"))
+
+# headers that only apply to a single connection and must not be forwarded
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+}
+
+# task-service response headers that no longer apply once the body is decoded
+# and encoded again, every other end-to-end header is passed on
+REENCODED_BODY_HEADERS = {"content-length", "content-encoding", "content-type"}
+
+# app-lifetime upstream clients, one connection pool per service
+auth_service = register_upstream("auth-service", AUTH_SERVICE_BASE_URL)
+task_service = register_upstream("task-service", TASK_SERVICE_BASE_URL)
+# long-lived event streams get their own pool, so they never starve other requests
+task_feed = register_upstream(
+    "task-feed",
+    TASK_SERVICE_BASE_URL,
+    max_connections=FEED_MAX_CONNECTIONS,
+    read_timeout=None,
+)
+
+
+@app.on_event("startup")
+async def startup_event() -> None:
+    # runs in every worker process, nothing here is shared between workers
+    await start_upstreams()
+    await user_cache.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event() -> None:
+    await close_upstreams()
+    await user_cache.close()
+    logger.info("Shutdown event completed")
+
+
+@app.get("/metrics/upstreams", dependencies=[Depends(require_metrics_token)])
+async def fetch_upstream_metrics() -> Any:
+    return upstream_stats()
+
+
+@app.get("/metrics/compression", dependencies=[Depends(require_metrics_token)])
+async def fetch_compression_metrics() -> Any:
+    return compression_stats.stats()
 
 
 @app.post("/login")
 async def forward_login(request: Request) -> Any:
-    async with AsyncClient() as client:
-        # Capture the incoming request method, headers, and body
-        headers = dict(request.headers)
-        body = await request.body()  # Capture request body as bytes
-
-        # Forward the request to the Auth Service
-        response = await client.post(
-            f"{AUTH_SERVICE_URL}/login", headers=headers, content=body
-        )
+    # Capture the incoming request method, headers, and body
+    headers = dict(request.headers)
+    body = await request.body()  # Capture request body as bytes
 
-        # Return the Auth Service's response
-        return JSONResponse(content=response.json(), status_code=response.status_code)
+    # Forward the request to the Auth Service
+    response = await auth_service.request(
+        "POST", f"{AUTH_SERVICE_URL}/login", headers=headers, content=body
+    )
+
+    # Return the Auth Service's response
+    return JSONResponse(content=response.json(), status_code=response.status_code)
 
 
 @app.post("/signup")
 async def forward_signup(request: Request) -> Any:
-    async with AsyncClient() as client:
-        # Capture the incoming request method, headers, and body
-        headers = dict(request.headers)
-        body = await request.body()  # Capture request body as bytes
-
-        # Forward the request to the Auth Service
-        response = await client.post(
-            f"{AUTH_SERVICE_URL}/signup", headers=headers, content=body
-        )
+    # Capture the incoming request method, headers, and body
+    headers = dict(request.headers)
+    body = await request.body()  # Capture request body as bytes
 
-        # Return the Auth Service's response
-        return JSONResponse(content=response.json(), status_code=response.status_code)
+    # Forward the request to the Auth Service
+    response = await auth_service.request(
+        "POST", f"{AUTH_SERVICE_URL}/signup", headers=headers, content=body
+    )
+
+    # Return the Auth Service's response
+    return JSONResponse(content=response.json(), status_code=response.status_code)
 
 
 @app.get("/users/me")
 async def fetch_user_info(request: Request) -> Any:
-    async with AsyncClient() as client:
+    # Forward the request to the Auth Service
+    response = await auth_service.request(
+        "GET", f"{USER_SERVICE_URL}/me", headers=request.headers
+    )
+
+    # Return the Auth Service's response
+    return JSONResponse(content=response.json(), status_code=response.status_code)
 
-        # Forward the request to the Auth Service
-        response = await client.get(f"{USER_SERVICE_URL}/me", headers=request.headers)
 
-        # Return the Auth Service's response
-        return JSONResponse(content=response.json(), status_code=response.status_code)
+async def get_user_info(authorization: str) -> dict[str, Any]:
+    token = authorization.split(" ")[-1]  # Remove "Bearer" prefix
+    try:
+        payload = decode_access_token(token)
+    except jwt.InvalidTokenError:
+        raise HTTPException(
+            status_code=401,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    user_info = await user_cache.get(token)
+    if user_info is None:
+        # cache miss, ask the Auth Service
+        token_header = {"authorization": authorization}
+        response = await auth_service.request(
+            "GET", f"{USER_SERVICE_URL}/me", headers=token_header
+        )
+
+        if not response.is_success:
+            raise HTTPException(response.status_code, response.json())
+
+        response_json = response.json()
+        user_info = {
+            "id": response_json.get("id"),
+            "email": response_json.get("email"),
+            "disabled": response_json.get("disabled", False),
+        }
+        await user_cache.set(
+            token,
+            response_json.get("username"),
+            user_info,
+            token_exp=payload.get("exp") if payload else None,
+        )
+
+    if user_info["disabled"]:
+        raise HTTPException(status_code=400, detail="Inactive user")
+    return user_info
+
+
+@app.delete(
+    "/internal/cache/users/{username}", dependencies=[Depends(require_metrics_token)]
+)
+async def invalidate_user_info(username: str) -> Any:
+    # called when a user is disabled or changed, so stale entries are not served
+    return {"invalidated": await user_cache.invalidate_user(username)}
+
+
+@app.get("/metrics/user-cache", dependencies=[Depends(require_metrics_token)])
+async def fetch_user_cache_metrics() -> Any:
+    return await user_cache.stats()
 
 
 @app.api_route("/tasks/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
 async def proxy_tasks(path: str, request: Request) -> Any:
-    token = request.headers.get("authorization")
-    if token:
-        token = token.split(" ")[1]  # Remove "Bearer" prefix
-    else:
-        return HTTPException(403, "unauthorized")
-
-    async with AsyncClient() as client:
-
-        try:
-            # Forward the request to the Auth Service
-            token_header = {"authorization": request.headers["authorization"]}
-            response = await client.get(f"{USER_SERVICE_URL}/me", headers=token_header)
-
-            if not response.is_success:
-                raise HTTPException(response.status_code, response.json())
-
-            # Return the Auth Service's response
-            response_json = response.json()
-            user_info = {
-                "id": response_json.get("id"),
-                "email": response_json.get("email"),
-            }
-
-            method = request.method
-            # Extract the query parameters
-            query_params = request.query_params
-            url = f"{TASK_SERVICE_URL}/{path}"
-            if query_params:
-                url += f"?{query_params}"
-            headers = dict(request.headers)
-            headers.pop("authorization", None)
-            headers.update({"X-User-Info": json.dumps(user_info)})
-
-            if method == "GET":
-                response = await client.get(url, headers=headers)
-            elif method == "POST":
-                body = await request.body()
-                response = await client.post(url, headers=headers, content=body)
-            elif method == "PUT":
-                body = await request.body()
-                response = await client.put(url, headers=headers, content=body)
-            elif method == "DELETE":
-                response = await client.delete(url, headers=headers)
-            elif method == "PATCH":
-                response = await client.patch(url, headers=headers)
-        except Exception as e:
-            logger.error(f"Exception occurred: {e}")
-            raise HTTPException(500, "Internal server error")
-
-        return (
-            JSONResponse(content=response.json(), status_code=response.status_code)
-            if response.content
-            else Response(status_code=response.status_code)
+    authorization = request.headers.get("authorization")
+    if not authorization:
+        raise HTTPException(403, "unauthorized")
+
+    user_info = await get_user_info(authorization)
+
+    # Extract the query parameters
+    query_params = request.query_params
+    url = f"{TASK_SERVICE_URL}/{path}"
+    if query_params:
+        url += f"?{query_params}"
+    headers = dict(request.headers)
+    headers.pop("authorization", None)
+    headers.update(
+        {
+            "X-User-Info": json.dumps(
+                {"id": user_info["id"], "email": user_info["email"]}
+            )
+        }
+    )
+
+    if "text/event-stream" in request.headers.get("accept", ""):
+        return await stream_tasks(request, url, headers, task_feed)
+    if STREAMING_PROXY_ENABLED:
+        return await stream_tasks(request, url, headers, task_service)
+
+    # the body is read in full here, so the HTTP client sets its own length
+    has_body = "content-length" in headers or "transfer-encoding" in headers
+    headers = {
+        k: v
+        for k, v in headers.items()
+        if k.lower() not in HOP_BY_HOP_HEADERS and k.lower() != "content-length"
+    }
+    # the body is decoded here and compressed again for the client
+    headers["accept-encoding"] = "gzip"
+    try:
+        body = await request.body() if has_body else None
+        response = await task_service.request(
+            request.method, url, headers=headers, content=body
         )
+    except Exception as e:
+        logger.error(f"Exception occurred: {e}")
+        raise HTTPException(500, "Internal server error")
+
+    # validators and pagination headers (link, x-next-cursor) are passed on
+    response_headers = {
+        k: v
+        for k, v in response.headers.items()
+        if k not in HOP_BY_HOP_HEADERS and k not in REENCODED_BODY_HEADERS
+    }
+    if "etag" in response_headers:
+        # the tag of the decoded body, the middleware adds its own encoding
+        response_headers["etag"], _ = strip_etag_encodings(response_headers["etag"])
+    if response.status_code == 304:
+        return Response(status_code=304, headers=response_headers)
+    return (
+        JSONResponse(
+            content=response.json(),
+            status_code=response.status_code,
+            headers=response_headers,
+        )
+        if response.content
+        else Response(status_code=response.status_code, headers=response_headers)
+    )
+
+
+async def stream_tasks(
+    request: Request, url: str, headers: dict[str, str], upstream: Upstream
+) -> Any:
+    """Pipe the request and response bodies through chunk by chunk."""
+    headers = {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+    # the body is passed on as the service encodes it, so only ask for the
+    # encodings the client accepts, instead of the HTTP client's defaults
+    headers.setdefault("accept-encoding", "identity")
+    has_body = "content-length" in headers or "transfer-encoding" in request.headers
+
+    try:
+        response = await upstream.stream(
+            request.method,
+            url,
+            headers=headers,
+            content=request.stream() if has_body else None,
+        )
+    except Exception as e:
+        logger.error(f"Exception occurred: {e}")
+        raise HTTPException(500, "Internal server error")
+
+    response_headers = {
+        k: v for k, v in response.headers.items() if k not in HOP_BY_HOP_HEADERS
+    }
+    return StreamingResponse(
+        upstream.iter_stream(response),
+        status_code=response.status_code,
+        headers=response_headers,
+        background=BackgroundTask(upstream.close_stream, response),
+    )
 
 
 # if __name__ == "__main__":
@@ -0,0 +1,60 @@
+import asyncio
+import logging
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.utils import auth
+from app.utils.user_cache import user_cache
+
+client = TestClient(app)
+
+
+def test_metrics_need_the_metrics_token(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(auth, "METRICS_TOKEN", None)
+    response = client.get("/metrics/user-cache", headers={"X-Metrics-Token": ""})
+    assert response.status_code == 404, response.text
+
+    monkeypatch.setattr(auth, "METRICS_TOKEN", "secret")
+    response = client.get("/metrics/user-cache")
+    assert response.status_code == 404, response.text
+    response = client.get("/metrics/user-cache", headers={"X-Metrics-Token": "wrong"})
+    assert response.status_code == 404, response.text
+
+    response = client.get("/metrics/user-cache", headers={"X-Metrics-Token": "secret"})
+    assert response.status_code == 200, response.text
+    assert "hits" in response.json()
+
+
+def test_user_cache_invalidation_needs_the_metrics_token(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(auth, "METRICS_TOKEN", "secret")
+    user_info = {"id": 1, "email": "user@example.com", "disabled": False}
+    asyncio.run(user_cache.set("token", "user", user_info))
+
+    response = client.delete("/internal/cache/users/user")
+    assert response.status_code == 404, response.text
+    assert asyncio.run(user_cache.get("token")) == user_info
+
+    response = client.delete(
+        "/internal/cache/users/user", headers={"X-Metrics-Token": "secret"}
+    )
+    assert response.status_code == 200, response.text
+    assert response.json() == {"invalidated": 1}
+    assert asyncio.run(user_cache.get("token")) is None
+
+
+def test_request_log_fields(caplog: pytest.LogCaptureFixture) -> None:
+    with caplog.at_level(logging.INFO):
+        client.get("/metrics/user-cache?a=1&b=2")
+
+    [record] = [record for record in caplog.records if hasattr(record, "route")]
+    fields = vars(record)
+    assert fields["url"] == "http://testserver/metrics/user-cache?a=1&b=2"
+    assert fields["method"] == "GET"
+    assert fields["query"] == {"a": "1", "b": "2"}
+    assert fields["route"] == "/metrics/user-cache"
+    assert fields["status_code"] == 404
+    assert fields["process_time"] > 0
@@ -0,0 +1,146 @@
+import gzip
+import json
+from typing import Any
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main
+from app.main import app
+from app.utils.compression import encoded_etag, strip_etag_encodings
+
+TASKS = [{"id": n, "title": f"Task {n}"} for n in range(50)]
+PAGINATION = {
+    "link": '</tasks/?after=49>; rel="next"',
+    "x-next-cursor": "49",
+}
+
+
+def task_service(request: httpx.Request) -> httpx.Response:
+    assert json.loads(request.headers["x-user-info"]) == {
+        "id": 1,
+        "email": "user@example.com",
+    }
+    headers = {"etag": '"l-1"', "cache-control": "private, no-cache", **PAGINATION}
+    if request.headers.get("if-none-match") == '"l-1"':
+        return httpx.Response(304, headers=headers, stream=httpx.ByteStream(b""))
+    # the task service tags its gzip bodies like the gateway does
+    headers["etag"] = '"l-1-gzip"'
+    return httpx.Response(
+        200,
+        # streams like a real connection, so the body can be read raw
+        stream=httpx.ByteStream(gzip.compress(json.dumps(TASKS).encode())),
+        headers={
+            **headers,
+            "content-type": "application/json",
+            "content-encoding": "gzip",
+            "connection": "keep-alive",
+        },
+    )
+
+
+@pytest.fixture
+def client(monkeypatch: pytest.MonkeyPatch) -> TestClient:
+    async def get_user_info(authorization: str) -> dict[str, Any]:
+        return {"id": 1, "email": "user@example.com", "disabled": False}
+
+    monkeypatch.setattr(main, "get_user_info", get_user_info)
+    monkeypatch.setattr(
+        main.task_service,
+        "client",
+        httpx.AsyncClient(
+            transport=httpx.MockTransport(task_service),
+            base_url=main.TASK_SERVICE_BASE_URL,
+        ),
+    )
+    return TestClient(app, headers={"authorization": "Bearer token"})
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_proxy_passes_on_response_headers(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch, streaming: bool
+) -> None:
+    monkeypatch.setattr(main, "STREAMING_PROXY_ENABLED", streaming)
+
+    response = client.get("/tasks/", headers={"accept-encoding": "gzip"})
+    assert response.status_code == 200, response.text
+    assert response.json() == TASKS
+    assert response.headers["content-encoding"] == "gzip"
+    for name, value in PAGINATION.items():
+        assert response.headers[name] == value
+    assert response.headers["etag"] == '"l-1-gzip"'
+    assert response.headers["cache-control"] == "private, no-cache"
+    assert response.headers.get("connection") != "keep-alive"
+
+    # the service is asked about its own tag, the client gets back the one it has
+    response = client.get("/tasks/", headers={"if-none-match": '"l-1-gzip"'})
+    assert response.status_code == 304
+    assert response.headers["x-next-cursor"] == "49"
+    assert response.headers["etag"] == '"l-1-gzip"'
+    response = client.get("/tasks/", headers={"if-none-match": '"l-1"'})
+    assert response.status_code == 304
+    assert response.headers["etag"] == '"l-1"'
+
+
+def test_buffered_proxy_encodes_the_body_again(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(main, "STREAMING_PROXY_ENABLED", False)
+
+    # the client does not accept gzip, the body is decoded for it
+    response = client.get("/tasks/", headers={"accept-encoding": "identity"})
+    assert response.status_code == 200, response.text
+    assert "content-encoding" not in response.headers
+    assert int(response.headers["content-length"]) == len(response.content)
+    assert response.json() == TASKS
+    assert response.headers["link"] == PAGINATION["link"]
+    assert response.headers["etag"] == '"l-1"'
+
+    response = client.get("/tasks/", headers={"accept-encoding": "zstd, br, gzip"})
+    encoding = response.headers["content-encoding"]
+    assert response.headers["etag"] == f'"l-1-{encoding}"'
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_proxy_forwards_request_bodies(
+    monkeypatch: pytest.MonkeyPatch, streaming: bool
+) -> None:
+    received: list[tuple[str, str | None, bytes]] = []
+
+    async def get_user_info(authorization: str) -> dict[str, Any]:
+        return {"id": 1, "email": "user@example.com", "disabled": False}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        received.append((request.method, request.headers.get("content-length"), body))
+        return httpx.Response(204, stream=httpx.ByteStream(b""))
+
+    monkeypatch.setattr(main, "STREAMING_PROXY_ENABLED", streaming)
+    monkeypatch.setattr(main, "get_user_info", get_user_info)
+    monkeypatch.setattr(
+        main.task_service,
+        "client",
+        httpx.AsyncClient(
+            transport=httpx.MockTransport(handler),
+            base_url=main.TASK_SERVICE_BASE_URL,
+        ),
+    )
+    client = TestClient(app, headers={"authorization": "Bearer token"})
+
+    body = b'{"ids": [1, 2]}'
+    response = client.request("DELETE", "/tasks/batch", content=body)
+    assert response.status_code == 204, response.text
+    response = client.get("/tasks/1")
+    assert response.status_code == 204, response.text
+
+    assert received == [("DELETE", str(len(body)), body), ("GET", None, b"")]
+
+
+def test_encoded_etags_round_trip() -> None:
+    assert encoded_etag('W/"a"', "br") == 'W/"a-br"'
+    assert strip_etag_encodings('"a-gzip", W/"b-br", "c"') == (
+        '"a", W/"b", "c"',
+        {'"a"': '"a-gzip"', '"b"': 'W/"b-br"'},
+    )
+    assert strip_etag_encodings("*") == ("*", {})
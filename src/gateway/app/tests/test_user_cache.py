@@ -0,0 +1,114 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from app.utils.user_cache import SharedUserInfoCache, UserInfoCache
+
+USER = {"id": 1, "email": "user@example.com", "disabled": False}
+
+
+def test_memory_cache_expires_entries() -> None:
+    async def run() -> None:
+        cache = UserInfoCache(ttl=60, max_size=2)
+        await cache.set("a", "user", USER)
+        await cache.set("b", "user", USER, token_exp=time.time() - 1)
+        await cache.set("c", "user", USER)
+        await cache.set("d", "user", USER)
+        assert await cache.get("a") is None  # evicted
+        assert await cache.get("b") is None  # token already expired
+        assert await cache.get("d") == USER
+        assert (await cache.stats())["size"] == 2
+
+        await cache.set("e", "other", USER)
+        assert await cache.invalidate_user("user") == 1
+        assert await cache.get("d") is None
+        assert await cache.get("e") == USER
+        assert cache.tokens_by_user == {"other": {"e"}}
+
+    asyncio.run(run())
+
+
+def test_shared_cache_is_shared_between_workers(tmp_path: Path) -> None:
+    path = str(tmp_path / "cache.sqlite3")
+
+    async def run() -> None:
+        first = SharedUserInfoCache(path, ttl=60, max_size=10)
+        second = SharedUserInfoCache(path, ttl=60, max_size=10)
+        await first.start()
+        await second.start()
+        try:
+            await first.set("token", "user", USER)
+            await first.set("expired", "user", USER, token_exp=time.time() - 1)
+            assert await second.get("token") == USER
+            assert await second.get("expired") is None
+            assert await second.stats() | {"pid": 0} == {
+                "backend": "sqlite",
+                "pid": 0,
+                "path": path,
+                "size": 1,
+                "max_size": 10,
+                "hits": 1,
+                "misses": 1,
+                "errors": 0,
+            }
+
+            # an invalidation through one worker reaches the other
+            await second.set("other", "other", USER)
+            assert await first.invalidate_user("user") == 1
+            assert await second.get("token") is None
+            assert await second.get("other") == USER
+        finally:
+            await first.close()
+            await second.close()
+
+    asyncio.run(run())
+
+
+def test_shared_cache_does_not_block_the_event_loop(tmp_path: Path) -> None:
+    path = str(tmp_path / "cache.sqlite3")
+    threads: set[str] = set()
+
+    async def run() -> None:
+        cache = SharedUserInfoCache(path, ttl=60, max_size=10)
+        await cache.start()
+        fetch = cache._fetch
+
+        def record_fetch(key: str, now: float) -> tuple[str] | None:
+            threads.add(threading.current_thread().name)
+            return fetch(key, now)
+
+        cache._fetch = record_fetch  # type: ignore[method-assign]
+        # another worker holds the write lock for a while
+        other = sqlite3.connect(path, isolation_level=None)
+        other.execute("BEGIN EXCLUSIVE")
+        ticks = 0
+
+        async def tick() -> None:
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        try:
+            await cache.set("token", "user", USER)
+            # readers do not wait for the writer, the write was not stored
+            assert await cache.get("token") is None
+        finally:
+            ticker.cancel()
+            other.rollback()
+            other.close()
+        # the loop kept running while the cache waited for the lock
+        assert ticks >= 10
+        assert cache.errors == 1
+
+        await cache.set("token", "user", USER)
+        assert await cache.get("token") == USER
+        await cache.close()
+        # failing like a miss once closed
+        assert await cache.get("token") is None
+
+    asyncio.run(run())
+    assert threads and all(name.startswith("user-cache") for name in threads)
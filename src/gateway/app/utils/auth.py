@@ -0,0 +1,33 @@
+import hmac
+import os
+from typing import Annotated, Any
+
+import jwt
+from fastapi import Header, HTTPException
+
+# same key and algorithm the auth-service signs its tokens with
+SECRET_KEY = os.getenv("SECRET_KEY")
+ALGORITHM = os.getenv("ALGORITHM", "HS256")
+# shared secret for the /metrics and /internal endpoints, which are not
+# served without one
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+
+def decode_access_token(token: str) -> dict[str, Any] | None:
+    """Verify the token locally. Returns None when no secret key is configured."""
+    if not SECRET_KEY:
+        return None
+    payload: dict[str, Any] = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    return payload
+
+
+def require_metrics_token(
+    x_metrics_token: Annotated[str | None, Header()] = None
+) -> None:
+    """Hide the metrics and internal endpoints from callers without the token."""
+    if (
+        not METRICS_TOKEN
+        or x_metrics_token is None
+        or not hmac.compare_digest(x_metrics_token, METRICS_TOKEN)
+    ):
+        raise HTTPException(status_code=404, detail="Not Found")
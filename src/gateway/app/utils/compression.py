@@ -0,0 +1,347 @@
+import importlib.util
+import os
+import zlib
+from typing import Any, Callable, Protocol
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.utils.logger import logger
+
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+# responses smaller than this (bytes) are sent uncompressed, the saving would
+# not make up for the CPU time and the encoding overhead
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+# compression levels, low enough to keep per-request CPU time small
+GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
+
+# content types worth compressing, event streams are left alone so every
+# event is delivered as soon as it is sent
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript")
+EXCLUDED_TYPES = ("text/event-stream",)
+# request headers whose entity tags may carry an encoding suffix
+CONDITIONAL_HEADERS = ("if-none-match", "if-match")
+
+
+class Encoder(Protocol):
+    def compress(self, data: bytes) -> bytes: ...
+
+    def finish(self) -> bytes: ...
+
+
+class GzipEncoder:
+    def __init__(self) -> None:
+        # wbits=31 writes the gzip header and trailer
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush()
+
+
+class BrotliEncoder:
+    def __init__(self) -> None:
+        brotli = importlib.import_module("brotli")
+        self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        result: bytes = self.compressor.process(data)
+        return result
+
+    def finish(self) -> bytes:
+        result: bytes = self.compressor.finish()
+        return result
+
+
+class ZstdEncoder:
+    def __init__(self) -> None:
+        zstandard = importlib.import_module("zstandard")
+        self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        result: bytes = self.compressor.compress(data)
+        return result
+
+    def finish(self) -> bytes:
+        result: bytes = self.compressor.flush()
+        return result
+
+
+def available_encoders() -> dict[str, Callable[[], Encoder]]:
+    """Encoders by content coding, in order of preference.
+
+    Brotli and zstd need the optional `brotli` and `zstandard` packages.
+    """
+    encoders: dict[str, Callable[[], Encoder]] = {}
+    if importlib.util.find_spec("zstandard") is not None:
+        encoders["zstd"] = ZstdEncoder
+    if importlib.util.find_spec("brotli") is not None:
+        encoders["br"] = BrotliEncoder
+    encoders["gzip"] = GzipEncoder
+    return encoders
+
+
+ENCODERS = available_encoders()
+
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    """The preferred encoding the client accepts, None to send the body as is."""
+    accepted: dict[str, float] = {}
+    for item in accept_encoding.lower().split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+
+    best, best_quality = None, 0.0
+    for coding in ENCODERS:
+        quality = accepted.get(coding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    """The entity tag of an encoded body, "abc" becomes "abc-gzip".
+
+    Each encoding is a different representation, so it gets its own strong
+    validator instead of sharing the one of the identity body.
+    """
+    if not etag.endswith('"'):
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def strip_etag_encodings(header: str) -> tuple[str, dict[str, str]]:
+    """Remove the suffixes added by `encoded_etag` from a conditional header.
+
+    Returns the header as the upstream service created its tags, and the
+    tags the client sent by the upstream tag they were made from.
+    """
+    tags = []
+    client_tags: dict[str, str] = {}
+    for tag in header.split(","):
+        tag = tag.strip()
+        for coding in ("zstd", "br", "gzip"):
+            suffix = f'-{coding}"'
+            if tag.endswith(suffix):
+                upstream_tag = tag[: -len(suffix)] + '"'
+                client_tags[upstream_tag.removeprefix("W/")] = tag
+                tag = upstream_tag
+                break
+        tags.append(tag)
+    return ", ".join(tags), client_tags
+
+
+def is_compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES) and not content_type.startswith(
+        EXCLUDED_TYPES
+    )
+
+
+class CompressionStats:
+    def __init__(self) -> None:
+        # per encoding
+        self.responses: dict[str, int] = {}
+        self.bytes_in: dict[str, int] = {}
+        self.bytes_out: dict[str, int] = {}
+        # bodies already compressed by the upstream service
+        self.passed_through = 0
+        # compressible bodies sent as is
+        self.too_small = 0
+        self.not_accepted = 0
+
+    def record(self, encoding: str, bytes_in: int, bytes_out: int) -> None:
+        self.bytes_in[encoding] = self.bytes_in.get(encoding, 0) + bytes_in
+        self.bytes_out[encoding] = self.bytes_out.get(encoding, 0) + bytes_out
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "enabled": COMPRESSION_ENABLED,
+            "min_size": COMPRESSION_MIN_SIZE,
+            "encodings": list(ENCODERS),
+            "responses": self.responses,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "passed_through": self.passed_through,
+            "too_small": self.too_small,
+            "not_accepted": self.not_accepted,
+        }
+
+
+compression_stats = CompressionStats()
+
+
+class CompressionMiddleware:
+    """Compresses response bodies with the best encoding the client accepts.
+
+    A plain ASGI middleware, so streamed bodies are compressed chunk by chunk
+    instead of being collected first. Bodies that already have a
+    Content-Encoding, such as task-service responses the gateway streams
+    through, are sent as they are.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = COMPRESSION_MIN_SIZE,
+        stats: CompressionStats = compression_stats,
+    ) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.stats = stats
+        if COMPRESSION_ENABLED:
+            logger.info(f"Response compression enabled: {', '.join(ENCODERS)}")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # the services only know the tags of their identity bodies
+        client_tags: dict[str, str] = {}
+        request_headers = MutableHeaders(scope=scope)
+        for name in CONDITIONAL_HEADERS:
+            if name in request_headers:
+                request_headers[name], tags = strip_etag_encodings(
+                    request_headers[name]
+                )
+                client_tags.update(tags)
+
+        if scope["method"] == "HEAD" or not COMPRESSION_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(request_headers.get("accept-encoding", ""))
+        responder = CompressionResponder(
+            send, encoding, self.minimum_size, self.stats, client_tags
+        )
+        await self.app(scope, receive, responder.send)
+
+
+class CompressionResponder:
+    """Compresses a single response.
+
+    The start message is held back until enough of the body is known to
+    decide whether it is worth compressing. A 304 answers with the tag the
+    client sent, so it still matches the encoded body the client has.
+    """
+
+    def __init__(
+        self,
+        send: Send,
+        encoding: str | None,
+        minimum_size: int,
+        stats: CompressionStats,
+        client_tags: dict[str, str] | None = None,
+    ) -> None:
+        self.send_message = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.stats = stats
+        self.client_tags = client_tags or {}
+        self.start_message: Message | None = None
+        self.encoder: Encoder | None = None
+        self.passthrough = False
+        self.buffer: list[bytes] = []
+        self.buffered = 0
+
+    async def send(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            await self.start(message)
+        elif message["type"] != "http.response.body" or self.passthrough:
+            await self.send_message(message)
+        else:
+            await self.body(message)
+
+    async def start(self, message: Message) -> None:
+        headers = MutableHeaders(scope=message)
+        status = message["status"]
+        etag = headers.get("etag")
+        if status == 304 and etag is not None:
+            client_tag = self.client_tags.get(etag.removeprefix("W/"))
+            if client_tag is not None:
+                headers["etag"] = client_tag
+
+        if (
+            status < 200
+            or status in (204, 304)
+            or not is_compressible(headers.get("content-type", ""))
+        ):
+            self.passthrough = True
+        elif "content-encoding" in headers:
+            self.passthrough = True
+            self.stats.passed_through += 1
+        else:
+            vary = headers.get("vary")
+            if not vary:
+                headers["vary"] = "Accept-Encoding"
+            elif "accept-encoding" not in vary.lower():
+                headers["vary"] = f"{vary}, Accept-Encoding"
+
+            content_length = headers.get("content-length")
+            if self.encoding is None:
+                self.passthrough = True
+                self.stats.not_accepted += 1
+            elif content_length is not None and int(content_length) < self.minimum_size:
+                self.passthrough = True
+                self.stats.too_small += 1
+
+        if self.passthrough:
+            await self.send_message(message)
+        else:
+            self.start_message = message
+
+    async def body(self, message: Message) -> None:
+        # only reached when an encoding was negotiated
+        assert self.encoding is not None
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.encoder is None:
+            self.buffer.append(body)
+            self.buffered += len(body)
+            if more_body and self.buffered < self.minimum_size:
+                return
+            body = b"".join(self.buffer)
+            self.buffer = []
+            assert self.start_message is not None
+            if self.buffered < self.minimum_size:
+                self.passthrough = True
+                self.stats.too_small += 1
+                await self.send_message(self.start_message)
+                await self.send_message({"type": "http.response.body", "body": body})
+                return
+
+            headers = MutableHeaders(scope=self.start_message)
+            headers["content-encoding"] = self.encoding
+            del headers["content-length"]
+            if "etag" in headers:
+                headers["etag"] = encoded_etag(headers["etag"], self.encoding)
+            self.encoder = ENCODERS[self.encoding]()
+            self.stats.responses[self.encoding] = (
+                self.stats.responses.get(self.encoding, 0) + 1
+            )
+            await self.send_message(self.start_message)
+
+        data = self.encoder.compress(body)
+        if not more_body:
+            data += self.encoder.finish()
+        self.stats.record(self.encoding, len(body), len(data))
+        if data or not more_body:
+            await self.send_message(
+                {"type": "http.response.body", "body": data, "more_body": more_body}
+            )
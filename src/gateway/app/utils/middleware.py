@@ -1,21 +1,66 @@
+import os
+import random
 import time
 from typing import Any
 
-from fastapi import Request
+from starlette.datastructures import URL, QueryParams
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 from app.utils.logger import logger
 
+# share of requests that are logged, 1 logs every request
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1"))
+# requests slower than this (milliseconds) or failing with a 5xx are always logged
+LOG_SLOW_REQUEST_MS = float(os.getenv("LOG_SLOW_REQUEST_MS", "1000"))
 
-async def middleware_logger(request: Request, call_next: Any) -> Any:
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
 
-    api_info = {
-        "url": str(request.url),
-        "method": request.method,
-        "query": dict(request.query_params),
-        "process_time": process_time
+class TimingMiddleware:
+    """Logs the method, route and duration of HTTP requests.
+
+    A plain ASGI middleware: the response is passed through as is, and the
+    log fields are only built for the requests that are logged. Next to the
+    request URL, "route" is the matched path template (e.g.
+    "/tasks/{path:path}"), so log lines of the same endpoint can be grouped.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter_ns()
+        status_code = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed_ns = time.perf_counter_ns() - start
+            if (
+                status_code >= 500
+                or elapsed_ns >= LOG_SLOW_REQUEST_MS * 1_000_000
+                or random.random() < LOG_SAMPLE_RATE
+            ):
+                log_request(scope, status_code, elapsed_ns)
+
+
+def log_request(scope: Scope, status_code: int, elapsed_ns: int) -> None:
+    # the router sets the matched route on the scope
+    route = scope.get("route")
+    api_info: dict[str, Any] = {
+        "url": str(URL(scope=scope)),
+        "method": scope["method"],
+        "query": dict(QueryParams(scope["query_string"])),
+        "process_time": elapsed_ns / 1e9,
+        "route": getattr(route, "path", None) or scope["path"],
+        "status_code": status_code,
     }
     logger.info(api_info, extra=api_info)
-    return response
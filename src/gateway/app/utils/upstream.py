@@ -0,0 +1,172 @@
+import importlib.util
+import os
+from typing import Any, AsyncIterator
+
+from httpx import AsyncClient, Limits, Response, Timeout
+
+from app.utils.logger import logger
+
+# connection pool settings shared by every upstream client
+MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+
+# timeouts (in seconds)
+CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "30"))
+WRITE_TIMEOUT = float(os.getenv("UPSTREAM_WRITE_TIMEOUT", "30"))
+POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "5"))
+
+# HTTP/2 needs the optional `h2` package
+HTTP2_ENABLED = os.getenv("UPSTREAM_HTTP2", "false").lower() == "true"
+
+
+class Upstream:
+    """A long-lived, pooled HTTP client for a single upstream service."""
+
+    def __init__(
+        self,
+        name: str,
+        base_url: str,
+        max_connections: int = MAX_CONNECTIONS,
+        read_timeout: float | None = READ_TIMEOUT,
+    ) -> None:
+        self.name = name
+        self.base_url = base_url
+        self.max_connections = max_connections
+        # None waits for as long as the upstream takes, e.g. for event streams
+        self.read_timeout = read_timeout
+        self.client: AsyncClient | None = None
+        self.open_streams: set[Response] = set()
+
+        # pool utilization metrics
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests_total = 0
+        self.errors_total = 0
+
+    async def start(self) -> None:
+        http2 = HTTP2_ENABLED
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("h2 is not installed, falling back to HTTP/1.1")
+            http2 = False
+
+        self.client = AsyncClient(
+            base_url=self.base_url,
+            http2=http2,
+            limits=Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+            timeout=Timeout(
+                connect=CONNECT_TIMEOUT,
+                read=self.read_timeout,
+                write=WRITE_TIMEOUT,
+                pool=POOL_TIMEOUT,
+            ),
+        )
+        logger.info(f"Upstream client '{self.name}' started for {self.base_url}")
+
+    async def close(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+            logger.info(f"Upstream client '{self.name}' closed")
+
+    def _get_client(self) -> AsyncClient:
+        if self.client is None:
+            raise RuntimeError(f"Upstream client '{self.name}' is not started")
+        return self.client
+
+    def acquire(self) -> None:
+        self.in_flight += 1
+        self.requests_total += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def release(self) -> None:
+        self.in_flight -= 1
+
+    async def request(self, method: str, url: str, **kwargs: Any) -> Response:
+        client = self._get_client()
+        self.acquire()
+        try:
+            return await client.request(method, url, **kwargs)
+        except Exception:
+            self.errors_total += 1
+            raise
+        finally:
+            self.release()
+
+    async def stream(self, method: str, url: str, **kwargs: Any) -> Response:
+        """Send a request without reading the response body.
+
+        The response must be released with `close_stream` once it is consumed.
+        """
+        client = self._get_client()
+        request = client.build_request(method, url, **kwargs)
+        self.acquire()
+        try:
+            response = await client.send(request, stream=True)
+        except Exception:
+            self.errors_total += 1
+            self.release()
+            raise
+        self.open_streams.add(response)
+        return response
+
+    async def iter_stream(self, response: Response) -> AsyncIterator[bytes]:
+        # raw bytes, so a compressed upstream body is passed through untouched
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+        finally:
+            await self.close_stream(response)
+
+    async def close_stream(self, response: Response) -> None:
+        if response not in self.open_streams:
+            return
+        self.open_streams.discard(response)
+        await response.aclose()
+        self.release()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "base_url": self.base_url,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "requests_total": self.requests_total,
+            "errors_total": self.errors_total,
+            "max_connections": self.max_connections,
+            "utilization": self.in_flight / self.max_connections,
+        }
+
+
+upstreams: dict[str, Upstream] = {}
+
+
+def register_upstream(name: str, base_url: str, **kwargs: Any) -> Upstream:
+    upstream = Upstream(name, base_url, **kwargs)
+    upstreams[name] = upstream
+    return upstream
+
+
+def get_upstream(name: str) -> Upstream:
+    return upstreams[name]
+
+
+async def start_upstreams() -> None:
+    for upstream in upstreams.values():
+        await upstream.start()
+
+
+async def close_upstreams() -> None:
+    for upstream in upstreams.values():
+        try:
+            await upstream.close()
+        except Exception as e:
+            logger.error(f"Failed to close upstream client '{upstream.name}': {e}")
+
+
+def upstream_stats() -> dict[str, Any]:
+    return {name: upstream.stats() for name, upstream in upstreams.items()}
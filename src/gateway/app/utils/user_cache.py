@@ -0,0 +1,310 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+from app.utils.logger import logger
+
+# also how long a disabled user may keep using an already cached token
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "10000"))
+# "memory" keeps a cache per worker process, "sqlite" shares one between the
+# workers of a host through USER_CACHE_PATH (best on a tmpfs like /dev/shm)
+USER_CACHE_BACKEND = os.getenv("USER_CACHE_BACKEND", "memory")
+USER_CACHE_PATH = os.getenv("USER_CACHE_PATH", "/dev/shm/gateway-user-cache.sqlite3")
+# expired and surplus entries of the shared cache are removed every N writes
+USER_CACHE_PRUNE_EVERY = int(os.getenv("USER_CACHE_PRUNE_EVERY", "100"))
+# how long to wait for another worker's write (seconds)
+USER_CACHE_LOCK_TIMEOUT = float(os.getenv("USER_CACHE_LOCK_TIMEOUT", "0.5"))
+
+T = TypeVar("T")
+
+
+class UserInfoCache:
+    """Bounded LRU cache of token -> user info with a per-entry TTL."""
+
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        # token -> (expires_at, username, user_info)
+        self.entries: OrderedDict[str, tuple[float, str, dict[str, Any]]] = (
+            OrderedDict()
+        )
+        # username -> tokens cached for that user, used for invalidation
+        self.tokens_by_user: dict[str, set[str]] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def get(self, token: str) -> dict[str, Any] | None:
+        entry = self.entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, _, user_info = entry
+        if expires_at <= time.monotonic():
+            self._remove(token)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(token)
+        self.hits += 1
+        return user_info
+
+    async def set(
+        self,
+        token: str,
+        username: str,
+        user_info: dict[str, Any],
+        token_exp: float | None = None,
+    ) -> None:
+        ttl = self.ttl
+        if token_exp is not None:
+            # never keep an entry around longer than the token is valid
+            ttl = min(ttl, token_exp - time.time())
+        if ttl <= 0:
+            return
+
+        self._remove(token)
+        self.entries[token] = (time.monotonic() + ttl, username, user_info)
+        self.tokens_by_user.setdefault(username, set()).add(token)
+        while len(self.entries) > self.max_size:
+            self._remove(next(iter(self.entries)))
+
+    async def invalidate_user(self, username: str) -> int:
+        tokens = self.tokens_by_user.pop(username, set())
+        for token in tokens:
+            self.entries.pop(token, None)
+        return len(tokens)
+
+    def _remove(self, token: str) -> None:
+        entry = self.entries.pop(token, None)
+        if entry is None:
+            return
+        tokens = self.tokens_by_user.get(entry[1])
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self.tokens_by_user[entry[1]]
+
+    async def stats(self) -> dict[str, Any]:
+        return {
+            "backend": "memory",
+            "pid": os.getpid(),
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class SharedUserInfoCache:
+    """Token -> user info cache in an SQLite file shared by the local workers.
+
+    Each worker opens its own connection on startup. Entries cached by one
+    worker are hits for the others, and an invalidation reaches all of them.
+    The connection is only used by a
+    dedicated thread, so waiting for the file lock of another worker never
+    blocks the event loop.
+    Tokens are stored as their SHA-256 digest. When the cache is full the
+    entries closest to expiring are evicted. A failing cache is logged and
+    treated as a miss.
+    """
+
+    def __init__(self, path: str, ttl: float, max_size: int) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.db: sqlite3.Connection | None = None
+        self.executor: ThreadPoolExecutor | None = None
+        self.writes = 0
+
+        # per worker, hits of other workers are not included
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    async def start(self) -> None:
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="user-cache"
+        )
+        self.db = await self._run(self._connect)
+        logger.info(f"Shared user cache opened at {self.path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(
+            self.path,
+            timeout=USER_CACHE_LOCK_TIMEOUT,
+            isolation_level=None,  # autocommit, every statement is its own write
+            check_same_thread=False,
+        )
+        # readers never wait for a writer, losing the file on a crash is fine
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=OFF")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS user_cache ("
+            "token TEXT PRIMARY KEY, username TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, user_info TEXT NOT NULL)"
+        )
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS ix_user_cache_username "
+            "ON user_cache (username)"
+        )
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS ix_user_cache_expires_at "
+            "ON user_cache (expires_at)"
+        )
+        return db
+
+    async def close(self) -> None:
+        executor, self.executor = self.executor, None
+        db, self.db = self.db, None
+        if executor is not None:
+            if db is not None:
+                await asyncio.get_running_loop().run_in_executor(executor, db.close)
+            executor.shutdown()
+
+    async def _run(self, function: Callable[..., T], *args: Any) -> T:
+        if self.executor is None:
+            raise sqlite3.ProgrammingError("the shared user cache is not started")
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args
+        )
+
+    def _execute(self, sql: str, params: tuple[Any, ...] = ()) -> sqlite3.Cursor:
+        if self.db is None:
+            raise sqlite3.ProgrammingError("the shared user cache is not started")
+        return self.db.execute(sql, params)
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    async def get(self, token: str) -> dict[str, Any] | None:
+        try:
+            row = await self._run(self._fetch, self._key(token), time.time())
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning(f"Shared user cache read failed: {e}")
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        user_info: dict[str, Any] = json.loads(row[0])
+        return user_info
+
+    def _fetch(self, key: str, now: float) -> tuple[str] | None:
+        row: tuple[str] | None = self._execute(
+            "SELECT user_info FROM user_cache WHERE token = ? AND expires_at > ?",
+            (key, now),
+        ).fetchone()
+        return row
+
+    async def set(
+        self,
+        token: str,
+        username: str,
+        user_info: dict[str, Any],
+        token_exp: float | None = None,
+    ) -> None:
+        # wall clock time, monotonic clocks are not comparable between processes
+        expires_at = time.time() + self.ttl
+        if token_exp is not None:
+            expires_at = min(expires_at, token_exp)
+        if expires_at <= time.time():
+            return
+
+        self.writes += 1
+        prune = self.writes % USER_CACHE_PRUNE_EVERY == 0
+        try:
+            await self._run(
+                self._store,
+                self._key(token),
+                username,
+                expires_at,
+                json.dumps(user_info),
+                prune,
+            )
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning(f"Shared user cache write failed: {e}")
+
+    def _store(
+        self, key: str, username: str, expires_at: float, user_info: str, prune: bool
+    ) -> None:
+        self._execute(
+            "INSERT OR REPLACE INTO user_cache VALUES (?, ?, ?, ?)",
+            (key, username, expires_at, user_info),
+        )
+        if prune:
+            self._prune()
+
+    def _prune(self) -> None:
+        self._execute("DELETE FROM user_cache WHERE expires_at <= ?", (time.time(),))
+        self._execute(
+            "DELETE FROM user_cache WHERE token IN (SELECT token FROM user_cache "
+            "ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_size,),
+        )
+
+    async def invalidate_user(self, username: str) -> int:
+        try:
+            return await self._run(self._delete_user, username)
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning(f"Shared user cache invalidation failed: {e}")
+            return 0
+
+    def _delete_user(self, username: str) -> int:
+        return self._execute(
+            "DELETE FROM user_cache WHERE username = ?", (username,)
+        ).rowcount
+
+    def _size(self) -> int:
+        size: int = self._execute("SELECT count(*) FROM user_cache").fetchone()[0]
+        return size
+
+    async def stats(self) -> dict[str, Any]:
+        try:
+            size: int | None = await self._run(self._size)
+        except sqlite3.Error:
+            size = None
+        return {
+            "backend": "sqlite",
+            "pid": os.getpid(),
+            "path": self.path,
+            "size": size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+        }
+
+
+def create_user_cache() -> UserInfoCache | SharedUserInfoCache:
+    if USER_CACHE_BACKEND == "sqlite":
+        return SharedUserInfoCache(USER_CACHE_PATH, USER_CACHE_TTL, USER_CACHE_MAX_SIZE)
+    return UserInfoCache(USER_CACHE_TTL, USER_CACHE_MAX_SIZE)
+
+
+def remove_shared_cache(path: str = USER_CACHE_PATH) -> None:
+    # entries invalidated while the gateway was down must not be served
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+user_cache = create_user_cache()
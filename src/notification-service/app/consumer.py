@@ -1,44 +1,125 @@
-import json
 import os
 import sys
 import time
+from functools import partial
 from typing import Any
 
 import pika
 import pika.exceptions
-from pika.adapters.blocking_connection import BlockingChannel
 
+from app.utils.codec import CONTENT_TYPE_JSON, decode_events, encode_events
 from app.utils.email import send_email
-
-
-def send_notification(
-    method: Any, channel: BlockingChannel, email: None | str, message: str
-) -> None:
-    if email:
-        success = send_email(email, message)
-        if not success:
-            print("error")
-            channel.basic_nack(delivery_tag=method.delivery_tag)
-        else:
-            channel.basic_ack(delivery_tag=method.delivery_tag)
-    else:
-        print(message)
-
-
-def callback(ch: Any, method: Any, properties: Any, body: Any) -> None:
-    message = json.loads(body)
-
-    operation = message["operation"]
-    task = message["task"]
-    email = message.get("email")
+from app.utils.retry import (
+    DEAD_LETTER_QUEUE,
+    MAX_RETRIES,
+    NOTIFICATION_QUEUE,
+    ORIGIN_QUEUE_HEADER,
+    RETRY_COUNT_HEADER,
+    RETRY_DELAYS,
+    get_retry_count,
+    next_route,
+    retry_queue_arguments,
+    retry_queue_name,
+)
+from app.utils.shards import (
+    NOTIFICATION_EXCHANGE,
+    SHARD_QUEUE_ARGUMENTS,
+    get_consumer_shards,
+    shard_queue_name,
+)
+
+
+def get_notification_message(event: dict[str, Any]) -> str | None:
+    operation = event["operation"]
+    task = event["task"]
     if operation == "create":
-        send_notification(method, ch, email, "Task created: {}".format(task))
+        return "Task created: {}".format(task)
     elif operation == "update":
-        send_notification(method, ch, email, "Task updated: {}".format(task))
+        return "Task updated: {}".format(task)
     elif operation == "delete":
-        send_notification(method, ch, email, "Task with ID: {} deleted".format(task))
+        return "Task with ID: {} deleted".format(task)
     elif operation == "complete":
-        send_notification(method, ch, email, "Task mark as completed: {}".format(task))
+        return "Task mark as completed: {}".format(task)
+    return None
+
+
+def publish_retry(
+    ch: Any, queue: str, body: bytes, content_type: str | None, retries: int
+) -> None:
+    # a delay queue sends the message back to `queue` once it expires
+    route = next_route(queue, retries)
+    ch.basic_publish(
+        exchange="",
+        routing_key=route,
+        body=body,
+        properties=pika.BasicProperties(
+            content_type=content_type,
+            headers={RETRY_COUNT_HEADER: retries, ORIGIN_QUEUE_HEADER: queue},
+            delivery_mode=pika.DeliveryMode.Persistent,
+        ),
+    )
+    print(f"notification failed {retries} times, sent to {route}")
+
+
+def callback(
+    ch: Any, method: Any, properties: Any, body: Any, queue: str = NOTIFICATION_QUEUE
+) -> None:
+    retries = get_retry_count(properties.headers)
+    try:
+        events = decode_events(body, properties.content_type)
+    except Exception as e:
+        # retrying would not help, keep the message for inspection
+        print(e)
+        publish_retry(ch, queue, body, properties.content_type, MAX_RETRIES + 1)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return
+
+    failed = []
+    for event in events:
+        notification = get_notification_message(event)
+        if notification is None:
+            continue
+        email = event.get("email")
+        if email:
+            if not send_email(email, notification):
+                failed.append(event)
+        else:
+            print(notification)
+
+    if failed:
+        print("error")
+        # only the failed events are retried, after a backoff
+        publish_retry(ch, queue, encode_events(failed), CONTENT_TYPE_JSON, retries + 1)
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+
+
+def declare_queues(channel: Any, shards: list[int]) -> list[str]:
+    channel.exchange_declare(
+        exchange=NOTIFICATION_EXCHANGE, exchange_type="direct", durable=True
+    )
+    queues = []
+    for shard in shards:
+        queue = shard_queue_name(shard)
+        channel.queue_declare(
+            queue=queue, durable=True, arguments=SHARD_QUEUE_ARGUMENTS
+        )
+        channel.queue_bind(
+            queue=queue, exchange=NOTIFICATION_EXCHANGE, routing_key=str(shard)
+        )
+        queues.append(queue)
+    if 0 in shards:
+        # messages published before the queue was sharded
+        channel.queue_declare(queue=NOTIFICATION_QUEUE, durable=True)
+        queues.append(NOTIFICATION_QUEUE)
+    for queue in queues:
+        for delay in RETRY_DELAYS:
+            channel.queue_declare(
+                queue=retry_queue_name(queue, delay),
+                durable=True,
+                arguments=retry_queue_arguments(queue, delay),
+            )
+    channel.queue_declare(queue=DEAD_LETTER_QUEUE, durable=True)
+    return queues
 
 
 def get_rabbitmq_connection() -> Any:
@@ -72,9 +153,11 @@ def main() -> None:
         print("Could not establish connection with RabbitMQ. Exiting....")
         return
     channel = connection.channel()
-    channel.queue_declare(queue="notification_queue", durable=True)
-
-    channel.basic_consume(queue="notification_queue", on_message_callback=callback)
+    # this consumer handles its shards one message at a time, in a single process
+    for queue in declare_queues(channel, get_consumer_shards()):
+        channel.basic_consume(
+            queue=queue, on_message_callback=partial(callback, queue=queue)
+        )
 
     print("Waiting for messages. To exit press CTRL+C")
 
@@ -0,0 +1,100 @@
+"""Inspect and replay the dead letter queue of the notification service.
+
+    python -m app.dlq count
+    python -m app.dlq replay [--limit N]
+
+Replayed messages go back to the queue they failed in with their retry count reset.
+"""
+
+import argparse
+import os
+from typing import Any
+
+import pika
+
+from app.utils.retry import (
+    DEAD_LETTER_QUEUE,
+    NOTIFICATION_QUEUE,
+    ORIGIN_QUEUE_HEADER,
+    RETRY_COUNT_HEADER,
+)
+
+
+def get_channel() -> Any:
+    connection = pika.BlockingConnection(
+        pika.ConnectionParameters(
+            host=os.getenv("RABBITMQ_HOST", "rabbitmq"),
+            port=int(os.getenv("RABBITMQ_PORT", "5672")),
+            credentials=pika.PlainCredentials(
+                os.getenv("RABBITMQ_USER", ""),
+                os.getenv("RABBITMQ_PASSWORD", ""),
+            ),
+        )
+    )
+    channel = connection.channel()
+    channel.queue_declare(queue=DEAD_LETTER_QUEUE, durable=True)
+    return channel
+
+
+def count(channel: Any) -> int:
+    result = channel.queue_declare(queue=DEAD_LETTER_QUEUE, durable=True, passive=True)
+    message_count: int = result.method.message_count
+    return message_count
+
+
+def replay(channel: Any, limit: int | None = None) -> int:
+    # every message is confirmed by the broker before it leaves the dead letter queue
+    channel.confirm_delivery()
+    replayed = 0
+    while limit is None or replayed < limit:
+        method, properties, body = channel.basic_get(queue=DEAD_LETTER_QUEUE)
+        if method is None:
+            break
+        headers = dict(properties.headers or {})
+        headers.pop(RETRY_COUNT_HEADER, None)
+        # messages dead-lettered before the queue was sharded have no origin,
+        # the consumer of shard 0 still reads the old queue
+        queue = headers.get(ORIGIN_QUEUE_HEADER, NOTIFICATION_QUEUE)
+        if isinstance(queue, bytes):
+            queue = queue.decode()
+        channel.basic_publish(
+            exchange="",
+            routing_key=queue,
+            mandatory=True,
+            body=body,
+            properties=pika.BasicProperties(
+                content_type=properties.content_type,
+                headers=headers,
+                delivery_mode=pika.DeliveryMode.Persistent,
+            ),
+        )
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        replayed += 1
+    return replayed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m app.dlq",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("count", help="number of dead-lettered messages")
+    replay_parser = subparsers.add_parser("replay", help="move messages back")
+    replay_parser.add_argument("--limit", type=int, help="replay at most N messages")
+    args = parser.parse_args()
+
+    channel = get_channel()
+    try:
+        if args.command == "count":
+            print(f"{count(channel)} messages in '{DEAD_LETTER_QUEUE}'")
+        else:
+            replayed = replay(channel, args.limit)
+            print(f"Replayed {replayed} messages")
+    finally:
+        channel.connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,405 @@
 import asyncio
-import json
+import multiprocessing
 import os
+import signal
+import time
+from functools import partial
+from typing import Any
 
 import aio_pika
 
+from app.utils.codec import CONTENT_TYPE_JSON, decode_events, encode_events
+from app.utils.digest import Delivery, DigestAggregator, format_digest
 from app.utils.logger import logger
 from app.utils.new_email import send_email_async
+from app.utils.retry import (
+    DEAD_LETTER_QUEUE,
+    MAX_RETRIES,
+    NOTIFICATION_QUEUE,
+    ORIGIN_QUEUE_HEADER,
+    RETRY_COUNT_HEADER,
+    RETRY_DELAYS,
+    get_retry_count,
+    next_route,
+    retry_queue_arguments,
+    retry_queue_name,
+)
+from app.utils.shards import (
+    NOTIFICATION_EXCHANGE,
+    SHARD_QUEUE_ARGUMENTS,
+    get_consumer_shards,
+    shard_queue_name,
+)
+from app.utils.smtp_pool import smtp_pool
 
+# unacknowledged messages the broker may deliver to this consumer, a message
+# stays unacknowledged until the digests of its events went out, so this also
+# bounds the messages held by pending digests
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", "20"))
+# messages processed at the same time
+CONSUMER_CONCURRENCY = int(os.getenv("CONSUMER_CONCURRENCY", "10"))
+# seconds to wait for messages in progress on shutdown
+CONSUMER_DRAIN_TIMEOUT = float(os.getenv("CONSUMER_DRAIN_TIMEOUT", "30"))
+# seconds between metrics log lines
+CONSUMER_METRICS_INTERVAL = float(os.getenv("CONSUMER_METRICS_INTERVAL", "60"))
+# seconds before a shard process that exited is started again
+CONSUMER_RESTART_DELAY = float(os.getenv("CONSUMER_RESTART_DELAY", "5"))
 
-async def process_message(message: aio_pika.IncomingMessage) -> None:
-    async with message.process():
+
+class RetryPublisher:
+    """Moves failed notifications to a delay queue, or to the dead letter queue."""
+
+    def __init__(self) -> None:
+        self.channel: aio_pika.abc.AbstractChannel | None = None
+        self.queue = NOTIFICATION_QUEUE
+        self.retried_total = 0
+        self.dead_lettered_total = 0
+
+    async def declare(self, channel: aio_pika.abc.AbstractChannel, queue: str) -> None:
+        """Declare the delay queues that lead back to `queue`."""
+        for delay in RETRY_DELAYS:
+            await channel.declare_queue(
+                retry_queue_name(queue, delay),
+                durable=True,
+                arguments=retry_queue_arguments(queue, delay),
+            )
+        await channel.declare_queue(DEAD_LETTER_QUEUE, durable=True)
+        self.channel = channel
+        self.queue = queue
+
+    async def publish(
+        self, body: bytes, content_type: str | None, retries: int
+    ) -> None:
+        if self.channel is None or self.channel.is_closed:
+            # the message of the notification is requeued instead
+            raise RuntimeError("no channel to retry a failed notification on")
+        route = next_route(self.queue, retries)
+        await self.channel.default_exchange.publish(
+            aio_pika.Message(
+                body,
+                content_type=content_type,
+                headers={RETRY_COUNT_HEADER: retries, ORIGIN_QUEUE_HEADER: self.queue},
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            ),
+            routing_key=route,
+        )
+        if route == DEAD_LETTER_QUEUE:
+            self.dead_lettered_total += 1
+            logger.warning(f"Notification failed {retries} times, dead-lettered")
+        else:
+            self.retried_total += 1
+            logger.info(f"Notification failed, retry {retries} via '{route}'")
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "retried_total": self.retried_total,
+            "dead_lettered_total": self.dead_lettered_total,
+        }
+
+
+def get_recipient(event: dict[str, Any]) -> str | None:
+    email = event.get("email")
+    return email if isinstance(email, str) and "@" in email else None
+
+
+async def send_notification(email: str, event: dict[str, Any]) -> bool:
+    operation = event["operation"]
+    task = event["task"]
+    if operation == "create":
+        return await send_email_async("Task created: {}".format(task), email)
+    elif operation == "update":
+        return await send_email_async("Task updated: {}".format(task), email)
+    elif operation == "delete":
+        return await send_email_async("Task with ID: {} deleted".format(task), email)
+    elif operation == "complete":
+        return await send_email_async("Task mark as completed: {}".format(task), email)
+    else:
+        logger.warn(f"Unsupported operation: {operation}")
+        return True
+
+
+async def send_digest(
+    email: str, events: list[dict[str, Any]], retries: list[int]
+) -> None:
+    if len(events) == 1:
+        sent = await send_notification(email, events[0])
+    else:
+        sent = await send_email_async(format_digest(events), email)
+    if not sent:
+        # each event keeps its own retry count
+        by_count: dict[int, list[dict[str, Any]]] = {}
+        for event, count in zip(events, retries):
+            by_count.setdefault(count, []).append(event)
+        for count, failed in by_count.items():
+            await retry_publisher.publish(
+                encode_events(failed), CONTENT_TYPE_JSON, count + 1
+            )
+
+
+retry_publisher = RetryPublisher()
+digests = DigestAggregator(send_digest, max_messages=CONSUMER_PREFETCH)
+
+
+class NotificationConsumer:
+    """Consumes the task events of one shard with at most `concurrency` messages
+    in progress.
+
+    The broker delivers at most `prefetch` unacknowledged messages and the next
+    message is only taken once a worker is free, so a backlog stays queued in
+    RabbitMQ instead of piling up in memory. Messages are handed to the digests
+    in the order they were delivered and acknowledged once their digests were
+    sent or queued for a retry, the digests are sent with the same concurrency.
+    """
+
+    def __init__(self, shard: int, prefetch: int, concurrency: int) -> None:
+        self.shard = shard
+        self.queue_name = shard_queue_name(shard)
+        self.prefetch = prefetch
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks: set[asyncio.Task[None]] = set()
+        self.connection: aio_pika.abc.AbstractRobustConnection | None = None
+        self.channel: aio_pika.abc.AbstractChannel | None = None
+
+        # metrics
+        self.queued: int | None = None  # messages waiting in the broker
+        self.acked_total = 0
+        self.requeued_total = 0
+        self.failed_total = 0
+
+    async def process_message(
+        self, message: aio_pika.abc.AbstractIncomingMessage
+    ) -> None:
+        retries = get_retry_count(message.headers)
+        delivery = Delivery(partial(self.settle, message))
         try:
             logger.info("Processing message...")
-            # Simulate message processing
-            message_body = json.loads(message.body)
-            operation = message_body["operation"]
-            task = message_body["task"]
-            email = message_body.get("email")
-            if operation == "create":
-                await send_email_async("Task created: {}".format(task), email)
-            elif operation == "update":
-                await send_email_async("Task updated: {}".format(task), email)
-            elif operation == "delete":
-                await send_email_async("Task with ID: {} deleted".format(task), email)
-            elif operation == "complete":
-                await send_email_async("Task mark as completed: {}".format(task), email)
-            else:
-                logger.warn(f"Unsupported operation: {operation}")
+            events = decode_events(message.body, message.content_type)
+            invalid = [event for event in events if get_recipient(event) is None]
+            if invalid:
+                # there is no one to send them to, keep them for inspection
+                logger.error(f"{len(invalid)} events without a recipient")
+                await retry_publisher.publish(
+                    encode_events(invalid), CONTENT_TYPE_JSON, MAX_RETRIES + 1
+                )
+            # the message is acked once the digests of its events went out,
+            # failed sends are retried through the delay queues
+            for event in events:
+                email = get_recipient(event)
+                if email is not None:
+                    digests.add(email, event, retries, delivery)
         except Exception as e:
+            # retrying would not help, keep the message for inspection
+            self.failed_total += 1
             logger.error(f"Error processing message: {e}")
-            raise  # This will trigger a retry if you are using a retry mechanism
+            try:
+                await retry_publisher.publish(
+                    message.body, message.content_type, MAX_RETRIES + 1
+                )
+            except Exception as e:
+                logger.error(f"Failed to dead-letter a message: {e}")
+                delivery.ok = False
+        await delivery.seal()
+
+    async def settle(
+        self, message: aio_pika.abc.AbstractIncomingMessage, ok: bool
+    ) -> None:
+        try:
+            if ok:
+                await message.ack()
+                self.acked_total += 1
+            else:
+                # delivered again, to this consumer or another one
+                await message.nack(requeue=True)
+                self.requeued_total += 1
+        except Exception as e:
+            # the broker delivers it again once the channel is gone
+            logger.warning(f"Failed to settle a message: {e}")
 
+    def worker_done(self, task: "asyncio.Task[None]") -> None:
+        self.tasks.discard(task)
+        self.semaphore.release()
 
-async def consume() -> None:
-    connection = None
-    while True:
+    async def dispatch(self, message: aio_pika.abc.AbstractIncomingMessage) -> None:
         try:
-            if connection is None or connection.is_closed:
-                # Only create a new connection if none exists or the previous one is closed
-                connection = await aio_pika.connect_robust(
-                    host="rabbitmq",
-                    login=os.getenv("RABBITMQ_USER", ""),
-                    password=os.getenv("RABBITMQ_PASSWORD", ""),
-                )
-                logger.info("Connected to RabbitMQ.")
+            # wait for a free worker before taking the next message
+            await self.semaphore.acquire()
+        except asyncio.CancelledError:
+            await message.nack(requeue=True)
+            raise
+        task = asyncio.create_task(self.process_message(message))
+        self.tasks.add(task)
+        task.add_done_callback(self.worker_done)
 
-            channel = await connection.channel()
-            queue = await channel.declare_queue("notification_queue", durable=True)
-            logger.info("Waiting for messages in queue 'notification_queue'.")
+    async def consume(self) -> None:
+        while True:
+            try:
+                if self.connection is None or self.connection.is_closed:
+                    # Only create a new connection if there is none or it was closed
+                    self.connection = await aio_pika.connect_robust(
+                        host="rabbitmq",
+                        login=os.getenv("RABBITMQ_USER", ""),
+                        password=os.getenv("RABBITMQ_PASSWORD", ""),
+                    )
+                    logger.info("Connected to RabbitMQ.")
 
-            async with queue.iterator() as queue_iter:
-                async for message in queue_iter:
-                    # Process each message in a background task
-                    asyncio.create_task(process_message(message))
+                self.channel = await self.connection.channel()
+                await self.channel.set_qos(prefetch_count=self.prefetch)
+                queues = await self.declare_queues(self.channel)
+                tasks = [
+                    asyncio.create_task(self.consume_queue(queue)) for queue in queues
+                ]
+                try:
+                    await asyncio.gather(*tasks)
+                finally:
+                    for task in tasks:
+                        task.cancel()
 
-        except (aio_pika.exceptions.AMQPConnectionError, ConnectionResetError) as e:
-            logger.error(f"Connection lost: {e}. Reconnecting...")
-            connection = None  # Ensure we create a new connection on the next iteration
-            await asyncio.sleep(5)  # Delay before retrying the connection
+            except (aio_pika.exceptions.AMQPConnectionError, ConnectionResetError) as e:
+                logger.error(f"Connection lost: {e}. Reconnecting...")
+                self.connection = None  # create a new connection on the next iteration
+                await asyncio.sleep(5)  # Delay before retrying the connection
 
-        except Exception as e:
-            logger.error(f"Unexpected error: {e}")
-            break
+            except Exception as e:
+                logger.error(f"Unexpected error: {e}")
+                break
 
+    async def declare_queues(
+        self, channel: aio_pika.abc.AbstractChannel
+    ) -> list[aio_pika.abc.AbstractQueue]:
+        exchange = await channel.declare_exchange(
+            NOTIFICATION_EXCHANGE, aio_pika.ExchangeType.DIRECT, durable=True
+        )
+        queue = await channel.declare_queue(
+            self.queue_name, durable=True, arguments=SHARD_QUEUE_ARGUMENTS
+        )
+        await queue.bind(exchange, routing_key=str(self.shard))
+        await retry_publisher.declare(channel, self.queue_name)
+        queues = [queue]
+        if self.shard == 0:
+            # messages published before the queue was sharded
+            queues.append(await channel.declare_queue(NOTIFICATION_QUEUE, durable=True))
+        return queues
 
-if __name__ == "__main__":
+    async def consume_queue(self, queue: aio_pika.abc.AbstractQueue) -> None:
+        logger.info(f"Waiting for messages in queue '{queue.name}'.")
+        async with queue.iterator() as queue_iter:
+            async for message in queue_iter:
+                await self.dispatch(message)
+
+    async def drain(self, timeout: float) -> None:
+        """Wait for the messages in progress."""
+        if self.tasks:
+            logger.info(f"Waiting for {len(self.tasks)} messages in progress...")
+            _, pending = await asyncio.wait(self.tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+
+    async def close(self) -> None:
+        if self.connection is not None:
+            await self.connection.close()
+
+    async def report_metrics(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if self.channel is not None and not self.channel.is_closed:
+                    queue = await self.channel.declare_queue(
+                        self.queue_name, passive=True
+                    )
+                    self.queued = queue.declaration_result.message_count
+            except Exception as e:
+                logger.warning(f"Failed to read the queue length: {e}")
+            logger.info(f"Consumer metrics: {self.stats()}")
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "shard": self.shard,
+            "in_flight": len(self.tasks),
+            "concurrency": self.concurrency,
+            "prefetch": self.prefetch,
+            "queued": self.queued,
+            "acked_total": self.acked_total,
+            "requeued_total": self.requeued_total,
+            "failed_total": self.failed_total,
+            "digests": digests.stats(),
+            "retries": retry_publisher.stats(),
+            "smtp": smtp_pool.stats(),
+        }
+
+
+async def run(shard: int) -> None:
+    consumer = NotificationConsumer(shard, CONSUMER_PREFETCH, CONSUMER_CONCURRENCY)
+    digests.start(consumer.semaphore)
+    consume_task = asyncio.create_task(consumer.consume())
+    metrics_task = asyncio.create_task(
+        consumer.report_metrics(CONSUMER_METRICS_INTERVAL)
+    )
+
+    # stop taking new messages on SIGTERM/SIGINT, then finish the current ones
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, consume_task.cancel)
+
+    try:
+        await consume_task
+    except asyncio.CancelledError:
+        logger.info(f"Shutting down consumer of shard {shard}...")
+    metrics_task.cancel()
+    await consumer.drain(CONSUMER_DRAIN_TIMEOUT)
+    # pending digests are sent while failed ones can still be queued for a retry
+    await digests.close()
+    await consumer.close()
+    await smtp_pool.close()
+
+
+def run_shard(shard: int) -> None:
+    asyncio.run(run(shard))
 
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(consume())
+
+def main() -> None:
+    shards = get_consumer_shards()
+    if len(shards) == 1:
+        run_shard(shards[0])
+        return
+
+    # one process per shard, each with its own event loop and SMTP sessions
+    context = multiprocessing.get_context("spawn")
+
+    def start(shard: int) -> multiprocessing.process.BaseProcess:
+        process = context.Process(
+            target=run_shard, args=(shard,), name=f"notification-shard-{shard}"
+        )
+        process.start()
+        return process
+
+    processes = {shard: start(shard) for shard in shards}
+    stopping = False
+
+    def stop(signum: int, frame: Any) -> None:
+        nonlocal stopping
+        stopping = True
+        # every shard drains its messages in progress on SIGTERM
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopping:
+        time.sleep(CONSUMER_RESTART_DELAY)
+        for shard, process in list(processes.items()):
+            if not stopping and not process.is_alive():
+                logger.error(
+                    f"Consumer of shard {shard} exited with {process.exitcode}, "
+                    "restarting"
+                )
+                processes[shard] = start(shard)
+
+    for process in processes.values():
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
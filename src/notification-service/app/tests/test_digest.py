@@ -0,0 +1,129 @@
+import asyncio
+from typing import Any
+
+from app.utils.digest import Delivery, DigestAggregator
+
+
+class Sender:
+    def __init__(self, fail_for: tuple[str, ...] = ()) -> None:
+        self.fail_for = fail_for
+        self.sent: list[tuple[str, int]] = []
+        self.retries: list[list[int]] = []
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, email: str, events: list[Any], retries: list[int]) -> None:
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.01)
+            if email in self.fail_for:
+                raise RuntimeError("no channel to retry a failed notification on")
+            self.sent.append((email, len(events)))
+            self.retries.append(retries)
+        finally:
+            self.running -= 1
+
+
+def delivery(settled: list[tuple[str, bool]], name: str) -> Delivery:
+    async def settle(ok: bool) -> None:
+        settled.append((name, ok))
+
+    return Delivery(settle)
+
+
+def event(n: int) -> dict[str, Any]:
+    return {"operation": "create", "task": f"Task {n}"}
+
+
+def test_messages_are_settled_once_their_digests_went_out() -> None:
+    sender = Sender(fail_for=("b@example.com",))
+    settled: list[tuple[str, bool]] = []
+
+    async def run() -> None:
+        digests = DigestAggregator(sender)
+        first, second = delivery(settled, "first"), delivery(settled, "second")
+        digests.add("a@example.com", event(1), delivery=first)
+        digests.add("a@example.com", event(2), delivery=first)
+        await first.seal()
+        digests.add("a@example.com", event(3), delivery=second)
+        digests.add("b@example.com", event(4), delivery=second)
+        await second.seal()
+        # nothing is acknowledged while the events wait in their digests
+        assert settled == []
+        assert digests.stats()["held_messages"] == 2
+
+        await digests.close()
+
+    asyncio.run(run())
+    assert sender.sent == [("a@example.com", 3)]
+    # the second message is requeued, one of its digests could not go out
+    assert sorted(settled) == [("first", True), ("second", False)]
+
+
+def test_message_without_events_is_settled_right_away() -> None:
+    settled: list[tuple[str, bool]] = []
+
+    async def run() -> None:
+        await delivery(settled, "empty").seal()
+
+    asyncio.run(run())
+    assert settled == [("empty", True)]
+
+
+def test_oldest_digests_go_out_when_too_much_is_pending() -> None:
+    sender = Sender()
+    settled: list[tuple[str, bool]] = []
+
+    async def run() -> None:
+        digests = DigestAggregator(sender, max_messages=2, max_recipients=2)
+        for n in range(3):
+            # one message per recipient
+            message = delivery(settled, str(n))
+            digests.add(f"{n}@example.com", event(n), delivery=message)
+            await message.seal()
+        # a message is always left for the broker to deliver
+        assert list(digests.pending) == ["2@example.com"]
+        assert digests.stats()["early_flushes_total"] == 2
+        await asyncio.wait(digests.sending)
+        assert settled == [("0", True), ("1", True)]
+
+        digests.max_messages = None
+        for n in range(3, 6):
+            digests.add(f"{n}@example.com", event(n))
+        # at most two recipients wait for their digest
+        assert list(digests.pending) == ["4@example.com", "5@example.com"]
+        await digests.close()
+
+    asyncio.run(run())
+    assert len(sender.sent) == 6
+
+
+def test_sends_share_the_consumer_semaphore() -> None:
+    sender = Sender()
+
+    async def run() -> None:
+        digests = DigestAggregator(sender)
+        digests.start(asyncio.Semaphore(2))
+        for n in range(6):
+            digests.add(f"{n}@example.com", event(n))
+        await digests.close()
+
+    asyncio.run(run())
+    assert len(sender.sent) == 6
+    assert sender.max_running == 2
+
+
+def test_retry_counts_are_kept_per_event() -> None:
+    sender = Sender()
+
+    async def run() -> None:
+        digests = DigestAggregator(sender)
+        digests.add("a@example.com", event(1), retries=3)
+        digests.add("a@example.com", event(2))
+        await digests.close()
+
+    asyncio.run(run())
+    assert sender.sent == [("a@example.com", 2)]
+    # the fresh event is not charged the retries of the other one
+    assert sender.retries == [[3, 0]]
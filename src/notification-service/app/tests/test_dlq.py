@@ -0,0 +1,106 @@
+import sys
+from types import SimpleNamespace
+from typing import Any
+
+import pika
+import pika.exceptions
+import pytest
+
+from app import dlq
+from app.utils.retry import (
+    DEAD_LETTER_QUEUE,
+    NOTIFICATION_QUEUE,
+    ORIGIN_QUEUE_HEADER,
+    RETRY_COUNT_HEADER,
+)
+
+
+class FakeChannel:
+    """Records the calls made on a confirm channel, in order."""
+
+    def __init__(self, messages: int, unroutable: set[int] | None = None) -> None:
+        self.queue = [
+            (
+                SimpleNamespace(delivery_tag=n),
+                pika.BasicProperties(
+                    content_type="application/json",
+                    headers={
+                        RETRY_COUNT_HEADER: 5,
+                        ORIGIN_QUEUE_HEADER: b"notification_queue.1",
+                    },
+                ),
+                f"[{n}]".encode(),
+            )
+            for n in range(1, messages + 1)
+        ]
+        self.unroutable = unroutable or set()
+        self.calls: list[tuple[str, Any]] = []
+        self.connection = SimpleNamespace(close=lambda: None)
+
+    def confirm_delivery(self) -> None:
+        self.calls.append(("confirm_delivery", None))
+
+    def basic_get(self, queue: str) -> Any:
+        assert queue == DEAD_LETTER_QUEUE
+        self.calls.append(("get", None))
+        if not self.queue:
+            return None, None, None
+        return self.queue.pop(0)
+
+    def basic_publish(self, **kwargs: Any) -> None:
+        # with confirms on, this returns once the broker confirmed the message
+        tag = int(kwargs["body"][1:-1])
+        if tag in self.unroutable:
+            raise pika.exceptions.UnroutableError([])
+        self.calls.append(("publish", (tag, kwargs["routing_key"], kwargs)))
+
+    def basic_ack(self, delivery_tag: int) -> None:
+        self.calls.append(("ack", delivery_tag))
+
+
+def test_replay_acks_each_message_after_its_confirm() -> None:
+    channel = FakeChannel(messages=3)
+    assert dlq.replay(channel, limit=2) == 2
+
+    assert channel.calls[0] == ("confirm_delivery", None)
+    steps = [
+        (name, arg if name != "publish" else arg[0]) for name, arg in channel.calls
+    ]
+    assert steps[1:] == [
+        ("get", None),
+        ("publish", 1),
+        ("ack", 1),
+        ("get", None),
+        ("publish", 2),
+        ("ack", 2),
+    ]
+    # the third message is left in the dead letter queue
+    assert len(channel.queue) == 1
+
+    _, routing_key, kwargs = channel.calls[2][1]
+    assert routing_key == "notification_queue.1"
+    assert RETRY_COUNT_HEADER not in kwargs["properties"].headers
+    assert kwargs["mandatory"] is True
+
+
+def test_replay_keeps_unconfirmed_messages() -> None:
+    channel = FakeChannel(messages=3, unroutable={2})
+    with pytest.raises(pika.exceptions.UnroutableError):
+        dlq.replay(channel)
+    assert [arg for name, arg in channel.calls if name == "ack"] == [1]
+
+
+def test_replay_command_limit(
+    monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    channel = FakeChannel(messages=5)
+    channel.queue[0][1].headers.pop(ORIGIN_QUEUE_HEADER)
+    monkeypatch.setattr(dlq, "get_channel", lambda: channel)
+    monkeypatch.setattr(sys, "argv", ["dlq", "replay", "--limit", "3"])
+    dlq.main()
+
+    assert "Replayed 3 messages" in capsys.readouterr().out
+    assert [arg for name, arg in channel.calls if name == "ack"] == [1, 2, 3]
+    publishes = [arg for name, arg in channel.calls if name == "publish"]
+    # dead-lettered before the queues were sharded
+    assert publishes[0][1] == NOTIFICATION_QUEUE
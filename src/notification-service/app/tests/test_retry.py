@@ -0,0 +1,68 @@
+import asyncio
+from typing import Any
+
+import pytest
+
+from app import new_consumer
+from app.utils import retry
+from app.utils.codec import decode_events
+from app.utils.retry import (
+    DEAD_LETTER_QUEUE,
+    RETRY_COUNT_HEADER,
+    get_retry_count,
+    next_route,
+    retry_queue_name,
+)
+
+QUEUE = "notification_queue.0"
+
+
+@pytest.fixture(autouse=True)
+def delays(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(retry, "RETRY_DELAYS", [10.0, 60.0])
+    monkeypatch.setattr(retry, "MAX_RETRIES", 2)
+
+
+def test_failed_messages_wait_in_the_delay_queues() -> None:
+    assert next_route(QUEUE, 1) == retry_queue_name(QUEUE, 10)
+    assert next_route(QUEUE, 2) == "notification_queue.0.retry.60000ms"
+
+
+def test_messages_go_to_the_dead_letter_queue_after_max_retries() -> None:
+    # the last allowed retry still goes through a delay queue
+    assert next_route(QUEUE, retry.MAX_RETRIES) != DEAD_LETTER_QUEUE
+    assert next_route(QUEUE, retry.MAX_RETRIES + 1) == DEAD_LETTER_QUEUE
+    assert next_route(QUEUE, 100) == DEAD_LETTER_QUEUE
+
+
+def test_last_delay_is_reused(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(retry, "MAX_RETRIES", 4)
+    assert next_route(QUEUE, 3) == retry_queue_name(QUEUE, 60)
+    assert next_route(QUEUE, 4) == retry_queue_name(QUEUE, 60)
+    assert next_route(QUEUE, 5) == DEAD_LETTER_QUEUE
+
+
+def test_get_retry_count() -> None:
+    assert get_retry_count(None) == 0
+    assert get_retry_count({}) == 0
+    assert get_retry_count({RETRY_COUNT_HEADER: 3}) == 3
+    assert get_retry_count({RETRY_COUNT_HEADER: "3"}) == 0
+
+
+def test_failed_digests_keep_the_retry_count_of_each_event(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    published: list[tuple[list[Any], int]] = []
+
+    async def send_email_async(body: str, email: str) -> bool:
+        return False
+
+    async def publish(body: bytes, content_type: str | None, retries: int) -> None:
+        published.append((decode_events(body, content_type), retries))
+
+    monkeypatch.setattr(new_consumer, "send_email_async", send_email_async)
+    monkeypatch.setattr(new_consumer.retry_publisher, "publish", publish)
+    events = [{"operation": "create", "task": f"Task {n}"} for n in range(3)]
+
+    asyncio.run(new_consumer.send_digest("a@example.com", events, [2, 0, 2]))
+    assert published == [([events[0], events[2]], 3), ([events[1]], 1)]
@@ -0,0 +1,124 @@
+import asyncio
+from email.message import EmailMessage
+
+import pytest
+
+from app.utils import smtp_pool
+from app.utils.smtp_pool import SMTPPool
+from app.utils.stub_smtp import StubSMTPServer
+
+
+@pytest.fixture(autouse=True)
+def plain_smtp(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(smtp_pool, "SMTP_START_TLS", False)
+    monkeypatch.setattr(smtp_pool, "SMTP_TIMEOUT", 5)
+
+
+def message(n: int) -> EmailMessage:
+    email = EmailMessage()
+    email["From"] = "tasks@example.com"
+    email["To"] = f"user{n}@example.com"
+    email["Subject"] = f"Message {n}"
+    email.set_content("Hello")
+    return email
+
+
+def send(server: StubSMTPServer, count: int, pause: float = 0) -> SMTPPool:
+    """Sends `count` messages one after the other through a new pool."""
+
+    async def run() -> SMTPPool:
+        await server.start()
+        pool = SMTPPool("127.0.0.1", server.port, "user", "secret", size=1)
+        try:
+            for n in range(count):
+                if n:
+                    await asyncio.sleep(pause)
+                await pool.send_message(message(n))
+        finally:
+            await pool.close()
+            await server.stop()
+        return pool
+
+    return asyncio.run(run())
+
+
+def test_sessions_are_reused() -> None:
+    server = StubSMTPServer(port=0)
+    pool = send(server, 3)
+
+    assert len(server.messages) == 3
+    assert server.sessions == 1
+    assert server.commands.count("AUTH") == 1
+    assert "NOOP" not in server.commands
+    assert pool.stats()["connects_total"] == 1
+    assert pool.stats()["reuses_total"] == 2
+
+
+def test_idle_sessions_are_replaced(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(smtp_pool, "SMTP_IDLE_TIMEOUT", 0.01)
+    server = StubSMTPServer(port=0)
+    pool = send(server, 2, pause=0.05)
+
+    assert len(server.messages) == 2
+    assert server.sessions == 2
+    # the old session is closed properly
+    assert server.commands.count("QUIT") == 2
+    assert pool.stats()["connects_total"] == 2
+    assert pool.stats()["reuses_total"] == 0
+
+
+def test_sessions_are_checked_before_reuse(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(smtp_pool, "SMTP_HEALTH_CHECK_AFTER", 0.01)
+    server = StubSMTPServer(port=0)
+    pool = send(server, 2, pause=0.05)
+
+    assert server.commands.count("NOOP") == 1
+    assert server.sessions == 1
+    assert pool.stats()["reuses_total"] == 1
+
+
+def test_failed_health_check_opens_a_new_session(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(smtp_pool, "SMTP_HEALTH_CHECK_AFTER", 0.01)
+    server = StubSMTPServer(port=0)
+    server.drop_on.append("NOOP")
+    pool = send(server, 2, pause=0.05)
+
+    assert len(server.messages) == 2
+    assert server.sessions == 2
+    assert pool.stats()["connects_total"] == 2
+    assert pool.stats()["reuses_total"] == 0
+
+
+def test_dropped_session_is_retried_once() -> None:
+    server = StubSMTPServer(port=0)
+    # the session goes away in the middle of the message
+    server.drop_on.append("MAIL")
+    pool = send(server, 1)
+
+    assert len(server.messages) == 1
+    assert server.sessions == 2
+    assert pool.stats()["connects_total"] == 2
+
+
+def test_reconnects_only_once() -> None:
+    server = StubSMTPServer(port=0)
+    # the new session goes away as well
+    server.drop_on.extend(["MAIL", "MAIL"])
+
+    async def run() -> SMTPPool:
+        await server.start()
+        pool = SMTPPool("127.0.0.1", server.port, "user", "secret", size=1)
+        try:
+            with pytest.raises(smtp_pool.aiosmtplib.SMTPServerDisconnected):
+                await pool.send_message(message(0))
+        finally:
+            await pool.close()
+            await server.stop()
+        return pool
+
+    pool = asyncio.run(run())
+    assert server.messages == []
+    assert server.sessions == 2
+    assert pool.stats()["idle"] == 0
@@ -0,0 +1,21 @@
+import json
+from typing import Any
+
+import msgpack
+
+# set by the task-service publisher, anything else is decoded as JSON
+CONTENT_TYPE_MSGPACK = "application/msgpack"
+CONTENT_TYPE_JSON = "application/json"
+
+
+def decode_events(body: bytes, content_type: str | None) -> list[dict[str, Any]]:
+    """Decode a task event message, which holds a single event or a list of them."""
+    if content_type == CONTENT_TYPE_MSGPACK:
+        message = msgpack.unpackb(body)
+    else:
+        message = json.loads(body)
+    return message if isinstance(message, list) else [message]
+
+
+def encode_events(events: list[dict[str, Any]]) -> bytes:
+    return json.dumps(events).encode()
@@ -0,0 +1,256 @@
+import asyncio
+import contextlib
+import os
+import time
+from functools import partial
+from typing import Any, Awaitable, Callable
+
+from app.utils.logger import logger
+
+# a recipient's digest is sent once no new event arrived for this long (seconds),
+# 0 sends every event right away
+DIGEST_WINDOW = float(os.getenv("DIGEST_WINDOW", "30"))
+# ... but never later than this after its first event (seconds)
+DIGEST_MAX_DELAY = float(os.getenv("DIGEST_MAX_DELAY", "120"))
+# ... or as soon as it holds this many events
+DIGEST_MAX_EVENTS = int(os.getenv("DIGEST_MAX_EVENTS", "1000"))
+# the oldest pending digests are sent early once more than this many events ...
+DIGEST_MAX_PENDING_EVENTS = int(os.getenv("DIGEST_MAX_PENDING_EVENTS", "10000"))
+# ... or recipients are waiting
+DIGEST_MAX_PENDING_RECIPIENTS = int(os.getenv("DIGEST_MAX_PENDING_RECIPIENTS", "1000"))
+# how often pending digests are checked (seconds)
+DIGEST_TICK = float(os.getenv("DIGEST_TICK", "1"))
+
+# digest sections in the order they are listed in the email
+SECTIONS = {
+    "create": "Created",
+    "update": "Updated",
+    "complete": "Completed",
+    "delete": "Deleted",
+}
+
+# called with the recipient, the events and how often each of them already failed
+Sender = Callable[[str, list[dict[str, Any]], list[int]], Awaitable[None]]
+
+
+def format_digest(events: list[dict[str, Any]]) -> str:
+    """Group the events of a digest by operation."""
+    sections: dict[str, list[str]] = {operation: [] for operation in SECTIONS}
+    for event in events:
+        task = event["task"]
+        if event["operation"] == "delete":
+            task = f"Task with ID: {task}"
+        sections.setdefault(event["operation"], []).append(str(task))
+
+    lines = [f"{len(events)} task updates:"]
+    for operation, tasks in sections.items():
+        if tasks:
+            lines += ["", f"{SECTIONS.get(operation, operation)} ({len(tasks)}):"]
+            lines += [f"- {task}" for task in tasks]
+    return "\n".join(lines)
+
+
+class Delivery:
+    """A broker message whose events wait in digests.
+
+    It is settled once every digest holding one of its events was sent or
+    queued for a retry: acked if all of them were, nacked otherwise, so an
+    event is never acknowledged before it is taken care of.
+    """
+
+    def __init__(self, settle: Callable[[bool], Awaitable[None]]) -> None:
+        self.settle = settle
+        # digests holding its events that are not done yet
+        self.digests = 0
+        self.ok = True
+        self.sealed = False
+        self.settled = False
+
+    async def seal(self) -> None:
+        """Called once all the events of the message were added."""
+        self.sealed = True
+        await self.maybe_settle()
+
+    async def release(self, ok: bool) -> None:
+        self.digests -= 1
+        self.ok = self.ok and ok
+        await self.maybe_settle()
+
+    async def maybe_settle(self) -> None:
+        if self.sealed and self.digests == 0 and not self.settled:
+            self.settled = True
+            await self.settle(self.ok)
+
+
+class Digest:
+    def __init__(self) -> None:
+        self.events: list[dict[str, Any]] = []
+        # the failed attempts of each event, a retried event does not count
+        # against the fresh ones it is sent with
+        self.retries: list[int] = []
+        # the messages its events came from
+        self.deliveries: list[Delivery] = []
+        self.first_at = time.monotonic()
+        self.last_at = self.first_at
+
+    def is_due(self, now: float) -> bool:
+        return (
+            now - self.last_at >= DIGEST_WINDOW
+            or now - self.first_at >= DIGEST_MAX_DELAY
+            or len(self.events) >= DIGEST_MAX_EVENTS
+        )
+
+
+class DigestAggregator:
+    """Collects events per recipient and sends them as one email.
+
+    The messages of the events are only acknowledged once their digests were
+    sent or queued for a retry, so nothing is lost if the process is killed.
+    As the broker stops delivering once `max_messages` are unacknowledged, and
+    to keep memory bounded, the oldest digests are sent early when too much is
+    pending. A recipient's digests are sent one after the other, in the order
+    their events arrived.
+    """
+
+    def __init__(
+        self,
+        send: Sender,
+        max_messages: int | None = None,
+        max_events: int = DIGEST_MAX_PENDING_EVENTS,
+        max_recipients: int = DIGEST_MAX_PENDING_RECIPIENTS,
+    ) -> None:
+        self.send = send
+        self.max_messages = max_messages
+        self.max_events = max_events
+        self.max_recipients = max_recipients
+        self.pending: dict[str, Digest] = {}
+        self.pending_events = 0
+        # the messages held by pending digests, with how many digests hold them
+        self.held: dict[Delivery, int] = {}
+        self.sending: set[asyncio.Task[None]] = set()
+        # the latest send of each recipient, the next one waits for it
+        self.last_send: dict[str, asyncio.Task[None]] = {}
+        # shared with the consumer, so sends count against its concurrency
+        self.semaphore: asyncio.Semaphore | None = None
+        self.task: asyncio.Task[None] | None = None
+
+        self.events_total = 0
+        self.digests_total = 0
+        self.early_flushes_total = 0
+
+    def add(
+        self,
+        email: str,
+        event: dict[str, Any],
+        retries: int = 0,
+        delivery: Delivery | None = None,
+    ) -> None:
+        if DIGEST_WINDOW <= 0:
+            digest = Digest()
+            digest.events.append(event)
+            digest.retries.append(retries)
+            if delivery is not None:
+                digest.deliveries.append(delivery)
+                delivery.digests += 1
+            self.start_send(email, digest)
+            return
+
+        digest = self.pending.setdefault(email, Digest())
+        digest.events.append(event)
+        digest.retries.append(retries)
+        digest.last_at = time.monotonic()
+        if delivery is not None and delivery not in digest.deliveries:
+            digest.deliveries.append(delivery)
+            delivery.digests += 1
+            self.held[delivery] = self.held.get(delivery, 0) + 1
+        self.events_total += 1
+        self.pending_events += 1
+        if len(digest.events) >= DIGEST_MAX_EVENTS:
+            self.flush(email)
+        self.enforce_limits()
+
+    def over_limits(self) -> bool:
+        return (
+            len(self.pending) > self.max_recipients
+            or self.pending_events > self.max_events
+            or (self.max_messages is not None and len(self.held) >= self.max_messages)
+        )
+
+    def enforce_limits(self) -> None:
+        # the pending digests are in the order of their first event
+        while self.pending and self.over_limits():
+            self.early_flushes_total += 1
+            self.flush(next(iter(self.pending)))
+
+    def flush(self, email: str) -> None:
+        digest = self.pending.pop(email, None)
+        if digest is None:
+            return
+        self.pending_events -= len(digest.events)
+        for delivery in digest.deliveries:
+            self.held[delivery] -= 1
+            if not self.held[delivery]:
+                del self.held[delivery]
+        self.digests_total += 1
+        self.start_send(email, digest)
+
+    def start_send(self, email: str, digest: Digest) -> None:
+        previous = self.last_send.get(email)
+        task = asyncio.create_task(self.send_after(previous, email, digest))
+        self.sending.add(task)
+        self.last_send[email] = task
+        task.add_done_callback(partial(self.send_done, email))
+
+    async def send_after(
+        self, previous: "asyncio.Task[None] | None", email: str, digest: Digest
+    ) -> None:
+        if previous is not None:
+            await asyncio.wait([previous])
+        sent = False
+        try:
+            async with self.semaphore or contextlib.nullcontext():
+                await self.send(email, digest.events, digest.retries)
+            sent = True
+        finally:
+            for delivery in digest.deliveries:
+                await delivery.release(sent)
+
+    def send_done(self, email: str, task: "asyncio.Task[None]") -> None:
+        self.sending.discard(task)
+        if self.last_send.get(email) is task:
+            del self.last_send[email]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Failed to send notification: {task.exception()}")
+
+    def start(self, semaphore: asyncio.Semaphore | None = None) -> None:
+        self.semaphore = semaphore
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(DIGEST_TICK)
+            now = time.monotonic()
+            for email in [e for e, d in self.pending.items() if d.is_due(now)]:
+                self.flush(email)
+
+    async def close(self) -> None:
+        """Send every pending digest and wait for the emails in progress."""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for email in list(self.pending):
+            self.flush(email)
+        if self.sending:
+            await asyncio.wait(self.sending)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "pending_recipients": len(self.pending),
+            "pending_events": self.pending_events,
+            "held_messages": len(self.held),
+            "sending": len(self.sending),
+            "events_total": self.events_total,
+            "digests_total": self.digests_total,
+            "early_flushes_total": self.early_flushes_total,
+        }
@@ -1,11 +1,16 @@
 import os
 import smtplib
 import ssl
+import time
 
-port = 465  # For SSL
-smtp_server = "smtp.gmail.com"
-sender_email = os.getenv("EMAIL_SENDER_MAIL", '')  # Enter your address
-password = os.getenv("EMAIL_SECRET_KEY", '')
+port = int(os.getenv("SMTP_SSL_PORT", "465"))  # For SSL
+smtp_server = os.getenv("SMTP_HOST", "smtp.gmail.com")
+sender_email = os.getenv("EMAIL_SENDER_MAIL", "")  # Enter your address
+password = os.getenv("EMAIL_SECRET_KEY", "")
+# the session is closed after this many idle seconds and checked with a NOOP
+# before reuse after SMTP_HEALTH_CHECK_AFTER
+idle_timeout = float(os.getenv("SMTP_IDLE_TIMEOUT", "60"))
+health_check_after = float(os.getenv("SMTP_HEALTH_CHECK_AFTER", "10"))
 message = """\
 Subject: Task Manager Notification
 This message is sent from task manager.
@@ -13,22 +18,60 @@ This message is sent from task manager.
 {}
 """
 
+# persistent session reused across messages, the legacy consumer is single threaded
+server: smtplib.SMTP_SSL | None = None
+last_used = 0.0
+
+
+def close_server() -> None:
+    global server
+    if server is not None:
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+        server = None
+
+
+def get_server() -> smtplib.SMTP_SSL:
+    global server
+    idle_for = time.monotonic() - last_used
+    if server is not None and idle_for > idle_timeout:
+        close_server()
+    if server is not None and idle_for > health_check_after:
+        try:
+            server.noop()
+        except smtplib.SMTPException:
+            close_server()
+    if server is None:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        server = smtplib.SMTP_SSL(smtp_server, port, context=context)
+        server.login(sender_email, password)
+    return server
+
 
 def send_email(receiver_email: str, message_body: str) -> bool:
+    global last_used
     print(f"sending mail to user: {receiver_email} with message body: {message_body}")
-    context = ssl.create_default_context()
-    context.check_hostname = False
-    context.verify_mode = ssl.CERT_NONE
-    try:
-        with smtplib.SMTP_SSL(smtp_server, port, context=context) as server:
-            server.login(sender_email, password)
-            err = server.sendmail(
+    for attempt in range(2):
+        try:
+            err = get_server().sendmail(
                 sender_email, receiver_email, message.format(message_body)
             )
+            last_used = time.monotonic()
             if err:
                 print(err)
                 return False
-        return True
-    except Exception as e:
-        print(e)
-        return False
+            return True
+        except smtplib.SMTPServerDisconnected as e:
+            # the server dropped the session, retry once on a new one
+            close_server()
+            if attempt:
+                print(e)
+        except Exception as e:
+            print(e)
+            close_server()
+            return False
+    return False
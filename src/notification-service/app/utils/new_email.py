@@ -4,13 +4,12 @@ from email.message import EmailMessage
 import aiosmtplib
 
 from app.utils.logger import logger
+from app.utils.smtp_pool import smtp_pool
 
-smtp_server = "smtp.gmail.com"
 sender_email = os.getenv("EMAIL_SENDER_MAIL", "")  # Enter your address
-password = os.getenv("EMAIL_SECRET_KEY", "")
 
 
-async def send_email_async(body: str, to_email: str) -> None:
+async def send_email_async(body: str, to_email: str) -> bool:
     message = EmailMessage()
     message["From"] = sender_email
     message["To"] = to_email
@@ -18,14 +17,10 @@ async def send_email_async(body: str, to_email: str) -> None:
     message.set_content(body)
 
     try:
-        await aiosmtplib.send(
-            message,
-            hostname=smtp_server,
-            port=587,
-            start_tls=True,
-            username=sender_email,
-            password=password,
-        )
+        # reuses an authenticated session instead of a new handshake per email
+        await smtp_pool.send_message(message)
         logger.info("Email sent")
-    except aiosmtplib.SMTPException as e:
+        return True
+    except (aiosmtplib.SMTPException, OSError) as e:
         logger.error(f"Failed to send email: {e}")
+        return False
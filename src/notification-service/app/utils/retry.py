@@ -0,0 +1,44 @@
+import os
+from typing import Mapping
+
+from aio_pika.abc import Arguments
+
+NOTIFICATION_QUEUE = "notification_queue"
+RETRY_COUNT_HEADER = "x-retry-count"
+# the queue a dead-lettered message failed in, replays go back there
+ORIGIN_QUEUE_HEADER = "x-origin-queue"
+DEAD_LETTER_QUEUE = f"{NOTIFICATION_QUEUE}.dead"
+
+# backoff before each retry (seconds), the last delay is reused for later attempts
+RETRY_DELAYS = [
+    float(delay)
+    for delay in os.getenv("NOTIFICATION_RETRY_DELAYS", "10,60,300,1800").split(",")
+]
+# retries before a message goes to the dead letter queue, it is dead-lettered
+# when it fails for the (MAX_RETRIES + 1)th time
+MAX_RETRIES = int(os.getenv("NOTIFICATION_MAX_RETRIES", str(len(RETRY_DELAYS))))
+
+
+def retry_queue_name(queue: str, delay: float) -> str:
+    return f"{queue}.retry.{int(delay * 1000)}ms"
+
+
+def retry_queue_arguments(queue: str, delay: float) -> Arguments:
+    # messages expire after the delay and are dead-lettered back to their queue
+    return {
+        "x-message-ttl": int(delay * 1000),
+        "x-dead-letter-exchange": "",
+        "x-dead-letter-routing-key": queue,
+    }
+
+
+def get_retry_count(headers: Mapping[str, object] | None) -> int:
+    count = (headers or {}).get(RETRY_COUNT_HEADER, 0)
+    return count if isinstance(count, int) else 0
+
+
+def next_route(queue: str, retries: int) -> str:
+    """Queue for a message of `queue` that has now failed `retries` times."""
+    if retries > MAX_RETRIES:
+        return DEAD_LETTER_QUEUE
+    return retry_queue_name(queue, RETRY_DELAYS[min(retries, len(RETRY_DELAYS)) - 1])
@@ -0,0 +1,26 @@
+import os
+
+from aio_pika.abc import Arguments
+
+from app.utils.retry import NOTIFICATION_QUEUE
+
+# task-service publishes every event to this exchange with the recipient's shard
+# as routing key, so all events of a user end up in the same queue
+NOTIFICATION_EXCHANGE = "notifications"
+# must match NOTIFICATION_SHARDS of task-service
+NOTIFICATION_SHARDS = int(os.getenv("NOTIFICATION_SHARDS", "1"))
+# a shard is consumed by one process at a time, consumers of other instances
+# stand by and take over when it goes away
+SHARD_QUEUE_ARGUMENTS: Arguments = {"x-single-active-consumer": True}
+
+
+def shard_queue_name(shard: int) -> str:
+    return f"{NOTIFICATION_QUEUE}.{shard}"
+
+
+def get_consumer_shards() -> list[int]:
+    """Shards consumed by this instance, e.g. CONSUMER_SHARDS=0,1, all by default."""
+    value = os.getenv("CONSUMER_SHARDS", "")
+    if not value:
+        return list(range(NOTIFICATION_SHARDS))
+    return [int(shard) for shard in value.split(",")]
@@ -0,0 +1,137 @@
+import asyncio
+import os
+import time
+from email.message import EmailMessage
+
+import aiosmtplib
+
+from app.utils.logger import logger
+
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_START_TLS = os.getenv("SMTP_START_TLS", "true").lower() == "true"
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))
+
+# authenticated sessions kept open and shared between messages
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "5"))
+# sessions unused for longer than this are closed instead of reused (seconds)
+SMTP_IDLE_TIMEOUT = float(os.getenv("SMTP_IDLE_TIMEOUT", "60"))
+# sessions unused for longer than this are checked with a NOOP first (seconds)
+SMTP_HEALTH_CHECK_AFTER = float(os.getenv("SMTP_HEALTH_CHECK_AFTER", "10"))
+
+
+class SMTPPool:
+    """A pool of long-lived, authenticated SMTP sessions."""
+
+    def __init__(
+        self,
+        hostname: str,
+        port: int,
+        username: str,
+        password: str,
+        size: int,
+    ) -> None:
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.semaphore = asyncio.Semaphore(size)
+        # idle sessions with the time they were last used, the newest last
+        self.idle: list[tuple[aiosmtplib.SMTP, float]] = []
+
+        self.connects_total = 0
+        self.reuses_total = 0
+
+    async def connect(self) -> aiosmtplib.SMTP:
+        client = aiosmtplib.SMTP(
+            hostname=self.hostname,
+            port=self.port,
+            start_tls=SMTP_START_TLS,
+            timeout=SMTP_TIMEOUT,
+        )
+        await client.connect()
+        if self.username:
+            await client.login(self.username, self.password)
+        self.connects_total += 1
+        logger.info(f"New SMTP session to {self.hostname}:{self.port}")
+        return client
+
+    async def discard(self, client: aiosmtplib.SMTP) -> None:
+        try:
+            if client.is_connected:
+                await client.quit()
+        except Exception:
+            client.close()
+
+    async def acquire(self) -> aiosmtplib.SMTP:
+        while self.idle:
+            client, last_used = self.idle.pop()
+            idle_for = time.monotonic() - last_used
+            if idle_for > SMTP_IDLE_TIMEOUT or not client.is_connected:
+                await self.discard(client)
+                continue
+            if idle_for > SMTP_HEALTH_CHECK_AFTER:
+                try:
+                    await client.noop()
+                except aiosmtplib.SMTPException:
+                    await self.discard(client)
+                    continue
+            self.reuses_total += 1
+            return client
+        return await self.connect()
+
+    def release(self, client: aiosmtplib.SMTP) -> None:
+        self.idle.append((client, time.monotonic()))
+
+    async def send_message(self, message: EmailMessage) -> None:
+        async with self.semaphore:
+            client = await self.acquire()
+            try:
+                await client.send_message(message)
+            except aiosmtplib.SMTPServerDisconnected:
+                # the server dropped the session, retry once on a new one
+                await self.discard(client)
+                client = await self.connect()
+                try:
+                    await client.send_message(message)
+                except Exception:
+                    await self.discard(client)
+                    raise
+            except (
+                aiosmtplib.SMTPResponseException,
+                aiosmtplib.SMTPRecipientsRefused,
+            ):
+                # the server refused this message, the session is still usable
+                try:
+                    await client.rset()
+                    self.release(client)
+                except aiosmtplib.SMTPException:
+                    await self.discard(client)
+                raise
+            except Exception:
+                await self.discard(client)
+                raise
+            self.release(client)
+
+    async def close(self) -> None:
+        idle, self.idle = self.idle, []
+        for client, _ in idle:
+            await self.discard(client)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": self.size,
+            "idle": len(self.idle),
+            "connects_total": self.connects_total,
+            "reuses_total": self.reuses_total,
+        }
+
+
+smtp_pool = SMTPPool(
+    SMTP_HOST,
+    SMTP_PORT,
+    os.getenv("EMAIL_SENDER_MAIL", ""),
+    os.getenv("EMAIL_SECRET_KEY", ""),
+    SMTP_POOL_SIZE,
+)
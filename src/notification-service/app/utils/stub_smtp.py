@@ -0,0 +1,103 @@
+"""A minimal SMTP server that accepts every message, for local runs and tests.
+
+Start it with `python -m app.utils.stub_smtp` and point the service at it with
+SMTP_HOST=localhost SMTP_PORT=1025 SMTP_START_TLS=false.
+"""
+
+import asyncio
+import os
+
+from app.utils.logger import logger
+
+STUB_SMTP_HOST = os.getenv("STUB_SMTP_HOST", "127.0.0.1")
+STUB_SMTP_PORT = int(os.getenv("STUB_SMTP_PORT", "1025"))
+
+
+class StubSMTPServer:
+    def __init__(self, host: str = STUB_SMTP_HOST, port: int = STUB_SMTP_PORT) -> None:
+        self.host = host
+        self.port = port
+        self.server: asyncio.AbstractServer | None = None
+        # (sender, recipients, data) of every message received
+        self.messages: list[tuple[str, list[str], bytes]] = []
+        self.sessions = 0
+        # the verb of every command received
+        self.commands: list[str] = []
+        # verbs answered by dropping the session, each one once, to test
+        # how clients deal with a server that went away
+        self.drop_on: list[str] = []
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"Stub SMTP server listening on {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.sessions += 1
+
+        async def reply(line: str) -> None:
+            writer.write(f"{line}\r\n".encode())
+            await writer.drain()
+
+        sender = ""
+        recipients: list[str] = []
+        await reply("220 stub ESMTP ready")
+        try:
+            while line := await reader.readline():
+                command = line.decode().strip()
+                verb = command.split(" ", 1)[0].upper()
+                self.commands.append(verb)
+                if verb in self.drop_on:
+                    self.drop_on.remove(verb)
+                    break
+                if verb in ("EHLO", "HELO"):
+                    await reply("250-stub\r\n250 AUTH PLAIN LOGIN")
+                elif verb == "AUTH":
+                    parts = command.split()
+                    # prompt for the credentials that were not sent inline
+                    prompts = 2 if parts[1].upper() == "LOGIN" else 1
+                    for _ in range(prompts - (len(parts) > 2)):
+                        await reply("334 ")
+                        await reader.readline()
+                    await reply("235 2.7.0 Authentication successful")
+                elif verb == "MAIL":
+                    sender, recipients = command[10:].strip("<> "), []
+                    await reply("250 OK")
+                elif verb == "RCPT":
+                    recipients.append(command[8:].strip("<> "))
+                    await reply("250 OK")
+                elif verb == "DATA":
+                    await reply("354 End data with <CR><LF>.<CR><LF>")
+                    data = b""
+                    while (chunk := await reader.readline()) not in (b".\r\n", b""):
+                        data += chunk
+                    self.messages.append((sender, recipients, data))
+                    logger.info(f"Stub SMTP received a message for {recipients}")
+                    await reply("250 OK")
+                elif verb in ("NOOP", "RSET"):
+                    await reply("250 OK")
+                elif verb == "QUIT":
+                    await reply("221 Bye")
+                    break
+                else:
+                    await reply("502 Command not implemented")
+        finally:
+            writer.close()
+
+
+async def main() -> None:
+    server = StubSMTPServer()
+    await server.start()
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,22 +1,180 @@
-from sqlalchemy.orm import Session
+from datetime import date
+from typing import Any
 
+from sqlalchemy import and_, delete, insert, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.enums.sort_enum import TaskSort
+from app.enums.status_enum import Status
+from app.models.outbox import OutboxEvent
 from app.models.task import Task
-from app.schemas.task import TaskCreate, TaskUpdatePayload
+from app.schemas.task import TaskCreate, TaskFilter, TaskUpdatePayload
+from app.utils.events import task_event
+from app.utils.task_cache import task_cache
 
+TASK_NOT_FOUND = "task not found"
+VERSION_MISMATCH = "task was modified by another request"
 
-def get_user_tasks(
-    db: Session, user_id: int, skip: int = 0, limit: int = 100
-) -> list[Task]:
-    return (
-        db.query(Task).filter(Task.user_id == user_id).offset(skip).limit(limit).all()
+
+def _add_event(db: AsyncSession, message: Any) -> None:
+    # committed together with the change, the outbox relay publishes it later
+    db.add(OutboxEvent(payload=message))
+
+
+# columns of a task listing, the version is only used for the ETag
+LIST_COLUMNS = (
+    Task.id,
+    Task.title,
+    Task.description,
+    Task.due_date,
+    Task.status,
+    Task.version,
+)
+
+
+def _task_row(task: Task) -> dict[str, Any]:
+    # cached instead of the instance, which is bound to its session
+    return {column.key: getattr(task, column.key) for column in Task.__table__.columns}
+
+
+def _task_filters(filters: TaskFilter) -> list[Any]:
+    conditions: list[Any] = []
+    if filters.status:
+        conditions.append(Task.status.in_(filters.status))
+    if filters.due_after:
+        conditions.append(Task.due_date >= filters.due_after)
+    if filters.due_before:
+        conditions.append(Task.due_date <= filters.due_before)
+    if filters.overdue:
+        conditions.append(Task.due_date < date.today())
+        conditions.append(Task.status != Status.DONE)
+    return conditions
+
+
+def _order_by(sort: TaskSort) -> list[Any]:
+    # tasks without a due date are ordered last (first when descending)
+    if sort == TaskSort.DUE_DATE:
+        return [Task.due_date.is_(None), Task.due_date, Task.id]
+    if sort == TaskSort.DUE_DATE_DESC:
+        return [Task.due_date.is_(None).desc(), Task.due_date.desc(), Task.id.desc()]
+    if sort == TaskSort.ID_DESC:
+        return [Task.id.desc()]
+    return [Task.id]
+
+
+def _keyset_filter(sort: TaskSort, after: dict[str, Any]) -> Any:
+    """Filter for the rows that come after the `after` key in the given order."""
+    if after.get("sort") != sort.value or not isinstance(after.get("id"), int):
+        raise ValueError("cursor does not match the requested sort")
+    last_id = after["id"]
+    id_after = Task.id < last_id if sort.descending else Task.id > last_id
+
+    if not sort.by_due_date:
+        return id_after
+
+    if after.get("due_date") is None:
+        if sort.descending:
+            return or_(
+                and_(Task.due_date.is_(None), id_after), Task.due_date.isnot(None)
+            )
+        return and_(Task.due_date.is_(None), id_after)
+
+    last_due_date = date.fromisoformat(str(after["due_date"]))
+    if sort.descending:
+        return or_(
+            Task.due_date < last_due_date,
+            and_(Task.due_date == last_due_date, id_after),
+        )
+    return or_(
+        Task.due_date > last_due_date,
+        and_(Task.due_date == last_due_date, id_after),
+        Task.due_date.is_(None),
     )
 
 
-def get_task_by_id(db: Session, user_id: int, task_id: int) -> Task | None:
-    return db.query(Task).filter(Task.user_id == user_id, Task.id == task_id).first()
+def _keyset_values(sort: TaskSort, row: dict[str, Any]) -> dict[str, Any]:
+    values: dict[str, Any] = {"sort": sort.value, "id": row["id"]}
+    if sort.by_due_date:
+        due_date = row["due_date"]
+        values["due_date"] = due_date.isoformat() if due_date else None
+    return values
+
+
+async def get_user_tasks(
+    db: AsyncSession,
+    user_id: int,
+    skip: int = 0,
+    limit: int = 100,
+    after: dict[str, Any] | None = None,
+    sort: TaskSort = TaskSort.ID,
+    filters: TaskFilter | None = None,
+) -> tuple[list[dict[str, Any]], dict[str, Any] | None]:
+    """Return a page of the user's tasks and the key to continue after, if any.
+
+    With `after` the page starts right after that key (keyset pagination),
+    otherwise `skip` rows are skipped. Tasks are plain dicts of LIST_COLUMNS.
+    """
+    params = {"skip": skip, "limit": limit, "after": after, "sort": sort.value}
+    if filters is not None:
+        params["filters"] = filters.model_dump()
+        if filters.overdue:
+            params["today"] = date.today()
+    key = await task_cache.key(user_id, "list", params)
+    cached = await task_cache.get(key)
+    if cached is not None:
+        return cached
+
+    result = await _get_user_tasks(db, user_id, skip, limit, after, sort, filters)
+    await task_cache.set(key, result)
+    return result
+
+
+async def _get_user_tasks(
+    db: AsyncSession,
+    user_id: int,
+    skip: int,
+    limit: int,
+    after: dict[str, Any] | None,
+    sort: TaskSort,
+    filters: TaskFilter | None,
+) -> tuple[list[dict[str, Any]], dict[str, Any] | None]:
+    # only the listed columns, as rows instead of ORM instances
+    stmt = select(*LIST_COLUMNS).where(Task.user_id == user_id)
+    if filters is not None:
+        stmt = stmt.where(*_task_filters(filters))
+    stmt = stmt.order_by(*_order_by(sort))
+
+    if after is not None:
+        stmt = stmt.where(_keyset_filter(sort, after))
+    elif skip:
+        stmt = stmt.offset(skip)
+
+    # fetch one extra row to know whether there is a next page
+    result = await db.execute(stmt.limit(limit + 1))
+    tasks = [dict(row) for row in result.mappings()]
+    if len(tasks) <= limit:
+        return tasks, None
+    tasks = tasks[:limit]
+    return tasks, _keyset_values(sort, tasks[-1]) if tasks else None
+
+
+async def get_task_by_id(db: AsyncSession, user_id: int, task_id: int) -> Task | None:
+    key = await task_cache.key(user_id, "task", task_id)
+    row = await task_cache.get(key)
+    if row is not None:
+        return Task(**row)
+
+    task = await db.scalar(
+        select(Task).where(Task.user_id == user_id, Task.id == task_id)
+    )
+    if task is not None:
+        await task_cache.set(key, _task_row(task))
+    return task
 
 
-def create_task(db: Session, task: TaskCreate, user_id: int) -> Task:
+async def create_task(
+    db: AsyncSession, task: TaskCreate, user_id: int, email: str | None = None
+) -> Task:
     db_task = Task(
         title=task.title,
         description=task.description,
@@ -25,47 +183,198 @@ def create_task(db: Session, task: TaskCreate, user_id: int) -> Task:
         user_id=user_id,
     )
     db.add(db_task)
-    db.commit()
-    db.refresh(db_task)
+    if email:
+        await db.flush()  # assigns the id the event refers to
+        _add_event(db, task_event("create", db_task.id, email, db_task.title))
+    await db.commit()
+    await task_cache.invalidate(user_id)
+    await db.refresh(db_task)
     return db_task
 
 
-# Update an existing task
-def update_task(
-    db: Session, user_id: int, task_id: int, task_update_payload: TaskUpdatePayload
-):
-    task = get_task_by_id(db, user_id, task_id)
-    if not task:
-        return "task not found", None
+def _supports_returning(db: AsyncSession) -> bool:
+    dialect = db.get_bind().dialect
+    return dialect.update_returning and dialect.delete_returning
+
+
+async def _update_task_row(
+    db: AsyncSession,
+    user_id: int,
+    task_id: int,
+    values: dict[str, Any],
+    guard: Any = None,
+) -> Task | None:
+    """UPDATE a single task and return its new state, bumping its version.
+
+    Uses UPDATE ... RETURNING when the database supports it, otherwise the row
+    is read back after the UPDATE within the same transaction.
+    """
+    key = and_(Task.user_id == user_id, Task.id == task_id)
+    stmt = (
+        update(Task)
+        .where(key if guard is None else and_(key, guard))
+        .values(**values, version=Task.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    if _supports_returning(db):
+        return (await db.scalars(stmt.returning(Task))).first()
+
+    if not (await db.execute(stmt)).rowcount:
+        return None
+    return await db.scalar(
+        select(Task).where(key).execution_options(populate_existing=True)
+    )
+
 
+# Update an existing task, optionally only if it is still at `expected_version`
+async def update_task(
+    db: AsyncSession,
+    user_id: int,
+    task_id: int,
+    task_update_payload: TaskUpdatePayload,
+    expected_version: int | None = None,
+    email: str | None = None,
+):
+    values: dict[str, Any] = {}
     if task_update_payload.status:
-        task.status = task_update_payload.status  # type: ignore
+        values["status"] = task_update_payload.status
     if task_update_payload.title:
-        task.title = task_update_payload.title  # type: ignore
+        values["title"] = task_update_payload.title
     if task_update_payload.description:
-        task.description = task_update_payload.description  # type: ignore
+        values["description"] = task_update_payload.description
     if task_update_payload.due_date:
-        task.due_date = task_update_payload.due_date  # type: ignore
+        values["due_date"] = task_update_payload.due_date
+
+    guard = Task.version == expected_version if expected_version is not None else None
+    task = await _update_task_row(db, user_id, task_id, values, guard)
+    if task and email:
+        _add_event(db, task_event("update", task.id, email, task.title))
+    await db.commit()
+    if task:
+        await task_cache.invalidate(user_id)
+        return None, task
+
+    # read from the database, the cache may not have seen the conflicting write
+    if expected_version is not None and await db.scalar(
+        select(Task.id).where(Task.user_id == user_id, Task.id == task_id)
+    ):
+        return VERSION_MISMATCH, None
+    return TASK_NOT_FOUND, None
 
-    db.commit()
-    db.refresh(task)
-    return None, task
 
 # mark task as completed
-def mark_task_complete(db: Session, user_id: int, task_id: int):
-    task = get_task_by_id(db, user_id, task_id)
+async def mark_task_complete(
+    db: AsyncSession, user_id: int, task_id: int, email: str | None = None
+):
+    task = await _update_task_row(db, user_id, task_id, {"status": Status.DONE})
+    if task and email:
+        _add_event(db, task_event("complete", task.id, email, task.title))
+    await db.commit()
     if not task:
-        return "task not found", None
-    task.status = "DONE" # type: ignore
-    db.commit()
-    db.refresh(task)
+        return TASK_NOT_FOUND, None
+    await task_cache.invalidate(user_id)
     return None, task
 
+
 # Delete a task
-def delete_task(db: Session, user_id: int, task_id: int) -> bool:
-    task = db.query(Task).filter(Task.user_id == user_id, Task.id == task_id).first()
-    if task:
-        db.delete(task)
-        db.commit()
-        return True
-    return False
+async def delete_task(
+    db: AsyncSession, user_id: int, task_id: int, email: str | None = None
+) -> bool:
+    result = await db.execute(
+        delete(Task)
+        .where(Task.user_id == user_id, Task.id == task_id)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount and email:
+        _add_event(db, task_event("delete", task_id, email))
+    await db.commit()
+    if result.rowcount:
+        await task_cache.invalidate(user_id)
+    return bool(result.rowcount)
+
+
+# Create many tasks with a single INSERT
+async def create_tasks(
+    db: AsyncSession, tasks: list[TaskCreate], user_id: int, email: str | None = None
+) -> list[Task]:
+    values = [
+        {
+            "title": task.title,
+            "description": task.description,
+            "due_date": task.due_date,
+            "status": Status.OPEN,
+            "user_id": user_id,
+        }
+        for task in tasks
+    ]
+    if db.get_bind().dialect.insert_returning:
+        db_tasks = list(
+            await db.scalars(
+                insert(Task).returning(Task, sort_by_parameter_order=True), values
+            )
+        )
+    else:
+        db_tasks = [Task(**value) for value in values]
+        db.add_all(db_tasks)
+        await db.flush()
+    if db_tasks and email:
+        # one broker message for the whole batch
+        _add_event(
+            db,
+            [task_event("create", task.id, email, task.title) for task in db_tasks],
+        )
+    await db.commit()
+    if db_tasks:
+        await task_cache.invalidate(user_id)
+    return db_tasks
+
+
+# mark many tasks as completed with a single UPDATE
+async def mark_tasks_complete(
+    db: AsyncSession, user_id: int, task_ids: list[int], email: str | None = None
+) -> list[Task]:
+    condition = and_(Task.user_id == user_id, Task.id.in_(task_ids))
+    stmt = (
+        update(Task)
+        .where(condition)
+        .values(status=Status.DONE, version=Task.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    if _supports_returning(db):
+        tasks = list(await db.scalars(stmt.returning(Task)))
+    else:
+        await db.execute(stmt)
+        tasks = list(
+            await db.scalars(
+                select(Task).where(condition).execution_options(populate_existing=True)
+            )
+        )
+    if tasks and email:
+        _add_event(
+            db, [task_event("complete", task.id, email, task.title) for task in tasks]
+        )
+    await db.commit()
+    if tasks:
+        await task_cache.invalidate(user_id)
+    return tasks
+
+
+# Delete many tasks with a single DELETE, returns the ids that were deleted
+async def delete_tasks(
+    db: AsyncSession, user_id: int, task_ids: list[int], email: str | None = None
+) -> list[int]:
+    condition = and_(Task.user_id == user_id, Task.id.in_(task_ids))
+    stmt = delete(Task).where(condition).execution_options(synchronize_session=False)
+    if _supports_returning(db):
+        deleted_ids = list(await db.scalars(stmt.returning(Task.id)))
+    else:
+        deleted_ids = list(await db.scalars(select(Task.id).where(condition)))
+        await db.execute(stmt)
+    if deleted_ids and email:
+        _add_event(
+            db, [task_event("delete", task_id, email) for task_id in deleted_ids]
+        )
+    await db.commit()
+    if deleted_ids:
+        await task_cache.invalidate(user_id)
+    return deleted_ids
@@ -0,0 +1,16 @@
+import enum
+
+
+class TaskSort(str, enum.Enum):
+    ID = "id"
+    ID_DESC = "-id"
+    DUE_DATE = "due_date"
+    DUE_DATE_DESC = "-due_date"
+
+    @property
+    def descending(self) -> bool:
+        return self.value.startswith("-")
+
+    @property
+    def by_due_date(self) -> bool:
+        return self in (TaskSort.DUE_DATE, TaskSort.DUE_DATE_DESC)
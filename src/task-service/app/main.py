@@ -1,13 +1,25 @@
-from fastapi import FastAPI
+import os
+from typing import Any
 
+from fastapi import Depends, FastAPI
+
+from app.models.outbox import OutboxEvent  # noqa: F401
 from app.models.task import Task  # noqa: F401
 from app.models.user import User  # noqa: F401
 from app.routers import tasks
-from app.utils.database import Base, engine
+from app.utils.auth import require_metrics_token
+from app.utils.change_feed import change_feed
+from app.utils.compression import CompressionMiddleware
+from app.utils.database import close_db, init_db
 from app.utils.logger import logger
-from app.utils.message_broker import close_rabbitmq_channel, get_rabbitmq_channel
+from app.utils.message_broker import publisher, start_publisher, stop_publisher
+from app.utils.outbox_relay import outbox_relay
+from app.utils.task_cache import task_cache
 
 app = FastAPI()
+# the gateway asks for gzip and passes the compressed bodies through
+app.add_middleware(CompressionMiddleware)
+is_background_task_enabled = False if os.getenv("BACKGROUND_TASK_DISABLED") else True
 
 
 app.include_router(tasks.router, prefix="/tasks", tags=["tasks"])
@@ -16,25 +28,56 @@ app.include_router(tasks.router, prefix="/tasks", tags=["tasks"])
 @app.on_event("startup")
 async def startup_event():
     try:
-        Base.metadata.create_all(bind=engine)
+        await init_db()
         logger.info("Database initialized successfully")
     except Exception as e:
         logger.error(f"Failed to initialize the DBs: {e}")
-    try:
-        get_rabbitmq_channel()
-    except Exception as e:
-        logger.error(f"Failed to create channel: {e}")
+    start_publisher()
+    if is_background_task_enabled:
+        outbox_relay.start()
+        change_feed.start()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     try:
-        close_rabbitmq_channel()
+        await outbox_relay.stop()
+    except Exception as e:
+        logger.error(f"Failed to stop the outbox relay: {e}")
+    try:
+        change_feed.stop()
+    except Exception as e:
+        logger.error(f"Failed to stop the change feed: {e}")
+    try:
+        stop_publisher()
+    except Exception as e:
+        logger.error(f"Failed to stop the publisher: {e}")
+    try:
+        await task_cache.close()
     except Exception as e:
-        logger.error(f"Failed to close channel: {e}")
+        logger.error(f"Failed to close the task cache: {e}")
+    try:
+        await close_db()
+    except Exception as e:
+        logger.error(f"Failed to close the DB engine: {e}")
     logger.info("Shutdown event completed")
 
 
+@app.get("/metrics/publisher", dependencies=[Depends(require_metrics_token)])
+async def fetch_publisher_metrics() -> Any:
+    return {**publisher.stats(), "outbox": outbox_relay.stats()}
+
+
+@app.get("/metrics/feed", dependencies=[Depends(require_metrics_token)])
+async def fetch_feed_metrics() -> Any:
+    return change_feed.stats()
+
+
+@app.get("/metrics/task-cache", dependencies=[Depends(require_metrics_token)])
+async def fetch_task_cache_metrics() -> Any:
+    return task_cache.stats()
+
+
 # if __name__ == "__main__":
 #     uvicorn.run(
 #         "app.main:app",
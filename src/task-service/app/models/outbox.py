@@ -0,0 +1,14 @@
+from sqlalchemy import JSON, Column, DateTime, Integer, func
+
+from app.utils.database import Base
+
+
+# notifications waiting to be relayed to the broker, written in the same
+# transaction as the task change they describe
+class OutboxEvent(Base):
+    __tablename__ = "outbox_events"
+
+    id = Column(Integer, primary_key=True)
+    # message body for the notification queue, a single event or a list of events
+    payload = Column(JSON, nullable=False)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
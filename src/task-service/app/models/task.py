@@ -1,8 +1,8 @@
-
 from sqlalchemy import (
     Column,
     Date,
     ForeignKey,
+    Index,
     Integer,
     String,
 )
@@ -18,6 +18,11 @@ from app.utils.database import Base
 class Task(Base):
 
     __tablename__ = "tasks"
+    __table_args__ = (
+        # keyset pagination and filtered listings of a user's tasks
+        Index("ix_tasks_user_id_id", "user_id", "id"),
+        Index("ix_tasks_user_id_status_due_date", "user_id", "status", "due_date"),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String)
@@ -25,5 +30,7 @@ class Task(Base):
     status = Column(SQLAEnum(Status))
     due_date = Column(Date)
     user_id = Column(Integer, ForeignKey("users.id"))
+    # incremented on every update, used for optimistic concurrency and ETags
+    version = Column(Integer, nullable=False, default=1, server_default="1")
 
     user = relationship("User", back_populates="tasks")
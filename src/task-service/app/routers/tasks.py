@@ -1,134 +1,302 @@
 import json
-import os
-from typing import Annotated, Sequence
+from datetime import date
+from typing import Annotated, Any
 
 from fastapi import (
     APIRouter,
-    BackgroundTasks,
     Depends,
     Header,
     HTTPException,
     Query,
+    Request,
+    Response,
     status,
 )
-from sqlalchemy.orm import Session
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.crud.task import (
+    VERSION_MISMATCH,
     create_task,
+    create_tasks,
     delete_task,
+    delete_tasks,
     get_task_by_id,
     get_user_tasks,
     mark_task_complete,
+    mark_tasks_complete,
     update_task,
 )
-from app.schemas.task import Task, TaskCreate, TaskUpdatePayload, UserTasksOutput
+from app.enums.sort_enum import TaskSort
+from app.enums.status_enum import Status
+from app.schemas.task import (
+    Task,
+    TaskBatchCreate,
+    TaskBatchResult,
+    TaskCreate,
+    TaskFilter,
+    TaskIds,
+    TaskUpdatePayload,
+    UserTasksOutput,
+)
+from app.utils.change_feed import FeedFull, change_feed
 from app.utils.database import get_db
-from app.utils.message_broker import publish
+from app.utils.etag import (
+    etag_matches,
+    parse_task_etags,
+    task_etag,
+    task_list_etag,
+)
+from app.utils.outbox_relay import outbox_relay
+from app.utils.pagination import decode_cursor, encode_cursor
 
 router = APIRouter()
-is_background_task_enabled = False if os.getenv("BACKGROUND_TASK_DISABLED") else True
+
+# the task listing fields, see UserTasksOutput
+LIST_FIELDS = tuple(UserTasksOutput.model_fields)
 
 
 @router.post("/", response_model=Task, status_code=status.HTTP_201_CREATED)
 async def create(
-    db: Annotated[Session, Depends(get_db)],
+    db: Annotated[AsyncSession, Depends(get_db)],
     payload: TaskCreate,
     x_user_info: Annotated[str, Header()],
-    background_tasks: BackgroundTasks,
 ) -> Task:
     user_info = json.loads(x_user_info)
-    task = create_task(db, payload, user_info["id"])
-    if is_background_task_enabled:
-        payload = {
-            "operation": "create",
-            "task": task.title,
-            "email": user_info["email"],
-        }  # type: ignore
-        background_tasks.add_task(publish, payload)
-
+    task = await create_task(db, payload, user_info["id"], user_info["email"])
+    outbox_relay.wake()
     return task
 
 
+# batch routes are registered before the /{task_id} routes so they match first
+@router.post(
+    "/batch",
+    response_model=list[TaskBatchResult],
+    status_code=status.HTTP_201_CREATED,
+)
+async def create_batch(
+    db: Annotated[AsyncSession, Depends(get_db)],
+    payload: TaskBatchCreate,
+    x_user_info: Annotated[str, Header()],
+) -> list[dict[str, Any]]:
+    user_info = json.loads(x_user_info)
+    tasks = await create_tasks(db, payload.tasks, user_info["id"], user_info["email"])
+    outbox_relay.wake()
+    return [{"id": task.id, "result": "created", "task": task} for task in tasks]
+
+
+@router.patch("/batch/complete", response_model=list[TaskBatchResult])
+async def mark_completed_batch(
+    db: Annotated[AsyncSession, Depends(get_db)],
+    payload: TaskIds,
+    x_user_info: Annotated[str, Header()],
+) -> list[dict[str, Any]]:
+    user_info = json.loads(x_user_info)
+    task_ids = list(dict.fromkeys(payload.ids))
+    completed = await mark_tasks_complete(
+        db, user_info["id"], task_ids, user_info["email"]
+    )
+    tasks = {task.id: task for task in completed}
+    if tasks:
+        outbox_relay.wake()
+    return [
+        (
+            {"id": task_id, "result": "completed", "task": tasks[task_id]}
+            if task_id in tasks
+            else {"id": task_id, "result": "task not found"}
+        )
+        for task_id in task_ids
+    ]
+
+
+@router.delete("/batch", response_model=list[TaskBatchResult])
+async def delete_batch(
+    db: Annotated[AsyncSession, Depends(get_db)],
+    payload: TaskIds,
+    x_user_info: Annotated[str, Header()],
+) -> list[dict[str, Any]]:
+    user_info = json.loads(x_user_info)
+    task_ids = list(dict.fromkeys(payload.ids))
+    deleted_ids = set(
+        await delete_tasks(db, user_info["id"], task_ids, user_info["email"])
+    )
+    if deleted_ids:
+        outbox_relay.wake()
+    return [
+        {
+            "id": task_id,
+            "result": "deleted" if task_id in deleted_ids else "task not found",
+        }
+        for task_id in task_ids
+    ]
+
+
+@router.get("/feed")
+async def feed(
+    x_user_info: Annotated[str, Header()],
+    last_event_id: Annotated[str | None, Header()] = None,
+) -> StreamingResponse:
+    """Server-sent events for every change to the user's tasks.
+
+    A client reconnecting with Last-Event-ID gets the events it missed, or a
+    "reset" event when they are no longer buffered and it must reload.
+    """
+    user_info = json.loads(x_user_info)
+    try:
+        subscription = change_feed.subscribe(user_info["email"], last_event_id)
+    except FeedFull:
+        raise HTTPException(503, "too many open feeds", headers={"Retry-After": "5"})
+    return StreamingResponse(
+        change_feed.stream(subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
 @router.get("/{task_id}", response_model=Task)
 async def get_task(
-    db: Annotated[Session, Depends(get_db)],
+    db: Annotated[AsyncSession, Depends(get_db)],
     x_user_info: Annotated[str, Header()],
     task_id: int,
-) -> Task:
+    response: Response,
+    if_none_match: Annotated[str | None, Header()] = None,
+) -> Any:
     user_info = json.loads(x_user_info)
-    task = get_task_by_id(db, user_info["id"], task_id)
+    task = await get_task_by_id(db, user_info["id"], task_id)
     if not task:
         raise HTTPException(404, "task not found")
+    etag = task_etag(task)
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag}
+        )
+    response.headers["ETag"] = etag
     return task
 
 
 @router.get("/", response_model=list[UserTasksOutput])
 async def get_tasks(
-    db: Annotated[Session, Depends(get_db)],
+    db: Annotated[AsyncSession, Depends(get_db)],
     x_user_info: Annotated[str, Header()],
+    request: Request,
+    response: Response,
     limit: Annotated[int, Query(ge=0)] = 100,
     skip: Annotated[int, Query(ge=0)] = 0,
-) -> Sequence[UserTasksOutput]:
+    after: str | None = None,
+    sort: TaskSort = TaskSort.ID,
+    task_status: Annotated[list[Status] | None, Query(alias="status")] = None,
+    due_after: date | None = None,
+    due_before: date | None = None,
+    overdue: bool = False,
+    if_none_match: Annotated[str | None, Header()] = None,
+) -> Any:
     user_info = json.loads(x_user_info)
-    tasks = get_user_tasks(db, user_info["id"], skip, limit)
-    return tasks
+    filters = TaskFilter(
+        status=task_status,
+        due_after=due_after,
+        due_before=due_before,
+        overdue=overdue,
+    )
+    try:
+        after_key = decode_cursor(after) if after else None
+        tasks, next_key = await get_user_tasks(
+            db,
+            user_info["id"],
+            skip,
+            limit,
+            after=after_key,
+            sort=sort,
+            filters=filters,
+        )
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+    if next_key is not None:
+        next_cursor = encode_cursor(next_key)
+        next_url = request.url.remove_query_params("skip").include_query_params(
+            after=next_cursor
+        )
+        response.headers["Link"] = f'<{next_url.path}?{next_url.query}>; rel="next"'
+        response.headers["X-Next-Cursor"] = next_cursor
+
+    response.headers["ETag"] = task_list_etag(tasks, next_key)
+    if if_none_match is not None and etag_matches(
+        if_none_match, response.headers["ETag"]
+    ):
+        # the client's copy is current, skip serializing the tasks
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers=dict(response.headers)
+        )
+    # the rows come straight from the database, so they are encoded without
+    # validating them against UserTasksOutput first
+    return ORJSONResponse(
+        [{field: task[field] for field in LIST_FIELDS} for task in tasks],
+        headers=dict(response.headers),
+    )
 
 
 @router.put("/{task_id}")
 async def update(
-    db: Annotated[Session, Depends(get_db)],
+    db: Annotated[AsyncSession, Depends(get_db)],
     x_user_info: Annotated[str, Header()],
     task_id: int,
     task_update_payload: TaskUpdatePayload,
-    background_tasks: BackgroundTasks,
+    response: Response,
+    if_match: Annotated[str | None, Header()] = None,
 ) -> Task:
     user_info = json.loads(x_user_info)
-    err_msg, task = update_task(db, user_info["id"], task_id, task_update_payload)
+
+    expected_version = None
+    if if_match is not None and if_match.strip() != "*":
+        try:
+            etags = parse_task_etags(if_match)
+        except ValueError:
+            raise HTTPException(400, "invalid If-Match header")
+        versions = [version for etag_id, version in etags if etag_id == task_id]
+        if not versions:
+            raise HTTPException(412, VERSION_MISMATCH)
+        expected_version = versions[0]
+
+    err_msg, task = await update_task(
+        db,
+        user_info["id"],
+        task_id,
+        task_update_payload,
+        expected_version,
+        user_info["email"],
+    )
     if not task:
-        raise HTTPException(404, err_msg)
-    if is_background_task_enabled:
-        payload = {
-            "operation": "update",
-            "task": task.title,
-            "email": user_info["email"],
-        }
-        background_tasks.add_task(publish, payload)
+        raise HTTPException(412 if err_msg == VERSION_MISMATCH else 404, err_msg)
+    outbox_relay.wake()
+    response.headers["ETag"] = task_etag(task)
     return task
 
 
 @router.patch("/{task_id}/complete")
 async def mark_completed(
-    db: Annotated[Session, Depends(get_db)],
+    db: Annotated[AsyncSession, Depends(get_db)],
     x_user_info: Annotated[str, Header()],
     task_id: int,
-    background_tasks: BackgroundTasks,
 ) -> Task:
     user_info = json.loads(x_user_info)
-    err_msg, task = mark_task_complete(db, user_info["id"], task_id)
+    err_msg, task = await mark_task_complete(
+        db, user_info["id"], task_id, user_info["email"]
+    )
     if not task:
         raise HTTPException(404, err_msg)
-    if is_background_task_enabled:
-        payload = {
-            "operation": "complete",
-            "task": task.title,
-            "email": user_info["email"],
-        }
-        background_tasks.add_task(publish, payload)
+    outbox_relay.wake()
     return task
 
 
 @router.delete("/{task_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete(
-    db: Annotated[Session, Depends(get_db)],
+    db: Annotated[AsyncSession, Depends(get_db)],
     x_user_info: Annotated[str, Header()],
     task_id: int,
-    background_tasks: BackgroundTasks,
 ) -> None:
     user_info = json.loads(x_user_info)
-    success = delete_task(db, user_info["id"], task_id)
+    success = await delete_task(db, user_info["id"], task_id, user_info["email"])
     if not success:
         raise HTTPException(404, "task not found")
-    if is_background_task_enabled:
-        payload = {"operation": "delete", "task": task_id, "email": user_info["email"]}
-        background_tasks.add_task(publish, payload)
+    outbox_relay.wake()
     return None
@@ -1,9 +1,11 @@
 from datetime import date
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 
 from app.enums.status_enum import Status
 
+MAX_BATCH_SIZE = 1000
+
 
 class TaskBase(BaseModel):
     description: str | None = None
@@ -19,18 +21,38 @@ class TaskUpdatePayload(TaskBase):
     status: Status | None = None
 
 
+class TaskFilter(BaseModel):
+    status: list[Status] | None = None
+    due_after: date | None = None
+    due_before: date | None = None
+    overdue: bool = False
+
+
 class Task(TaskCreate):
     id: int
     status: Status
     user_id: int
+    version: int
 
-    class Config:
-        ord_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class UserTasksOutput(TaskCreate):
     id: int
     status: str
 
-    class Config:
-        ord_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+
+class TaskBatchCreate(BaseModel):
+    tasks: list[TaskCreate] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+
+
+class TaskIds(BaseModel):
+    ids: list[int] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+
+
+class TaskBatchResult(BaseModel):
+    id: int
+    result: str
+    task: Task | None = None
@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.utils import change_feed as feed_module
+from app.utils.change_feed import ChangeFeed, format_event
+from app.utils.events import task_event
+
+
+def event(event_id, email="a@gmail.com", operation="create"):
+    return {**task_event(operation, 1, email, "Title"), "id": event_id}
+
+
+async def next_events(feed, subscription, count):
+    stream = feed.stream(subscription)
+    chunks = [await stream.__anext__() for _ in range(count)]
+    await stream.aclose()
+    return chunks
+
+
+def test_feed_pushes_the_users_events():
+    async def run():
+        feed = ChangeFeed()
+        subscription = feed.subscribe("a@gmail.com")
+        feed.dispatch([event("1"), event("2", email="b@gmail.com"), event("3")])
+        chunks = await next_events(feed, subscription, 3)
+        return feed, chunks
+
+    feed, chunks = asyncio.run(run())
+    assert chunks[1:] == [format_event(event("1")), format_event(event("3"))]
+    assert chunks[1].startswith("id: 1\nevent: create\ndata: ")
+    assert "a@gmail.com" not in chunks[1]
+    # closing the stream unsubscribes
+    assert feed.connections == 0
+
+
+def test_feed_resumes_after_last_event_id():
+    async def run():
+        feed = ChangeFeed()
+        feed.dispatch([event("1"), event("2"), event("3", email="b@gmail.com")])
+        feed.dispatch([event("4")])
+        resumed = feed.subscribe("a@gmail.com", last_event_id="2")
+        unknown = feed.subscribe("a@gmail.com", last_event_id="0")
+        return (
+            await next_events(feed, resumed, 2),
+            await next_events(feed, unknown, 2),
+        )
+
+    resumed, unknown = asyncio.run(run())
+    assert resumed[1] == format_event(event("4"))
+    assert unknown[1] == "event: reset\ndata: {}\n\n"
+
+
+def test_feed_closes_a_slow_client(monkeypatch):
+    monkeypatch.setattr(feed_module, "FEED_CONNECTION_BUFFER", 2)
+
+    async def run():
+        feed = ChangeFeed()
+        subscription = feed.subscribe("a@gmail.com")
+        feed.dispatch([event(str(i)) for i in range(5)])
+        chunks = [chunk async for chunk in feed.stream(subscription)]
+        return feed, chunks
+
+    feed, chunks = asyncio.run(run())
+    # the events that fit are sent, then the client has to resume
+    assert chunks[1:] == [format_event(event("0")), format_event(event("1"))]
+    assert feed.stats()["overflows_total"] == 1
+
+
+def test_feed_rejects_connections_over_the_limit(monkeypatch):
+    monkeypatch.setattr(feed_module, "FEED_MAX_CONNECTIONS", 0)
+    headers = {"X-User-Info": json.dumps({"id": 1, "email": "a@gmail.com"})}
+
+    response = TestClient(app).get("/tasks/feed", headers=headers)
+    assert response.status_code == 503, response.text
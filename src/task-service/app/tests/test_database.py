@@ -0,0 +1,158 @@
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+
+from app.main import app
+from app.models.outbox import OutboxEvent  # noqa: F401
+from app.models.task import Task  # noqa: F401
+from app.models.user import User  # noqa: F401
+from app.utils.database import (
+    create_schema,
+    get_async_database_url,
+    get_db,
+    get_pool_options,
+)
+
+
+def test_create_schema_upgrades_existing_tables(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        # the tables as the first release created them
+        conn.execute(
+            text(
+                "CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR, "
+                "email VARCHAR, password VARCHAR, disabled BOOLEAN)"
+            )
+        )
+        conn.execute(
+            text(
+                "CREATE TABLE tasks (id INTEGER PRIMARY KEY, title VARCHAR, "
+                "description VARCHAR, status VARCHAR(11), due_date DATE, "
+                "user_id INTEGER REFERENCES users (id))"
+            )
+        )
+        conn.execute(text("INSERT INTO tasks (title, user_id) VALUES ('Old', 1)"))
+
+    for _ in range(2):
+        # a second run finds nothing left to do
+        with engine.begin() as conn:
+            create_schema(conn)
+
+    inspector = inspect(engine)
+    assert "version" in {column["name"] for column in inspector.get_columns("tasks")}
+    assert {index["name"] for index in inspector.get_indexes("tasks")} >= {
+        "ix_tasks_user_id_id",
+        "ix_tasks_user_id_status_due_date",
+    }
+    assert inspector.has_table("outbox_events")
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT version FROM tasks")).scalar() == 1
+        # the keyset and filtered listings use their indexes
+        for query, index in [
+            (
+                "SELECT id FROM tasks WHERE user_id = 1 AND id > 5 ORDER BY id",
+                "ix_tasks_user_id_id",
+            ),
+            (
+                "SELECT id FROM tasks WHERE user_id = 1 AND status = 'OPEN' "
+                "AND due_date < '2024-01-01'",
+                "ix_tasks_user_id_status_due_date",
+            ),
+        ]:
+            plan = conn.execute(text(f"EXPLAIN QUERY PLAN {query}")).all()
+            assert any(index in row[-1] for row in plan), plan
+    engine.dispose()
+
+
+@pytest.fixture
+def async_client(tmp_path):
+    """A client whose requests use a real AsyncSession on aiosqlite."""
+    url = get_async_database_url(f"sqlite:///{tmp_path / 'async.db'}")
+    assert url is not None and url.startswith("sqlite+aiosqlite://")
+    # every TestClient request runs on a new event loop, so connections are
+    # not pooled between requests
+    engine = create_async_engine(url, poolclass=NullPool)
+    session_factory = async_sessionmaker(
+        bind=engine, autoflush=False, expire_on_commit=False
+    )
+
+    async def create():
+        async with engine.begin() as conn:
+            await conn.run_sync(create_schema)
+
+    asyncio.run(create())
+
+    async def override_get_db():
+        async with session_factory() as db:
+            yield db
+
+    previous = app.dependency_overrides.get(get_db)
+    app.dependency_overrides[get_db] = override_get_db
+    try:
+        yield TestClient(app)
+    finally:
+        if previous is None:
+            del app.dependency_overrides[get_db]
+        else:
+            app.dependency_overrides[get_db] = previous
+        asyncio.run(engine.dispose())
+
+
+def test_async_session_writes(async_client):
+    headers = {"X-User-Info": json.dumps({"id": 20, "email": "async@gmail.com"})}
+
+    response = async_client.post("/tasks/", headers=headers, json={"title": "Async"})
+    assert response.status_code == 201, response.text
+    task_id = response.json()["id"]
+
+    # UPDATE ... RETURNING through the AsyncSession, guarded by the version
+    response = async_client.put(
+        f"/tasks/{task_id}",
+        headers={**headers, "If-Match": f'"{task_id}-1"'},
+        json={"title": "Async 2"},
+    )
+    assert response.status_code == 200, response.text
+    assert response.headers["etag"] == f'"{task_id}-2"'
+    response = async_client.put(
+        f"/tasks/{task_id}",
+        headers={**headers, "If-Match": f'"{task_id}-1"'},
+        json={"title": "Async 3"},
+    )
+    assert response.status_code == 412, response.text
+
+    response = async_client.post(
+        "/tasks/batch",
+        headers=headers,
+        json={"tasks": [{"title": "Batch A"}, {"title": "Batch B"}]},
+    )
+    assert response.status_code == 201, response.text
+    ids = [result["id"] for result in response.json()]
+
+    response = async_client.patch(
+        "/tasks/batch/complete", headers=headers, json={"ids": ids}
+    )
+    assert [result["result"] for result in response.json()] == ["completed"] * 2
+
+    response = async_client.delete(f"/tasks/{task_id}", headers=headers)
+    assert response.status_code == 204, response.text
+
+    response = async_client.get("/tasks/", headers=headers)
+    assert response.status_code == 200, response.text
+    assert [(task["title"], task["status"]) for task in response.json()] == [
+        ("Batch A", "DONE"),
+        ("Batch B", "DONE"),
+    ]
+
+
+def test_async_database_url():
+    assert get_async_database_url("sqlite:///./test.db") == (
+        "sqlite+aiosqlite:///./test.db"
+    )
+    assert get_async_database_url("mysql://db/tasks") is None
+    assert get_pool_options("sqlite+aiosqlite:///./test.db") == {}
+    assert get_pool_options("postgresql+asyncpg://db/tasks")["pool_size"] > 0
@@ -0,0 +1,67 @@
+from app.utils.events import coalesce_events, event_shard, task_event
+from app.utils.outbox_relay import build_messages
+
+
+def test_coalesce_folds_updates_into_create():
+    events = [
+        task_event("create", 1, "a@gmail.com", "Title"),
+        task_event("create", 2, "a@gmail.com", "Other"),
+        task_event("update", 1, "a@gmail.com", "Title 2"),
+        task_event("update", 1, "a@gmail.com", "Title 3"),
+    ]
+    assert coalesce_events(events) == [
+        task_event("create", 1, "a@gmail.com", "Title 3"),
+        task_event("create", 2, "a@gmail.com", "Other"),
+    ]
+
+
+def test_coalesce_delete_replaces_earlier_events():
+    events = [
+        task_event("update", 1, "a@gmail.com", "Title"),
+        task_event("complete", 1, "a@gmail.com", "Title"),
+        task_event("complete", 1, "a@gmail.com", "Title"),
+        task_event("delete", 1, "a@gmail.com"),
+        # created and deleted within the batch, nothing to notify
+        task_event("create", 2, "a@gmail.com", "Short lived"),
+        task_event("delete", 2, "a@gmail.com"),
+    ]
+    assert coalesce_events(events) == [task_event("delete", 1, "a@gmail.com")]
+
+
+def test_coalesce_keeps_events_without_task_id():
+    event = {"operation": "create", "task": "Title", "email": "a@gmail.com"}
+    assert coalesce_events([event, event]) == [event, event]
+
+
+def test_build_messages_flattens_outbox_payloads():
+    payloads = [
+        task_event("create", 1, "a@gmail.com", "Title"),
+        [
+            task_event("update", 1, "a@gmail.com", "Title 2"),
+            task_event("create", 2, "a@gmail.com", "Other"),
+        ],
+    ]
+    assert build_messages(payloads, shards=1) == [
+        (
+            0,
+            [
+                task_event("create", 1, "a@gmail.com", "Title 2"),
+                task_event("create", 2, "a@gmail.com", "Other"),
+            ],
+        )
+    ]
+
+
+def test_build_messages_groups_events_by_recipient_shard():
+    emails = [f"user{i}@gmail.com" for i in range(8)]
+    payloads = [task_event("create", i, email) for i, email in enumerate(emails)]
+    payloads += [task_event("complete", i, email) for i, email in enumerate(emails)]
+
+    messages = build_messages(payloads, shards=4)
+    assert len({shard for shard, _ in messages}) == len(messages) > 1
+    for shard, events in messages:
+        assert all(event_shard(event, 4) == shard for event in events)
+        # a recipient's events keep their order
+        for email in emails:
+            operations = [e["operation"] for e in events if e["email"] == email]
+            assert operations in ([], ["create", "complete"])
@@ -0,0 +1,137 @@
+import queue
+import time
+from types import SimpleNamespace
+
+import pytest
+from pika.spec import Basic
+
+from app.utils.message_broker import (
+    BrokerUnavailable,
+    CircuitBreaker,
+    Publisher,
+    PublisherThread,
+)
+
+
+def test_circuit_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_circuit_breaker_half_open_after_timeout():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+
+    # a failed trial call opens the circuit again
+    breaker.record_failure()
+    breaker.reset_timeout = 60
+    assert breaker.state == "open"
+
+
+def test_publisher_fails_fast_when_circuit_open():
+    publisher = Publisher(threads=1, queue_size=10)
+    publisher.breaker.opened_at = time.monotonic()
+    publisher.breaker.reset_timeout = 60
+
+    future = publisher.submit({"operation": "create"})
+    with pytest.raises(BrokerUnavailable):
+        future.result(timeout=0)
+    assert all(q.empty() for q in publisher.queues)
+    publisher.stop()
+
+
+def test_publisher_drops_when_queue_full():
+    publisher = Publisher(threads=0, queue_size=1)
+    publisher.queues[0].put_nowait((b"{}", "application/json", 0, None))  # type: ignore
+
+    future = publisher.submit({"operation": "create"})
+    with pytest.raises(BrokerUnavailable):
+        future.result(timeout=0)
+    assert publisher.stats()["failed_total"] == 1
+
+
+def test_publisher_keeps_a_shard_on_one_thread():
+    publisher = Publisher(threads=0, queue_size=10)
+    # the queue of a second thread, without starting it
+    publisher.queues.append(queue.Queue(maxsize=10))
+
+    for shard in (0, 1, 3, 1):
+        publisher.submit([{"operation": "create"}], shard)
+    assert [item[2] for item in publisher.queues[0].queue] == [0]  # type: ignore
+    assert [item[2] for item in publisher.queues[1].queue] == [1, 3, 1]  # type: ignore
+
+
+class FakeChannel:
+    def __init__(self) -> None:
+        self.published: list[tuple[str, bytes]] = []
+
+    def basic_publish(self, exchange, routing_key, body, properties, mandatory):
+        self.published.append((routing_key, body))
+
+
+def confirm(method):
+    return SimpleNamespace(method=method)
+
+
+def test_publisher_thread_pipelines_confirms():
+    publisher = Publisher(threads=0, queue_size=10)
+    thread = PublisherThread(publisher, 0)
+    futures = [publisher.submit({"n": n}, shard=0) for n in range(3)]
+    futures.append(publisher.submit({"n": 3}, shard=1))
+
+    channel = FakeChannel()
+    thread.on_channel_ready(channel)  # type: ignore[arg-type]
+    # everything queued goes out before the first confirm comes back
+    assert len(channel.published) == 4
+    assert not any(future.done() for future in futures)
+
+    # the message of shard 1 has no queue bound, it comes back before its ack
+    thread.on_return(
+        channel,  # type: ignore[arg-type]
+        SimpleNamespace(routing_key="1"),  # type: ignore[arg-type]
+        None,  # type: ignore[arg-type]
+        channel.published[3][1],
+    )
+    thread.on_confirm(confirm(Basic.Ack(delivery_tag=2, multiple=True)))
+    assert futures[0].result(timeout=0) is None
+    assert futures[1].result(timeout=0) is None
+    assert not futures[2].done()
+
+    thread.on_confirm(confirm(Basic.Nack(delivery_tag=3)))
+    thread.on_confirm(confirm(Basic.Ack(delivery_tag=4)))
+    for future in futures[2:]:
+        with pytest.raises(BrokerUnavailable):
+            future.result(timeout=0)
+    assert not thread.unconfirmed
+    assert publisher.stats()["published_total"] == 2
+    assert publisher.stats()["failed_total"] == 2
+    thread.ioloop.close()
+
+
+def test_publisher_thread_retries_unconfirmed_messages_once():
+    publisher = Publisher(threads=0, queue_size=10)
+    thread = PublisherThread(publisher, 0)
+    future = publisher.submit({"n": 1})
+
+    for _ in range(2):
+        channel = FakeChannel()
+        thread.on_channel_ready(channel)  # type: ignore[arg-type]
+        assert len(channel.published) == 1
+        assert not future.done()
+        # the connection is lost before the broker confirmed the message
+        thread.on_connection_closed(None, ConnectionError("lost"))  # type: ignore
+
+    with pytest.raises(BrokerUnavailable):
+        future.result(timeout=0)
+    assert not thread.pending
+    thread.ioloop.close()
@@ -0,0 +1,129 @@
+import asyncio
+from datetime import date
+from typing import Any
+
+from app.utils import task_cache
+from app.utils.task_cache import MemoryStore, RedisStore, TaskCache
+
+
+class FakeSharedStore:
+    """Stands in for a cache server shared by several workers."""
+
+    def __init__(self) -> None:
+        self.data: dict[str, Any] = {}
+
+    async def get(self, key: str) -> Any | None:
+        return self.data.get(key)
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        self.data[key] = value
+
+    def stats(self) -> dict[str, Any]:
+        return {"size": len(self.data)}
+
+
+def test_memory_store_evicts_least_recently_used():
+    async def run():
+        store = MemoryStore(max_size=2)
+        await store.set("a", 1, ttl=60)
+        await store.set("b", 2, ttl=60)
+        assert await store.get("a") == 1
+        await store.set("c", 3, ttl=60)
+        assert await store.get("b") is None
+        assert await store.get("a") == 1
+
+        await store.set("d", 4, ttl=0)
+        assert await store.get("d") is None
+        return store.stats()
+
+    stats = asyncio.run(run())
+    assert stats["evictions"] == 2
+    assert stats["expirations"] == 1
+
+
+def test_invalidation_reaches_every_worker_of_a_shared_store():
+    async def run():
+        store = FakeSharedStore()
+        worker_1 = TaskCache(store, ttl=60)
+        worker_2 = TaskCache(store, ttl=60)
+
+        key = await worker_1.key(1, "task", 7)
+        await worker_1.set(key, {"id": 7})
+        assert await worker_2.get(await worker_2.key(1, "task", 7)) == {"id": 7}
+        # other users and query shapes are separate entries
+        assert await worker_2.get(await worker_2.key(2, "task", 7)) is None
+        assert await worker_2.get(await worker_2.key(1, "task", 8)) is None
+
+        await worker_2.invalidate(1)
+        assert await worker_1.get(await worker_1.key(1, "task", 7)) is None
+        return worker_1.stats(), worker_2.stats()
+
+    stats_1, stats_2 = asyncio.run(run())
+    assert (stats_1["hits"], stats_1["misses"]) == (0, 1)
+    assert (stats_2["hits"], stats_2["misses"]) == (1, 2)
+    assert stats_2["invalidations"] == 1
+
+
+def test_disabled_cache_never_hits():
+    async def run():
+        cache = TaskCache(FakeSharedStore(), ttl=60, enabled=False)
+        key = await cache.key(1, "task", 7)
+        await cache.set(key, {"id": 7})
+        return await cache.get(key)
+
+    assert asyncio.run(run()) is None
+
+
+class FakeRedis:
+    def __init__(self) -> None:
+        self.data: dict[str, str] = {}
+        self.ttls: dict[str, int] = {}
+        self.down = False
+
+    async def get(self, key: str) -> str | None:
+        if self.down:
+            raise ConnectionError("redis is down")
+        return self.data.get(key)
+
+    async def set(self, key: str, value: str, px: int) -> None:
+        if self.down:
+            raise ConnectionError("redis is down")
+        self.data[key] = value
+        self.ttls[key] = px
+
+
+def test_redis_store_keeps_values_as_json():
+    client = FakeRedis()
+    store = RedisStore(client)
+    row = {"id": 7, "due_date": date(2024, 5, 1), "status": "TODO"}
+
+    async def run():
+        await store.set("task", row, ttl=5)
+        await store.set("list", ([row], None), ttl=0.0001)
+        return await store.get("task"), await store.get("list")
+
+    cached_row, cached_list = asyncio.run(run())
+    assert cached_row == row
+    assert cached_list == [[row], None]
+    assert client.ttls == {"task": 5000, "list": 1}
+
+    client.down = True
+    assert asyncio.run(store.get("task")) is None
+    asyncio.run(store.set("task", row, ttl=5))
+    assert store.stats() == {"backend": "redis", "errors": 2}
+
+
+def test_memory_cache_is_disabled_with_several_workers(monkeypatch):
+    monkeypatch.setattr(task_cache, "TASK_CACHE_BACKEND", "memory")
+    monkeypatch.setattr(task_cache, "WEB_CONCURRENCY", 1)
+    assert task_cache.create_task_cache().enabled
+
+    monkeypatch.setattr(task_cache, "WEB_CONCURRENCY", 4)
+    assert not task_cache.create_task_cache().enabled
+
+    # a shared store stays enabled
+    monkeypatch.setattr(task_cache, "TASK_CACHE_BACKEND", "redis")
+    cache = task_cache.create_task_cache()
+    assert cache.enabled
+    assert isinstance(cache.store, RedisStore)
+    asyncio.run(cache.close())
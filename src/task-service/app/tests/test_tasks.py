@@ -1,14 +1,19 @@
+import asyncio
 import json
+from concurrent.futures import Future
+from datetime import date
 
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 
 from app.main import app
+from app.models.outbox import OutboxEvent
 from app.models.task import Task
-from app.utils.database import Base, get_db
+from app.utils import auth, outbox_relay
+from app.utils.database import Base, SyncSessionAdapter, get_db
 
 # Setup the in-memory SQLite database for testing
 SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
@@ -19,13 +24,16 @@ engine = create_engine(
     poolclass=StaticPool,
 )
 
-TestingSessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+TestingSessionLocal = sessionmaker(
+    bind=engine, autocommit=False, autoflush=False, expire_on_commit=False
+)
 
 
 def override_get_db():
+    # the sync SQLite session is used through the async session interface
     try:
         db = TestingSessionLocal()
-        yield db
+        yield SyncSessionAdapter(db)
     finally:
         db.close()
 
@@ -82,6 +90,314 @@ def test_update_task():
     assert "description" in data and data["description"] == "Task Test Description 2"
 
 
+def test_get_user_tasks_keyset_pagination():
+    headers = {"X-User-Info": json.dumps({"id": 2, "email": "paging@gmail.com"})}
+
+    response = client.get("/tasks/?limit=2", headers=headers)
+    assert response.status_code == 200, response.text
+    first_page = response.json()
+    assert [task["title"] for task in first_page] == ["Paging 1", "Paging 2"]
+    assert 'rel="next"' in response.headers["link"]
+
+    cursor = response.headers["x-next-cursor"]
+    response = client.get(f"/tasks/?limit=2&after={cursor}", headers=headers)
+    assert response.status_code == 200, response.text
+    assert [task["title"] for task in response.json()] == ["Paging 3", "Paging 4"]
+    assert "x-next-cursor" not in response.headers
+
+    # the skip/limit fallback returns the same rows
+    response = client.get("/tasks/?limit=2&skip=2", headers=headers)
+    assert [task["title"] for task in response.json()] == ["Paging 3", "Paging 4"]
+
+
+def test_get_user_tasks_keyset_pagination_by_due_date():
+    headers = {"X-User-Info": json.dumps({"id": 2, "email": "paging@gmail.com"})}
+
+    titles = []
+    url = "/tasks/?limit=3&sort=due_date"
+    while url:
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200, response.text
+        titles += [task["title"] for task in response.json()]
+        cursor = response.headers.get("x-next-cursor")
+        url = f"/tasks/?limit=3&sort=due_date&after={cursor}" if cursor else ""
+
+    assert titles == ["Paging 3", "Paging 1", "Paging 4", "Paging 2"]
+
+
+def test_get_user_tasks_keyset_pagination_descending():
+    headers = {"X-User-Info": json.dumps({"id": 2, "email": "paging@gmail.com"})}
+
+    titles = []
+    url = "/tasks/?limit=3&sort=-due_date"
+    while url:
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200, response.text
+        titles += [task["title"] for task in response.json()]
+        cursor = response.headers.get("x-next-cursor")
+        url = f"/tasks/?limit=3&sort=-due_date&after={cursor}" if cursor else ""
+
+    assert titles == ["Paging 2", "Paging 4", "Paging 1", "Paging 3"]
+
+
+def test_get_user_tasks_filters():
+    headers = {"X-User-Info": json.dumps({"id": 2, "email": "paging@gmail.com"})}
+
+    response = client.get(
+        "/tasks/?status=DONE&status=BLOCKED&sort=-id", headers=headers
+    )
+    assert response.status_code == 200, response.text
+    assert [task["title"] for task in response.json()] == ["Paging 4", "Paging 3"]
+
+    response = client.get(
+        "/tasks/?due_after=2024-04-15&due_before=2024-05-01", headers=headers
+    )
+    assert [task["title"] for task in response.json()] == ["Paging 1", "Paging 4"]
+
+    response = client.get("/tasks/?overdue=true", headers=headers)
+    assert [task["title"] for task in response.json()] == ["Paging 1", "Paging 3"]
+
+
+def test_get_user_tasks_invalid_cursor():
+    response = client.get("/tasks/?after=not-a-cursor", headers=x_user_info_header)
+    assert response.status_code == 400, response.text
+
+
+def test_batch_create_complete_and_delete():
+    headers = {"X-User-Info": json.dumps({"id": 3, "email": "batch@gmail.com"})}
+    request_body = {"tasks": [{"title": f"Batch {i}"} for i in range(3)]}
+
+    response = client.post("/tasks/batch", headers=headers, json=request_body)
+    assert response.status_code == 201, response.text
+    results = response.json()
+    assert [result["result"] for result in results] == ["created"] * 3
+    assert [result["task"]["title"] for result in results] == [
+        "Batch 0",
+        "Batch 1",
+        "Batch 2",
+    ]
+    ids = [result["id"] for result in results]
+
+    response = client.patch(
+        "/tasks/batch/complete", headers=headers, json={"ids": [ids[0], 9999]}
+    )
+    assert response.status_code == 200, response.text
+    results = response.json()
+    assert results[0]["result"] == "completed"
+    assert results[0]["task"]["status"] == "DONE"
+    assert results[1] == {"id": 9999, "result": "task not found", "task": None}
+
+    # tasks of other users are not touched
+    response = client.request(
+        "DELETE", "/tasks/batch", headers=x_user_info_header, json={"ids": ids}
+    )
+    assert [result["result"] for result in response.json()] == ["task not found"] * 3
+
+    response = client.request(
+        "DELETE", "/tasks/batch", headers=headers, json={"ids": ids[:2]}
+    )
+    assert response.status_code == 200, response.text
+    assert [result["result"] for result in response.json()] == ["deleted"] * 2
+
+    response = client.get("/tasks/", headers=headers)
+    assert [task["id"] for task in response.json()] == ids[2:]
+
+
+def test_update_task_if_match():
+    headers = {"X-User-Info": json.dumps({"id": 4, "email": "etag@gmail.com"})}
+    response = client.post("/tasks/", headers=headers, json={"title": "ETag"})
+    assert response.status_code == 201, response.text
+    task_id = response.json()["id"]
+
+    response = client.get(f"/tasks/{task_id}", headers=headers)
+    etag = response.headers["etag"]
+    assert etag == f'"{task_id}-1"'
+
+    response = client.put(
+        f"/tasks/{task_id}",
+        headers={**headers, "If-Match": etag},
+        json={"title": "ETag 2"},
+    )
+    assert response.status_code == 200, response.text
+    assert response.json()["version"] == 2
+    assert response.headers["etag"] == f'"{task_id}-2"'
+
+    # a stale ETag must not overwrite the newer version
+    response = client.put(
+        f"/tasks/{task_id}",
+        headers={**headers, "If-Match": etag},
+        json={"title": "ETag 3"},
+    )
+    assert response.status_code == 412, response.text
+
+    response = client.put(
+        f"/tasks/{task_id}",
+        headers={**headers, "If-Match": "not-an-etag"},
+        json={"title": "ETag 3"},
+    )
+    assert response.status_code == 400, response.text
+
+    response = client.put(
+        "/tasks/9999", headers={**headers, "If-Match": '"9999-1"'}, json={}
+    )
+    assert response.status_code == 404, response.text
+
+    response = client.get(f"/tasks/{task_id}", headers=headers)
+    assert response.json()["title"] == "ETag 2"
+
+
+def test_conditional_get():
+    headers = {"X-User-Info": json.dumps({"id": 7, "email": "poll@gmail.com"})}
+    response = client.post("/tasks/", headers=headers, json={"title": "Poll"})
+    task_id = response.json()["id"]
+
+    for url in (f"/tasks/{task_id}", "/tasks/"):
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200, response.text
+        etag = response.headers["etag"]
+
+        response = client.get(url, headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 304, response.text
+        assert response.headers["etag"] == etag
+        assert response.content == b""
+
+    list_etag = etag
+    client.patch(f"/tasks/{task_id}/complete", headers=headers)
+    response = client.get("/tasks/", headers={**headers, "If-None-Match": list_etag})
+    assert response.status_code == 200, response.text
+    assert response.headers["etag"] != list_etag
+    assert response.json()[0]["status"] == "DONE"
+
+
+def test_writes_record_outbox_events():
+    headers = {"X-User-Info": json.dumps({"id": 5, "email": "outbox@gmail.com"})}
+    session = TestingSessionLocal()
+    last_id = session.query(func.max(OutboxEvent.id)).scalar() or 0
+
+    response = client.post("/tasks/", headers=headers, json={"title": "Outbox"})
+    assert response.status_code == 201, response.text
+    task_id = response.json()["id"]
+    response = client.delete(f"/tasks/{task_id}", headers=headers)
+    assert response.status_code == 204, response.text
+    # failed writes record nothing
+    response = client.delete(f"/tasks/{task_id}", headers=headers)
+    assert response.status_code == 404, response.text
+
+    events = session.query(OutboxEvent).filter(OutboxEvent.id > last_id).all()
+    session.close()
+    assert [event.payload for event in events] == [
+        {
+            "operation": "create",
+            "task": "Outbox",
+            "task_id": task_id,
+            "email": "outbox@gmail.com",
+        },
+        {
+            "operation": "delete",
+            "task": task_id,
+            "task_id": task_id,
+            "email": "outbox@gmail.com",
+        },
+    ]
+
+
+def test_outbox_relay_waits_for_the_relay_lock(monkeypatch):
+    client.post("/tasks/", headers=x_user_info_header, json={"title": "Relayed"})
+    session = TestingSessionLocal()
+    pending = session.query(func.count(OutboxEvent.id)).scalar()
+    assert pending > 0
+
+    relay = outbox_relay.OutboxRelay()
+    published = []
+
+    def submit(message, shard):
+        published.append((shard, message))
+        future = Future()
+        future.set_result(None)
+        return future
+
+    monkeypatch.setattr(
+        outbox_relay, "open_session", lambda: SyncSessionAdapter(TestingSessionLocal())
+    )
+    monkeypatch.setattr(outbox_relay.publisher, "submit", submit)
+
+    async def lock_taken(db):
+        return False
+
+    # another worker is relaying, the rows are left to it and retried shortly
+    monkeypatch.setattr(relay, "try_lock", lock_taken)
+    assert asyncio.run(relay.relay_batch()) == (0, False)
+    assert relay.wakeup.is_set() and relay.lock_busy_total == 1
+    assert published == []
+    assert session.query(func.count(OutboxEvent.id)).scalar() == pending
+
+    # SQLite takes no advisory lock, this worker relays
+    monkeypatch.delattr(relay, "try_lock")
+    relayed, failed = asyncio.run(relay.relay_batch())
+    assert relayed == min(pending, outbox_relay.OUTBOX_BATCH_SIZE) and not failed
+    assert published
+    assert session.query(func.count(OutboxEvent.id)).scalar() == pending - relayed
+    session.close()
+
+
+@pytest.mark.parametrize(
+    "path", ["/metrics/publisher", "/metrics/feed", "/metrics/task-cache"]
+)
+def test_metrics_need_the_metrics_token(monkeypatch, path):
+    monkeypatch.setattr(auth, "METRICS_TOKEN", None)
+    assert client.get(path, headers={"X-Metrics-Token": ""}).status_code == 404
+
+    monkeypatch.setattr(auth, "METRICS_TOKEN", "secret")
+    assert client.get(path).status_code == 404
+    assert client.get(path, headers={"X-Metrics-Token": "wrong"}).status_code == 404
+    response = client.get(path, headers={"X-Metrics-Token": "secret"})
+    assert response.status_code == 200, response.text
+
+
+def test_reads_are_cached_until_a_write(monkeypatch):
+    monkeypatch.setattr(auth, "METRICS_TOKEN", "secret")
+    metrics_headers = {"X-Metrics-Token": "secret"}
+    headers = {"X-User-Info": json.dumps({"id": 6, "email": "cache@gmail.com"})}
+    client.post("/tasks/", headers=headers, json={"title": "Cached"})
+
+    client.get("/tasks/", headers=headers)
+    hits = client.get("/metrics/task-cache", headers=metrics_headers).json()["hits"]
+    response = client.get("/tasks/", headers=headers)
+    assert [task["title"] for task in response.json()] == ["Cached"]
+    response = client.get("/metrics/task-cache", headers=metrics_headers)
+    assert response.json()["hits"] == hits + 1
+
+    client.post("/tasks/", headers=headers, json={"title": "Cached 2"})
+    response = client.get("/tasks/", headers=headers)
+    assert [task["title"] for task in response.json()] == ["Cached", "Cached 2"]
+
+
+def test_large_responses_are_compressed():
+    headers = {"X-User-Info": json.dumps({"id": 8, "email": "gzip@gmail.com"})}
+    tasks = [{"title": f"Compressed {i}"} for i in range(20)]
+    client.post("/tasks/batch", headers=headers, json={"tasks": tasks})
+
+    response = client.get("/tasks/", headers={**headers, "Accept-Encoding": "gzip"})
+    assert response.status_code == 200, response.text
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert len(response.json()) == 20
+    gzip_etag = response.headers["etag"]
+
+    response = client.get("/tasks/", headers={**headers, "Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
+    assert len(response.json()) == 20
+    # each representation has its own strong validator
+    assert gzip_etag == response.headers["etag"][:-1] + '-gzip"'
+
+    # small bodies are not worth compressing
+    task_id = response.json()[0]["id"]
+    response = client.get(
+        f"/tasks/{task_id}", headers={**headers, "Accept-Encoding": "gzip"}
+    )
+    assert "content-encoding" not in response.headers
+
+
 @pytest.fixture(scope="session", autouse=True)
 def setup_database():
     # Create the tables in the test database
@@ -94,9 +410,18 @@ def setup_database():
         user_id=1,
     )
     session.add(task)
+    paging_tasks = [
+        ("OPEN", date(2024, 5, 1)),
+        ("OPEN", None),
+        ("BLOCKED", date(2024, 4, 1)),
+        ("DONE", date(2024, 5, 1)),
+    ]
+    for i, (task_status, due_date) in enumerate(paging_tasks, start=1):
+        session.add(
+            Task(title=f"Paging {i}", status=task_status, due_date=due_date, user_id=2)
+        )
     session.commit()
     session.close()
     yield
     # Drop the tables in the test database
     Base.metadata.drop_all(bind=engine)
-
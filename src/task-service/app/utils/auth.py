@@ -0,0 +1,20 @@
+import hmac
+import os
+from typing import Annotated
+
+from fastapi import Header, HTTPException
+
+# shared secret for the /metrics endpoints, which are not served without one
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+
+def require_metrics_token(
+    x_metrics_token: Annotated[str | None, Header()] = None
+) -> None:
+    """Hide the metrics endpoints from callers without the metrics token."""
+    if (
+        not METRICS_TOKEN
+        or x_metrics_token is None
+        or not hmac.compare_digest(x_metrics_token, METRICS_TOKEN)
+    ):
+        raise HTTPException(status_code=404, detail="Not Found")
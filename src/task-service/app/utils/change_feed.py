@@ -0,0 +1,227 @@
+import asyncio
+import json
+import os
+import threading
+from collections import deque
+from typing import Any, AsyncIterator
+
+import pika
+
+from app.utils.logger import logger
+from app.utils.message_broker import (
+    NOTIFICATION_EXCHANGE,
+    NOTIFICATION_SHARDS,
+    declare_shards,
+    decode_message,
+    get_connection_parameters,
+)
+
+# recent events kept for clients resuming with Last-Event-ID
+FEED_BUFFER_SIZE = int(os.getenv("FEED_BUFFER_SIZE", "10000"))
+# events waiting to be sent to one client, a client that falls further behind
+# is disconnected and resumes from the buffer when it reconnects
+FEED_CONNECTION_BUFFER = int(os.getenv("FEED_CONNECTION_BUFFER", "100"))
+# open feeds per worker
+FEED_MAX_CONNECTIONS = int(os.getenv("FEED_MAX_CONNECTIONS", "1000"))
+# seconds between keep-alive comments on an idle feed, must stay below the
+# gateway's upstream read timeout
+FEED_HEARTBEAT = float(os.getenv("FEED_HEARTBEAT", "15"))
+# pause before reconnecting to RabbitMQ (seconds)
+FEED_RECONNECT_DELAY = float(os.getenv("FEED_RECONNECT_DELAY", "5"))
+# events not picked up by the worker within this time are dropped by the broker
+FEED_QUEUE_TTL_MS = 60_000
+
+
+class FeedFull(Exception):
+    """The worker has no room for another feed."""
+
+
+class Subscription:
+    def __init__(self, email: str) -> None:
+        self.email = email
+        self.queue: asyncio.Queue[dict[str, Any]] = asyncio.Queue(
+            FEED_CONNECTION_BUFFER
+        )
+        # the events the client missed are no longer buffered
+        self.reset = False
+        self.overflowed = False
+
+    def put(self, event: dict[str, Any]) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+def format_event(event: dict[str, Any]) -> str:
+    data = {k: v for k, v in event.items() if k not in ("id", "email")}
+    lines = [f"id: {event['id']}"] if "id" in event else []
+    lines += [f"event: {event['operation']}", f"data: {json.dumps(data)}"]
+    return "\n".join(lines) + "\n\n"
+
+
+class ChangeFeed:
+    """Pushes the task events published for the notification service to the
+    feeds of the users they belong to.
+
+    Every worker receives all events through its own exclusive queue bound
+    to the notification exchange, and keeps the latest ones so a client can
+    resume after the last event it saw, on any worker that still has it.
+    """
+
+    def __init__(self) -> None:
+        self.buffer: deque[dict[str, Any]] = deque(maxlen=FEED_BUFFER_SIZE)
+        self.subscriptions: dict[str, set[Subscription]] = {}
+        self.connections = 0
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.thread: FeedConsumerThread | None = None
+
+        self.events_total = 0
+        self.resets_total = 0
+        self.overflows_total = 0
+
+    def start(self) -> None:
+        if self.thread is None:
+            self.loop = asyncio.get_running_loop()
+            self.thread = FeedConsumerThread(self)
+            self.thread.start()
+
+    def stop(self, timeout: float = 5) -> None:
+        thread, self.thread = self.thread, None
+        if thread is not None:
+            thread.stopping.set()
+            thread.join(timeout)
+
+    def dispatch(self, events: list[dict[str, Any]]) -> None:
+        """Buffer new events and hand them to the feeds, runs on the event loop."""
+        for event in events:
+            self.events_total += 1
+            self.buffer.append(event)
+            for subscription in self.subscriptions.get(event.get("email"), ()):
+                subscription.put(event)
+
+    def events_after(
+        self, email: str, last_event_id: str
+    ) -> list[dict[str, Any]] | None:
+        """The user's buffered events after `last_event_id`, None if not buffered."""
+        missed = None
+        for event in self.buffer:
+            if missed is not None:
+                if event.get("email") == email:
+                    missed.append(event)
+            elif event.get("id") == last_event_id:
+                missed = []
+        return missed
+
+    def subscribe(self, email: str, last_event_id: str | None = None) -> Subscription:
+        if self.connections >= FEED_MAX_CONNECTIONS:
+            raise FeedFull()
+        subscription = Subscription(email)
+        if last_event_id:
+            missed = self.events_after(email, last_event_id)
+            if missed is None:
+                # the client has to reload its tasks
+                subscription.reset = True
+                self.resets_total += 1
+            for event in missed or []:
+                subscription.put(event)
+        self.subscriptions.setdefault(email, set()).add(subscription)
+        self.connections += 1
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        subscriptions = self.subscriptions.get(subscription.email, set())
+        if subscription in subscriptions:
+            subscriptions.discard(subscription)
+            self.connections -= 1
+        if not subscriptions:
+            self.subscriptions.pop(subscription.email, None)
+
+    async def stream(self, subscription: Subscription) -> AsyncIterator[str]:
+        """Server-sent events of a subscription, until the client goes away."""
+        try:
+            yield f"retry: {int(FEED_RECONNECT_DELAY * 1000)}\n\n"
+            if subscription.reset:
+                yield "event: reset\ndata: {}\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        subscription.queue.get(), FEED_HEARTBEAT
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_event(event)
+                if subscription.overflowed and subscription.queue.empty():
+                    # the client resumes from the buffer when it reconnects
+                    self.overflows_total += 1
+                    break
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "running": self.thread is not None and self.thread.is_alive(),
+            "connections": self.connections,
+            "max_connections": FEED_MAX_CONNECTIONS,
+            "buffered": len(self.buffer),
+            "events_total": self.events_total,
+            "resets_total": self.resets_total,
+            "overflows_total": self.overflows_total,
+        }
+
+
+class FeedConsumerThread(threading.Thread):
+    """Receives the task events of every shard and passes them to the loop."""
+
+    def __init__(self, feed: ChangeFeed) -> None:
+        super().__init__(name="change-feed", daemon=True)
+        self.feed = feed
+        self.stopping = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopping.is_set():
+            try:
+                self.consume()
+            except Exception as e:
+                logger.warning(f"{self.name}: rabbitmq connection lost: {e}")
+                self.stopping.wait(FEED_RECONNECT_DELAY)
+
+    def consume(self) -> None:
+        connection = pika.BlockingConnection(get_connection_parameters())
+        try:
+            channel = connection.channel()
+            declare_shards(channel)
+            # removed by the broker once this worker disconnects
+            queue = channel.queue_declare(
+                queue="",
+                exclusive=True,
+                auto_delete=True,
+                arguments={"x-message-ttl": FEED_QUEUE_TTL_MS},
+            ).method.queue
+            for shard in range(NOTIFICATION_SHARDS):
+                channel.queue_bind(
+                    queue=queue, exchange=NOTIFICATION_EXCHANGE, routing_key=str(shard)
+                )
+            channel.basic_consume(
+                queue=queue, on_message_callback=self.on_message, auto_ack=True
+            )
+            logger.info(f"{self.name}: receiving task events")
+            while not self.stopping.is_set():
+                connection.process_data_events(time_limit=1)
+        finally:
+            if connection.is_open:
+                connection.close()
+
+    def on_message(self, ch: Any, method: Any, properties: Any, body: bytes) -> None:
+        try:
+            message = decode_message(body, properties.content_type)
+        except Exception as e:
+            logger.error(f"{self.name}: failed to decode a task event: {e}")
+            return
+        events = message if isinstance(message, list) else [message]
+        if self.feed.loop is not None:
+            self.feed.loop.call_soon_threadsafe(self.feed.dispatch, events)
+
+
+change_feed = ChangeFeed()
@@ -0,0 +1,49 @@
+import os
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# responses smaller than this (bytes) are sent uncompressed
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+# gzip level, kept low as the gateway passes these bodies on to clients as is
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "5"))
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """Gzip for the requests that accept it, except for event streams.
+
+    GZipMiddleware holds streamed output back until the compressor emits it,
+    which would delay feed events indefinitely. Compressed bodies get their
+    own ETag, "abc" becomes "abc-gzip" as in the gateway, which strips the
+    suffix again from the conditional headers it forwards.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = COMPRESSION_MIN_SIZE,
+        compresslevel: int = COMPRESSION_LEVEL,
+    ) -> None:
+        super().__init__(app, minimum_size=minimum_size, compresslevel=compresslevel)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            accept = Headers(scope=scope).get("accept", "")
+            if "text/event-stream" in accept:
+                await self.app(scope, receive, send)
+                return
+
+        async def send_with_etag(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                etag = headers.get("etag")
+                if (
+                    headers.get("content-encoding") == "gzip"
+                    and etag is not None
+                    and etag.endswith('"')
+                ):
+                    headers["etag"] = f'{etag[:-1]}-gzip"'
+            await send(message)
+
+        await super().__call__(scope, receive, send_with_etag)
@@ -1,27 +1,192 @@
+import importlib.util
 import os
-from typing import Any, Generator
+from typing import Any, AsyncGenerator
 
-from sqlalchemy import create_engine
+from sqlalchemy import Connection, create_engine, func, inspect, select, text
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.schema import CreateColumn, CreateIndex
 
 from app.utils.logger import logger
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./test.db")
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    pool_pre_ping=True,  # Ensure the connection is valid before each use
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# connection pool tuning, see the SQLAlchemy QueuePool docs
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# postgres advisory lock held while a worker creates or upgrades the schema
+SCHEMA_LOCK_KEY = int(os.getenv("SCHEMA_LOCK_KEY", "72309"))
+
+# asyncio drivers used in place of the sync drivers of the DATABASE_URL
+ASYNC_DRIVERS = {
+    "postgresql": ("postgresql+asyncpg", "asyncpg"),
+    "sqlite": ("sqlite+aiosqlite", "aiosqlite"),
+}
+
+
+def get_async_database_url(url: str) -> str | None:
+    """Return the asyncio flavour of `url`, or None if its driver is missing."""
+    scheme, _, rest = url.partition("://")
+    dialect = scheme.split("+")[0]
+    if dialect not in ASYNC_DRIVERS:
+        return None
+    async_scheme, module = ASYNC_DRIVERS[dialect]
+    if importlib.util.find_spec(module) is None:
+        return None
+    return f"{async_scheme}://{rest}"
+
+
+def get_pool_options(url: str) -> dict[str, Any]:
+    if url.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+
+
+class SyncSessionAdapter:
+    """Exposes a sync `Session` through the `AsyncSession` methods the CRUD uses.
+
+    Only meant for SQLite (e.g. tests) when no asyncio driver is installed,
+    the queries still block the event loop.
+    """
+
+    def __init__(self, session: Session) -> None:
+        self.session = session
+
+    def add(self, instance: Any) -> None:
+        self.session.add(instance)
+
+    def add_all(self, instances: Any) -> None:
+        self.session.add_all(instances)
+
+    def get_bind(self) -> Any:
+        return self.session.get_bind()
+
+    async def execute(self, *args: Any, **kwargs: Any) -> Any:
+        return self.session.execute(*args, **kwargs)
+
+    async def scalars(self, *args: Any, **kwargs: Any) -> Any:
+        return self.session.scalars(*args, **kwargs)
+
+    async def scalar(self, *args: Any, **kwargs: Any) -> Any:
+        return self.session.scalar(*args, **kwargs)
+
+    async def flush(self) -> None:
+        self.session.flush()
+
+    async def refresh(self, instance: Any) -> None:
+        self.session.refresh(instance)
+
+    async def commit(self) -> None:
+        self.session.commit()
+
+    async def rollback(self) -> None:
+        self.session.rollback()
+
+    async def close(self) -> None:
+        self.session.close()
+
+
+ASYNC_DATABASE_URL = get_async_database_url(SQLALCHEMY_DATABASE_URL)
+if ASYNC_DATABASE_URL is None and not SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
+    raise RuntimeError("no asyncio driver installed for DATABASE_URL")
+
+if ASYNC_DATABASE_URL is not None:
+    engine: Any = create_async_engine(
+        ASYNC_DATABASE_URL,
+        pool_pre_ping=True,  # Ensure the connection is valid before each use
+        **get_pool_options(ASYNC_DATABASE_URL),
+    )
+    SessionLocal: Any = async_sessionmaker(
+        bind=engine, autoflush=False, expire_on_commit=False
+    )
+else:
+    # fallback sync mode for SQLite without aiosqlite
+    logger.warning("aiosqlite is not installed, using the sync SQLite driver")
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, pool_pre_ping=True)
+    SessionLocal = sessionmaker(
+        autocommit=False, autoflush=False, expire_on_commit=False, bind=engine
+    )
 
 Base = declarative_base()
 
 
-# Dependency
-def get_db() -> Generator[Session, Any, None]:
+def upgrade_schema(conn: Connection) -> None:
+    """Bring tables created by an earlier version up to date.
+
+    `create_all` skips tables that already exist, so columns added to a model
+    since are added to its table here (they need a server default when they
+    are NOT NULL), and missing indexes are created, such as the listing
+    indexes of the tasks table. Every worker runs this on startup, so nothing
+    is changed when the schema is current.
+    """
+    inspector = inspect(conn)
+    # Postgres can skip what another worker added in the meantime
+    if_not_exists = " IF NOT EXISTS" if conn.dialect.name == "postgresql" else ""
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.execute(
+                    text(f"ALTER TABLE {table.name} ADD COLUMN{if_not_exists} {ddl}")
+                )
+                logger.info(f"Added column {table.name}.{column.name}")
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+                logger.info(f"Created index {index.name}")
+
+
+def create_schema(conn: Connection) -> None:
+    if conn.dialect.name == "postgresql":
+        # workers starting together would race to create the same tables and
+        # indexes, they wait for each other until the transaction ends
+        conn.execute(select(func.pg_advisory_xact_lock(SCHEMA_LOCK_KEY)))
+    Base.metadata.create_all(conn)
+    upgrade_schema(conn)
+
+
+async def init_db() -> None:
+    if isinstance(engine, AsyncEngine):
+        async with engine.begin() as conn:
+            await conn.run_sync(create_schema)
+    else:
+        with engine.begin() as conn:
+            create_schema(conn)
+
+
+async def close_db() -> None:
+    if isinstance(engine, AsyncEngine):
+        await engine.dispose()
+    else:
+        engine.dispose()
+
+
+def open_session() -> AsyncSession:
     db = SessionLocal()
+    if not isinstance(db, AsyncSession):
+        db = SyncSessionAdapter(db)
+    return db
+
+
+# Dependency
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
+    db = open_session()
     try:
         yield db
     except OperationalError as e:
@@ -29,7 +194,7 @@ def get_db() -> Generator[Session, Any, None]:
         logger.error(f"Operational Error encountered: {e}")
         raise e
     finally:
-        db.close()
+        await db.close()
 
 
 # def reconnect_db():
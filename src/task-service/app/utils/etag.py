@@ -0,0 +1,46 @@
+import hashlib
+import json
+from typing import Any
+
+
+def task_etag(task: Any) -> str:
+    """Strong ETag of a single task, changes whenever the task is updated."""
+    return f'"{task.id}-{task.version}"'
+
+
+def task_list_etag(tasks: list[dict[str, Any]], next_key: dict[str, Any] | None) -> str:
+    """Strong ETag of a page of tasks.
+
+    Every update bumps a task's version, so the ids and versions of the page
+    (and where the next page starts) identify its content without serializing
+    the tasks themselves.
+    """
+    state = json.dumps([[task["id"], task["version"]] for task in tasks] + [next_key])
+    return f'"l-{hashlib.sha1(state.encode()).hexdigest()}"'
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """If-None-Match comparison, which is weak: W/ prefixes are ignored."""
+    if header.strip() == "*":
+        return True
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return etag.removeprefix("W/") in tags
+
+
+def parse_task_etags(header: str) -> list[tuple[int, int]]:
+    """Parse an If-Match style header into (task id, version) pairs.
+
+    Weak tags never match strongly, so they are skipped. Raises ValueError
+    for tags that were not created by `task_etag`.
+    """
+    etags = []
+    for tag in header.split(","):
+        tag = tag.strip()
+        if not tag or tag.startswith("W/"):
+            continue
+        try:
+            task_id, version = tag.strip('"').split("-")
+            etags.append((int(task_id), int(version)))
+        except ValueError:
+            raise ValueError("invalid ETag")
+    return etags
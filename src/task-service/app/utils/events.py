@@ -0,0 +1,74 @@
+import zlib
+from typing import Any
+
+# operations an update can be folded into
+UPDATABLE = ("create", "update")
+
+
+def task_event(
+    operation: str, task_id: int, email: str, title: str | None = None
+) -> dict[str, Any]:
+    # "task" is what the notification shows: the title, or the id once deleted
+    return {
+        "operation": operation,
+        "task": title if title is not None else task_id,
+        "task_id": task_id,
+        "email": email,
+    }
+
+
+def event_shard(event: dict[str, Any], shards: int) -> int:
+    """Shard of the event's recipient, the same in every process and service."""
+    # crc32 rather than hash(), which is randomized per process for strings
+    return zlib.crc32(str(event.get("email") or "").encode()) % shards
+
+
+def with_event_ids(row_id: int, payload: Any) -> list[dict[str, Any]]:
+    """The events of an outbox row, each with an id unique across the service.
+
+    The change feed sends it as the SSE event id, clients resume after it.
+    """
+    if not isinstance(payload, list):
+        return [{**payload, "id": str(row_id)}]
+    return [{**event, "id": f"{row_id}.{i}"} for i, event in enumerate(payload)]
+
+
+def coalesce_events(events: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Drop the events made redundant by a later event for the same task.
+
+    Updates are folded into the create or update right before them, repeated
+    completes keep the last one, and a delete replaces the earlier events of
+    its task (or drops them all if the task was created in the same batch).
+    """
+    result: list[Any] = []  # dropped events are set to None
+    pending: dict[int, list[int]] = {}  # task id -> its events' indexes in result
+
+    for event in events:
+        task_id = event.get("task_id")
+        if task_id is None:
+            result.append(event)
+            continue
+
+        indexes = pending.setdefault(task_id, [])
+        last = result[indexes[-1]] if indexes else None
+        operation = event["operation"]
+
+        if operation == "delete":
+            created = any(result[i]["operation"] == "create" for i in indexes)
+            for i in indexes:
+                result[i] = None
+            indexes.clear()
+            if created:
+                continue
+        elif last and operation == "update" and last["operation"] in UPDATABLE:
+            # the latest state (and event id) under the earlier operation
+            result[indexes[-1]] = {**event, "operation": last["operation"]}
+            continue
+        elif last and operation == last["operation"] == "complete":
+            result[indexes[-1]] = event
+            continue
+
+        indexes.append(len(result))
+        result.append(event)
+
+    return [event for event in result if event is not None]
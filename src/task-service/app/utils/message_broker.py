@@ -1,109 +1,459 @@
 import json
 import os
+import queue
+import threading
 import time
+from collections import deque
+from concurrent.futures import Future
 from typing import Any
 
+import msgpack
 import pika
-import pika.exceptions
+import pika.frame
+import pika.spec
 from pika.adapters.blocking_connection import BlockingChannel
+from pika.adapters.select_connection import IOLoop
+from pika.channel import Channel
 
 from app.utils.logger import logger
 
-channel: BlockingChannel = None  # type: ignore
+RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
+RABBITMQ_PORT = int(os.getenv("RABBITMQ_PORT", "5672"))
+NOTIFICATION_QUEUE = "notification_queue"
+# events are routed to one of NOTIFICATION_SHARDS queues by recipient through
+# this exchange, the notification service must use the same number of shards
+NOTIFICATION_EXCHANGE = "notifications"
+NOTIFICATION_SHARDS = int(os.getenv("NOTIFICATION_SHARDS", "1"))
+# declared the same way by the notification service
+SHARD_QUEUE_ARGUMENTS = {"x-single-active-consumer": True}
 
+# "json" or "msgpack", the consumers pick the decoder from the content type
+PUBLISH_ENCODING = os.getenv("PUBLISH_ENCODING", "json")
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_MSGPACK = "application/msgpack"
 
-def get_rabbitmq_connection() -> Any:
-    # rabbitmq connection
-    max_count = 7
-    count = 0
-    while count < max_count:
-        try:
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters(
-                    host="rabbitmq",
-                    port=5672,
-                    credentials=pika.PlainCredentials(
-                        os.getenv("RABBITMQ_USER", ""),
-                        os.getenv("RABBITMQ_PASSWORD", ""),
+# each publisher thread owns one connection and one confirm channel
+PUBLISHER_THREADS = int(os.getenv("PUBLISHER_THREADS", "1"))
+# messages waiting for each publisher thread, new messages are dropped when full
+PUBLISH_QUEUE_SIZE = int(os.getenv("PUBLISH_QUEUE_SIZE", "10000"))
+
+# circuit breaker: after this many failures in a row stop talking to RabbitMQ ...
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+# ... and let a single attempt through again after this many seconds
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+
+
+class BrokerUnavailable(Exception):
+    """The message could not be handed to RabbitMQ."""
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        return self.state != "open"
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            # a failed attempt while half-open opens the circuit again
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+
+def encode_message(message: Any) -> tuple[bytes, str]:
+    if PUBLISH_ENCODING == "msgpack":
+        return msgpack.packb(message), CONTENT_TYPE_MSGPACK
+    return json.dumps(message).encode(), CONTENT_TYPE_JSON
+
+
+def decode_message(body: bytes, content_type: str | None) -> Any:
+    if content_type == CONTENT_TYPE_MSGPACK:
+        return msgpack.unpackb(body)
+    return json.loads(body)
+
+
+def shard_queue_name(shard: int) -> str:
+    return f"{NOTIFICATION_QUEUE}.{shard}"
+
+
+def declare_shards(channel: BlockingChannel | Channel) -> None:
+    # declared here too, so no event is dropped before the consumers ran once
+    channel.exchange_declare(
+        exchange=NOTIFICATION_EXCHANGE, exchange_type="direct", durable=True
+    )
+    for shard in range(NOTIFICATION_SHARDS):
+        queue = shard_queue_name(shard)
+        channel.queue_declare(
+            queue=queue, durable=True, arguments=SHARD_QUEUE_ARGUMENTS
+        )
+        channel.queue_bind(
+            queue=queue, exchange=NOTIFICATION_EXCHANGE, routing_key=str(shard)
+        )
+
+
+def get_connection_parameters() -> pika.ConnectionParameters:
+    # a single, short connection attempt, retries are up to the circuit breaker
+    return pika.ConnectionParameters(
+        host=RABBITMQ_HOST,
+        port=RABBITMQ_PORT,
+        credentials=pika.PlainCredentials(
+            os.getenv("RABBITMQ_USER", ""),
+            os.getenv("RABBITMQ_PASSWORD", ""),
+        ),
+        heartbeat=60,
+        connection_attempts=1,
+        socket_timeout=5,
+        blocked_connection_timeout=30,
+    )
+
+
+PublishItem = tuple[bytes, str, int, "Future[None]"]
+
+
+class PublisherThread(threading.Thread):
+    """Publishes queued messages on its own connection with publisher confirms.
+
+    The thread runs a pika SelectConnection: everything waiting in the queue is
+    published at once and the futures resolve as the broker acks or nacks the
+    messages, so confirms are pipelined instead of taking one round trip each.
+    Messages that were not confirmed when the connection went down are retried
+    once on a new connection.
+    """
+
+    def __init__(self, publisher: "Publisher", index: int) -> None:
+        super().__init__(name=f"rabbitmq-publisher-{index}", daemon=True)
+        self.publisher = publisher
+        self.queue = publisher.queues[index]
+        self.ioloop = IOLoop()
+        self.connection: pika.SelectConnection | None = None
+        # set once the shards are declared and the confirm mode is on
+        self.channel: Channel | None = None
+        self.stopping = False
+        # the channel became ready on the current connection
+        self.connected = False
+        # set while a drain is scheduled on the ioloop, so submits wake it once
+        self.woken = False
+        self.wake_lock = threading.Lock()
+
+        # messages to publish once the channel is ready, with their attempt
+        self.pending: deque[tuple[PublishItem, int]] = deque()
+        # published messages waiting for their confirm, by delivery tag
+        self.unconfirmed: dict[int, tuple[PublishItem, int]] = {}
+        # delivery tags of the messages the broker returned as unroutable
+        self.returned: set[int] = set()
+        self.delivery_tag = 0
+
+    def run(self) -> None:
+        while not self.stopping:
+            if not self.pending:
+                item = self.queue.get()
+                if item is None:
+                    break
+                self.pending.append((item, 0))
+            if not self.publisher.breaker.allow():
+                self.fail_pending(BrokerUnavailable("circuit breaker is open"))
+                continue
+            self.connected = False
+            self.connection = pika.SelectConnection(
+                get_connection_parameters(),
+                on_open_callback=self.on_connection_open,
+                on_open_error_callback=self.on_connection_open_error,
+                on_close_callback=self.on_connection_closed,
+                custom_ioloop=self.ioloop,
+            )
+            # returns once the connection is closed
+            self.ioloop.start()
+            self.connection = None
+        self.fail_pending(BrokerUnavailable("publisher stopped"))
+        self.ioloop.close()
+
+    def wake(self) -> None:
+        """Publish newly queued messages, called from other threads."""
+        with self.wake_lock:
+            if self.woken:
+                return
+            self.woken = True
+        self.ioloop.add_callback_threadsafe(self.drain)
+
+    def drain(self) -> None:
+        with self.wake_lock:
+            self.woken = False
+        if self.channel is None:
+            # published once the channel is ready
+            return
+
+        breaker = self.publisher.breaker
+        while not self.stopping:
+            if self.pending:
+                item, attempt = self.pending.popleft()
+            else:
+                try:
+                    queued = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if queued is None:
+                    self.stopping = True
+                    break
+                item, attempt = queued, 0
+
+            if not breaker.allow():
+                self.publisher.fail(
+                    item[3], BrokerUnavailable("circuit breaker is open")
+                )
+                continue
+            body, content_type, shard, _ = item
+            try:
+                self.channel.basic_publish(
+                    exchange=NOTIFICATION_EXCHANGE,
+                    routing_key=str(shard),
+                    body=body,
+                    properties=pika.BasicProperties(
+                        content_type=content_type,
+                        delivery_mode=pika.DeliveryMode.Persistent,
                     ),
-                    heartbeat=60
+                    # returned instead of dropped if no queue is bound to the shard
+                    mandatory=True,
                 )
-            )
-            logger.info("New rabbitmq connection created")
-            return connection
-        except pika.exceptions.AMQPConnectionError:
-            count += 1
-            logger.info("Connection failed, retrying in 5 seconds...")
-            time.sleep(5)
-    return None
-
-
-def get_rabbitmq_channel() -> BlockingChannel | None:
-    global channel
-    if not channel or channel.is_closed:
-        connection = get_rabbitmq_connection()
-        if not connection:
-            return None
-        channel = connection.channel()
-        channel.queue_declare(queue="notification_queue", durable=True)
-    return channel
-
-
-def close_rabbitmq_channel() -> None:
-    global channel
-    try:
-        channel.close()
-    except Exception:
-        logger.error("error occurred while closing channel")
-
-
-def publish(message: Any) -> None:
-    global channel
-    if not channel:
-        try:
-            get_rabbitmq_channel()
-        except Exception as e:
-            logger.error(f"Failed to create channel: {e}")
-            channel = None  # type: ignore
-    try:
-        channel.basic_publish(
-            exchange="",
-            routing_key="notification_queue",
-            body=json.dumps(message),
-            properties=pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent),
+            except Exception as e:
+                logger.warning(f"{self.name}: failed to publish: {e}")
+                self.pending.appendleft((item, attempt))
+                self.close()
+                return
+            self.delivery_tag += 1
+            self.unconfirmed[self.delivery_tag] = (item, attempt)
+
+        if self.stopping and not self.unconfirmed:
+            self.close()
+
+    def on_connection_open(self, connection: pika.SelectConnection) -> None:
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_open_error(
+        self, connection: pika.SelectConnection, error: BaseException | str
+    ) -> None:
+        logger.warning(f"{self.name}: failed to connect to rabbitmq: {error}")
+        self.publisher.breaker.record_failure()
+        self.fail_pending(BrokerUnavailable(repr(error)))
+        self.ioloop.stop()
+
+    def on_channel_open(self, channel: Channel) -> None:
+        channel.add_on_close_callback(self.on_channel_closed)
+        channel.add_on_return_callback(self.on_return)
+        # the RPCs of a channel run in order, so the shards are declared
+        # before the confirm mode is on
+        declare_shards(channel)
+        channel.confirm_delivery(
+            ack_nack_callback=self.on_confirm,
+            callback=lambda _frame: self.on_channel_ready(channel),
         )
-    except pika.exceptions.ConnectionClosedByBroker:
-        logger.warn("Connection closed by broker, attempting to reconnect...")
-        channel = None  # type: ignore
-        try:
-            get_rabbitmq_channel()
-            channel.basic_publish(
-                exchange="",
-                routing_key="notification_queue",
-                body=json.dumps(message),
-                properties=pika.BasicProperties(
-                    delivery_mode=pika.DeliveryMode.Persistent
-                ),
-            )
-        except Exception as e:
-            channel = None  # type: ignore
-            logger.error(f"Failed to publish message: {e}")
-    except pika.exceptions.StreamLostError:
-        logger.warn("Stream connection lost, attempting to reconnect...")
-        channel = None  # type: ignore
+
+    def on_channel_ready(self, channel: Channel) -> None:
+        self.channel = channel
+        self.connected = True
+        self.delivery_tag = 0
+        logger.info(f"{self.name}: new rabbitmq connection created")
+        self.drain()
+
+    def on_channel_closed(self, channel: Channel, reason: BaseException) -> None:
+        logger.warning(f"{self.name}: rabbitmq channel closed: {reason}")
+        self.channel = None
+        self.close()
+
+    def on_return(
+        self,
+        channel: Channel,
+        method: pika.spec.Basic.Return,
+        properties: pika.BasicProperties,
+        body: bytes,
+    ) -> None:
+        # a return comes before the ack of its message, which is the oldest
+        # unconfirmed one with the same shard and body
+        for tag, ((item_body, _, shard, _), _) in self.unconfirmed.items():
+            if (
+                tag not in self.returned
+                and str(shard) == method.routing_key
+                and item_body == body
+            ):
+                self.returned.add(tag)
+                return
+
+    def on_confirm(self, frame: pika.frame.Method) -> None:
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:
+            tags = [tag for tag in self.unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        # the broker is reachable, even if it refused some of the messages
+        self.publisher.breaker.record_success()
+        for tag in tags:
+            entry = self.unconfirmed.pop(tag, None)
+            if entry is None:
+                continue
+            future = entry[0][3]
+            if tag in self.returned:
+                self.returned.discard(tag)
+                self.publisher.fail(future, BrokerUnavailable("message unroutable"))
+            elif acked:
+                self.publisher.succeed(future)
+            else:
+                self.publisher.fail(future, BrokerUnavailable("message nacked"))
+
+        if self.stopping and not self.unconfirmed:
+            self.close()
+
+    def on_connection_closed(
+        self, connection: pika.SelectConnection, reason: BaseException
+    ) -> None:
+        if not self.stopping:
+            logger.warning(f"{self.name}: rabbitmq connection closed: {reason}")
+        self.channel = None
+        unconfirmed, self.unconfirmed = self.unconfirmed, {}
+        self.returned.clear()
+
+        retry: list[tuple[PublishItem, int]] = []
+        failed = False
+        for item, attempt in unconfirmed.values():
+            if attempt == 0 and not self.stopping:
+                # the connection went stale, retry once on a new one
+                retry.append((item, attempt + 1))
+            else:
+                failed = True
+                self.publisher.fail(item[3], BrokerUnavailable(repr(reason)))
+        if not self.connected:
+            # closed while setting up the channel, nothing can be published
+            failed = True
+            self.fail_pending(BrokerUnavailable(repr(reason)))
+        if failed:
+            self.publisher.breaker.record_failure()
+        # retried ahead of the rest, to keep the order of the shard
+        self.pending.extendleft(reversed(retry))
+        self.ioloop.stop()
+
+    def fail_pending(self, error: Exception) -> None:
+        while self.pending:
+            item, _ = self.pending.popleft()
+            self.publisher.fail(item[3], error)
+
+    def close(self) -> None:
+        connection = self.connection
+        if connection is not None and not (
+            connection.is_closing or connection.is_closed
+        ):
+            try:
+                connection.close()
+            except Exception:
+                logger.error(f"{self.name}: error occurred while closing connection")
+
+
+class Publisher:
+    """Hands messages to publisher threads through bounded queues.
+
+    `submit` never blocks the caller, the returned future resolves once the
+    broker confirmed the message or fails with `BrokerUnavailable`. All the
+    messages of a shard go through the same thread, so they are published in
+    the order they were submitted.
+    """
+
+    def __init__(self, threads: int, queue_size: int) -> None:
+        self.thread_count = threads
+        self.queues: "list[queue.Queue[PublishItem | None]]" = [
+            queue.Queue(maxsize=queue_size) for _ in range(max(threads, 1))
+        ]
+        self.breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+        self.threads: list[PublisherThread] = []
+        self.lock = threading.Lock()
+
+        self.published_total = 0
+        self.failed_total = 0
+
+    def start(self) -> None:
+        with self.lock:
+            if self.threads:
+                return
+            self.threads = [
+                PublisherThread(self, index) for index in range(self.thread_count)
+            ]
+            for thread in self.threads:
+                thread.start()
+
+    def stop(self, timeout: float = 5) -> None:
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for thread in threads:
+            try:
+                thread.queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            thread.wake()
+        for thread in threads:
+            thread.join(timeout)
+
+    def submit(self, message: Any, shard: int = 0) -> "Future[None]":
+        future: Future[None] = Future()
+        if not self.threads:
+            self.start()
+        if not self.breaker.allow():
+            self.fail(future, BrokerUnavailable("circuit breaker is open"))
+            return future
+        index = shard % len(self.queues)
         try:
-            get_rabbitmq_channel()
-            channel.basic_publish(
-                exchange="",
-                routing_key="notification_queue",
-                body=json.dumps(message),
-                properties=pika.BasicProperties(
-                    delivery_mode=pika.DeliveryMode.Persistent
-                ),
-            )
-        except Exception as e:
-            channel = None  # type: ignore
-            logger.error(f"Failed to publish message: {e}")
-    except Exception as e:
-        logger.error(f"Failed to publish message: {e}")
-        channel = None  # type: ignore
+            self.queues[index].put_nowait((*encode_message(message), shard, future))
+        except queue.Full:
+            self.fail(future, BrokerUnavailable("publish queue is full"))
+            return future
+        if index < len(self.threads):
+            self.threads[index].wake()
+        return future
+
+    def succeed(self, future: "Future[None]") -> None:
+        with self.lock:
+            self.published_total += 1
+        future.set_result(None)
+
+    def fail(self, future: "Future[None]", error: Exception) -> None:
+        with self.lock:
+            self.failed_total += 1
+        future.set_exception(error)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "threads": len(self.threads),
+            "queued": sum(q.qsize() for q in self.queues),
+            "queue_size": sum(q.maxsize for q in self.queues),
+            "shards": NOTIFICATION_SHARDS,
+            "published_total": self.published_total,
+            "failed_total": self.failed_total,
+            "circuit_breaker": self.breaker.state,
+        }
+
+
+publisher = Publisher(PUBLISHER_THREADS, PUBLISH_QUEUE_SIZE)
+
+
+def start_publisher() -> None:
+    publisher.start()
+
+
+def stop_publisher() -> None:
+    publisher.stop()
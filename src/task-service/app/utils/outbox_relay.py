@@ -0,0 +1,198 @@
+import asyncio
+import os
+from typing import Any
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.outbox import OutboxEvent
+from app.utils.database import open_session
+from app.utils.events import coalesce_events, event_shard, with_event_ids
+from app.utils.logger import logger
+from app.utils.message_broker import NOTIFICATION_SHARDS, publisher
+
+# outbox rows relayed per round trip
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+# after being woken up, wait this long so a burst of writes goes out together
+OUTBOX_BATCH_WINDOW = float(os.getenv("OUTBOX_BATCH_WINDOW", "0.05"))
+# events per published message
+OUTBOX_MESSAGE_MAX_EVENTS = int(os.getenv("OUTBOX_MESSAGE_MAX_EVENTS", "100"))
+# how often the outbox is polled when nothing woke the relay up (seconds)
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+# how long to wait for the broker to confirm a batch (seconds)
+OUTBOX_PUBLISH_TIMEOUT = float(os.getenv("OUTBOX_PUBLISH_TIMEOUT", "10"))
+# pause after a batch could not be published (seconds)
+OUTBOX_RETRY_DELAY = float(os.getenv("OUTBOX_RETRY_DELAY", "5"))
+# postgres advisory lock held by the worker that is relaying
+OUTBOX_RELAY_LOCK_KEY = int(os.getenv("OUTBOX_RELAY_LOCK_KEY", "72310"))
+
+
+def build_messages(
+    payloads: list[Any], shards: int = NOTIFICATION_SHARDS
+) -> list[tuple[int, list[dict[str, Any]]]]:
+    """Merge the events of a batch of outbox rows into as few messages as possible.
+
+    Returns the messages with their shard, a message only holds the events of
+    one shard and keeps them in the order they were written.
+    """
+    events: list[dict[str, Any]] = []
+    for payload in payloads:
+        events += payload if isinstance(payload, list) else [payload]
+
+    by_shard: dict[int, list[dict[str, Any]]] = {}
+    for event in coalesce_events(events):
+        by_shard.setdefault(event_shard(event, shards), []).append(event)
+    return [
+        (shard, shard_events[i : i + OUTBOX_MESSAGE_MAX_EVENTS])
+        for shard, shard_events in by_shard.items()
+        for i in range(0, len(shard_events), OUTBOX_MESSAGE_MAX_EVENTS)
+    ]
+
+
+class OutboxRelay:
+    """Publishes outbox rows in batches and deletes them once confirmed.
+
+    The events of a batch are coalesced and sent as a few list messages, so
+    the broker confirms (and persists) one message instead of one per event.
+    Delivery is at least once: a failed or unconfirmed message keeps the
+    whole batch in the outbox, and a crash between the broker confirm and
+    the DELETE publishes the rows again.
+
+    A recipient's events are published in the order they were written: only
+    one worker relays at a time, as it holds an advisory lock for the length
+    of its batch, and the messages of a shard go through a single publisher
+    thread. A worker that finds the lock taken tries again shortly after.
+    """
+
+    def __init__(self) -> None:
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task[None] | None = None
+
+        self.relayed_total = 0
+        self.failed_total = 0
+        self.lock_busy_total = 0
+        self.messages_total = 0
+        self.events_total = 0
+
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    def wake(self) -> None:
+        """Relay new rows now instead of at the next poll."""
+        self.wakeup.set()
+
+    async def run(self) -> None:
+        while True:
+            self.wakeup.clear()
+            try:
+                relayed, failed = await self.relay_batch()
+            except Exception as e:
+                logger.error(f"Failed to relay outbox events: {e}")
+                relayed, failed = 0, True
+
+            if failed:
+                await asyncio.sleep(OUTBOX_RETRY_DELAY)
+            elif relayed < OUTBOX_BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    continue
+                await asyncio.sleep(OUTBOX_BATCH_WINDOW)
+
+    async def relay_batch(self) -> tuple[int, bool]:
+        """Relay one batch, returns the number of rows relayed and if it failed."""
+        db = open_session()
+        try:
+            if not await self.try_lock(db):
+                await db.rollback()
+                self.lock_busy_total += 1
+                # the rows this worker was woken up for may not be relayed yet
+                self.wakeup.set()
+                return 0, False
+
+            events = list(
+                await db.scalars(
+                    select(OutboxEvent)
+                    .order_by(OutboxEvent.id)
+                    .limit(OUTBOX_BATCH_SIZE)
+                )
+            )
+            if not events:
+                await db.rollback()
+                return 0, False
+
+            messages = build_messages(
+                [with_event_ids(event.id, event.payload) for event in events]
+            )
+            futures = [
+                asyncio.wrap_future(publisher.submit(message, shard))
+                for shard, message in messages
+            ]
+            try:
+                results: list[Any] = await asyncio.wait_for(
+                    asyncio.gather(*futures, return_exceptions=True),
+                    OUTBOX_PUBLISH_TIMEOUT,
+                )
+            except asyncio.TimeoutError as e:
+                results = [e]
+
+            failed = any(isinstance(result, BaseException) for result in results)
+            if not failed:
+                await db.execute(
+                    delete(OutboxEvent).where(
+                        OutboxEvent.id.in_([event.id for event in events])
+                    )
+                )
+            await db.commit()
+        finally:
+            await db.close()
+
+        if failed:
+            self.failed_total += len(events)
+            logger.warning(
+                f"{len(events)} outbox events could not be published, retrying"
+            )
+            return 0, True
+        self.relayed_total += len(events)
+        self.messages_total += len(messages)
+        self.events_total += sum(len(message) for _, message in messages)
+        return len(events), False
+
+    @staticmethod
+    async def try_lock(db: AsyncSession) -> bool:
+        """Take the relay lock until the end of the transaction, if it is free.
+
+        Relaying several batches at once could publish a recipient's later
+        events before the earlier ones. SQLite has no advisory locks, it is
+        only used with a single worker.
+        """
+        if db.get_bind().dialect.name != "postgresql":
+            return True
+        locked: bool = await db.scalar(
+            select(func.pg_try_advisory_xact_lock(OUTBOX_RELAY_LOCK_KEY))
+        )
+        return locked
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "running": self.task is not None and not self.task.done(),
+            "relayed_total": self.relayed_total,
+            "failed_total": self.failed_total,
+            "lock_busy_total": self.lock_busy_total,
+            "messages_total": self.messages_total,
+            "events_total": self.events_total,
+        }
+
+
+outbox_relay = OutboxRelay()
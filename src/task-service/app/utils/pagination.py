@@ -0,0 +1,21 @@
+import base64
+import json
+from typing import Any
+
+
+def encode_cursor(values: dict[str, Any]) -> str:
+    """Encode the sort key values of the last row into an opaque cursor."""
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> dict[str, Any]:
+    """Decode a cursor created by `encode_cursor`. Raises ValueError if invalid."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except Exception:
+        raise ValueError("invalid cursor")
+    if not isinstance(values, dict):
+        raise ValueError("invalid cursor")
+    return values
@@ -0,0 +1,219 @@
+import importlib
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Any, Protocol
+
+from app.utils.logger import logger
+
+TASK_CACHE_ENABLED = os.getenv("TASK_CACHE_ENABLED", "true").lower() == "true"
+# seconds a cached read may be served
+TASK_CACHE_TTL = float(os.getenv("TASK_CACHE_TTL", "5"))
+TASK_CACHE_MAX_SIZE = int(os.getenv("TASK_CACHE_MAX_SIZE", "10000"))
+# "memory" keeps a store per worker process, so a write through one worker
+# would not invalidate the reads cached by the others: it is only used with a
+# single worker. "redis" shares one store between every worker and instance
+TASK_CACHE_BACKEND = os.getenv("TASK_CACHE_BACKEND", "memory")
+TASK_CACHE_REDIS_URL = os.getenv("TASK_CACHE_REDIS_URL", "redis://redis:6379/0")
+# the number of gunicorn workers, gunicorn reads it as its default
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+
+class CacheStore(Protocol):
+    """Where cached reads are kept, e.g. in process or in a shared cache server."""
+
+    async def get(self, key: str) -> Any | None: ...
+
+    async def set(self, key: str, value: Any, ttl: float) -> None: ...
+
+    def stats(self) -> dict[str, Any]: ...
+
+    async def close(self) -> None: ...
+
+
+class MemoryStore:
+    """Bounded in-process LRU store with a TTL per entry."""
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        # key -> (expires_at, value)
+        self.entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+        self.evictions = 0
+        self.expirations = 0
+
+    async def get(self, key: str) -> Any | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "backend": "memory",
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    async def close(self) -> None:
+        pass
+
+
+def encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, date):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"{type(value).__name__} can not be cached")
+
+
+def decode_value(value: dict[str, Any]) -> Any:
+    if value.keys() == {"$datetime"}:
+        return datetime.fromisoformat(value["$datetime"])
+    if value.keys() == {"$date"}:
+        return date.fromisoformat(value["$date"])
+    return value
+
+
+class RedisStore:
+    """Store in a Redis server shared by every worker, values are kept as JSON.
+
+    Entries expire in Redis. A failing server is logged and treated as a miss.
+    """
+
+    def __init__(self, client: Any) -> None:
+        # a redis.asyncio.Redis
+        self.client = client
+        self.errors = 0
+
+    async def get(self, key: str) -> Any | None:
+        try:
+            data = await self.client.get(key)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Task cache read failed: {e}")
+            return None
+        if data is None:
+            return None
+        return json.loads(data, object_hook=decode_value)
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        data = json.dumps(value, default=encode_value)
+        try:
+            await self.client.set(key, data, px=max(int(ttl * 1000), 1))
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Task cache write failed: {e}")
+
+    def stats(self) -> dict[str, Any]:
+        return {"backend": "redis", "errors": self.errors}
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+class TaskCache:
+    """Read-through cache of a user's task reads.
+
+    Keys hold the user's current generation, a write starts a new one so
+    every cached read of that user is skipped from then on and ages out of
+    the store. A missing generation is replaced by a new one as well, so an
+    evicted generation never brings back older entries.
+    """
+
+    def __init__(self, store: CacheStore, ttl: float, enabled: bool = True) -> None:
+        self.store = store
+        self.ttl = ttl
+        self.enabled = enabled
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _generation_key(self, user_id: int) -> str:
+        return f"tasks:{user_id}:generation"
+
+    async def key(self, user_id: int, kind: str, params: Any) -> str | None:
+        """Key of a read of `kind` with the given parameters, None if disabled."""
+        if not self.enabled:
+            return None
+        generation_key = self._generation_key(user_id)
+        generation = await self.store.get(generation_key)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            # outlives the entries stored under it
+            await self.store.set(generation_key, generation, self.ttl * 10)
+        shape = json.dumps(params, sort_keys=True, default=str)
+        return f"tasks:{user_id}:{generation}:{kind}:{shape}"
+
+    async def get(self, key: str | None) -> Any | None:
+        if key is None:
+            return None
+        value = await self.store.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str | None, value: Any) -> None:
+        if key is not None:
+            await self.store.set(key, value, self.ttl)
+
+    async def invalidate(self, user_id: int) -> None:
+        """Drop the user's cached reads, called after each committed write."""
+        if not self.enabled:
+            return
+        self.invalidations += 1
+        await self.store.set(
+            self._generation_key(user_id), uuid.uuid4().hex, self.ttl * 10
+        )
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "store": self.store.stats(),
+        }
+
+    async def close(self) -> None:
+        await self.store.close()
+
+
+def create_task_cache() -> TaskCache:
+    if TASK_CACHE_BACKEND == "redis":
+        redis = importlib.import_module("redis.asyncio")
+        store: CacheStore = RedisStore(redis.from_url(TASK_CACHE_REDIS_URL))
+        return TaskCache(store, TASK_CACHE_TTL, enabled=TASK_CACHE_ENABLED)
+
+    enabled = TASK_CACHE_ENABLED
+    if enabled and WEB_CONCURRENCY > 1:
+        logger.warning(
+            f"Task cache disabled: the memory backend is not shared between "
+            f"{WEB_CONCURRENCY} workers, set TASK_CACHE_BACKEND=redis"
+        )
+        enabled = False
+    return TaskCache(MemoryStore(TASK_CACHE_MAX_SIZE), TASK_CACHE_TTL, enabled=enabled)
+
+
+task_cache = create_task_cache()
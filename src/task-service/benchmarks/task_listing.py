@@ -0,0 +1,100 @@
+"""Compare the task listing serialization paths.
+
+    python -m benchmarks.task_listing [--rows 1000 10000] [--repeat 5]
+
+"orm" is how GET /tasks/ used to work: ORM instances validated through
+UserTasksOutput and encoded with the stdlib JSON encoder. "rows" is the
+current path: selected columns as dicts, encoded with orjson.
+"""
+
+import argparse
+import asyncio
+import time
+from typing import Any, Callable
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import TypeAdapter
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.crud.task import _get_user_tasks
+from app.enums.sort_enum import TaskSort
+from app.models.outbox import OutboxEvent  # noqa: F401
+from app.models.task import Task
+from app.models.user import User  # noqa: F401
+from app.routers.tasks import LIST_FIELDS
+from app.schemas.task import UserTasksOutput
+from app.utils.database import Base, SyncSessionAdapter
+
+listing = TypeAdapter(list[UserTasksOutput])
+
+
+async def orm_page(db: SyncSessionAdapter, limit: int) -> bytes:
+    tasks = list(await db.scalars(select(Task).where(Task.user_id == 1).limit(limit)))
+    content = listing.dump_python(
+        listing.validate_python(tasks, from_attributes=True), mode="json"
+    )
+    return JSONResponse(content).body
+
+
+async def rows_page(db: SyncSessionAdapter, limit: int) -> bytes:
+    # bypasses the task cache, which would answer every run after the first
+    tasks, _ = await _get_user_tasks(db, 1, 0, limit, None, TaskSort.ID, None)
+    content = [{field: task[field] for field in LIST_FIELDS} for task in tasks]
+    return ORJSONResponse(content).body
+
+
+def measure(
+    page: Callable[[SyncSessionAdapter, int], Any],
+    db: SyncSessionAdapter,
+    rows: int,
+    repeat: int,
+) -> float:
+    """Best time of `repeat` runs, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        asyncio.run(page(db, rows))
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.task_listing")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    session.execute(
+        insert(Task),
+        [
+            {
+                "title": f"Task {i}",
+                "description": "A task to benchmark the listing with",
+                "status": "OPEN",
+                "user_id": 1,
+            }
+            for i in range(max(args.rows))
+        ],
+    )
+    session.commit()
+    db = SyncSessionAdapter(session)
+
+    for rows in args.rows:
+        orm = measure(orm_page, db, rows, args.repeat)
+        fast = measure(rows_page, db, rows, args.repeat)
+        print(
+            f"{rows:>6} rows: orm {orm * 1000:7.1f} ms ({rows / orm:>9,.0f} rows/s)"
+            f"  rows {fast * 1000:7.1f} ms ({rows / fast:>9,.0f} rows/s)"
+            f"  {orm / fast:.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()